@@ -1,11 +1,31 @@
+import os
 import sys
+import json
 import click
 import logging
+import multiprocessing
 from snapshot_repository import S3Handler
+from filesystem_repository import FileSystemRepository
 from cassandra_handler import CassandraHandler
 from snapshot_metadata import SnapshotMetadata
-from utils import (cassandra_backup_to_s3, get_environment_variable, validate_aws_permissions)
+from utils import (cassandra_backup_to_s3, cassandra_restore_from_s3, cassandra_verify_s3,
+                   refresh_snapshot_catalog, get_environment_variable, validate_aws_permissions, convert_mb_to_byte,
+                   format_size, generate_snapshot_timestamp, generate_snapshot_id, parse_snapshot_time,
+                   parallel_download)
 from notifier import SlackNotificationSender
+from compression import StreamCompressor
+from transfer_scheduler import TransferScheduler
+from transfer_policy import TransferPolicy
+from throttle import (TokenBucket, DiskPressureMonitor)
+from checkpoint_journal import CheckpointJournal
+from metrics import (SnapshotMetrics, MetricsReporter)
+from snapshot_catalog import SnapshotCatalog
+from snapshot_consolidator import SnapshotConsolidator
+from restore_planner import RestorePlanner
+from snapshot_pruner import SnapshotPruner
+from cluster_coordinator import (ClusterCoordinator, parse_cluster_nodes)
+from constants import (JOURNAL_DEFAULT_PATH, CATALOG_DEFAULT_PATH, SNAPSHOT_METADATA_FILE,
+                       METRICS_DEFAULT_INTERVAL, CLUSTER_LOG_DEFAULT_PATH, SUCCESS_FIELD_METADATA)
 
 
 # Optional environment variables
@@ -15,6 +35,24 @@ AWS_SECRET_KEY = get_environment_variable('AWS_SECRET_ACCESS_KEY')
 SLACK_TOKEN = get_environment_variable('SLACK_TOKEN')
 
 
+def repository_name(bucket, repository_path):
+    if (bucket is None) == (repository_path is None):
+        raise click.UsageError("Exactly one of --bucket and --repository-path is required")
+    return bucket if bucket is not None else os.path.abspath(repository_path)
+
+
+def create_repository(bucket, repository_path, aws_access_key, aws_secret_key, ssl_no_verify, s3_endpoint_url,
+                      **kwargs):
+    """
+    S3 bucket, or a local/NFS directory with the same layout when --repository-path is given.
+    """
+    repository_name(bucket, repository_path)
+    if repository_path is not None:
+        return FileSystemRepository(repository_path)
+    validate_aws_permissions(aws_access_key, aws_secret_key)
+    return S3Handler(bucket, aws_access_key, aws_secret_key, ssl_no_verify, endpoint_url=s3_endpoint_url, **kwargs)
+
+
 @click.group()
 def cli():
     pass
@@ -25,50 +63,466 @@ def cli():
 @click.option('--verbose', is_flag=True)
 @click.option('--ssl-no-verify', is_flag=True)
 @click.option('--node', default=HOSTNAME)
-@click.option('--bucket', required=True)
+@click.option('--bucket', default=None)
+@click.option('--repository-path', default=None)
 @click.option('--aws-access-key', default=AWS_ACCESS_KEY)
 @click.option('--aws-secret-key', default=AWS_SECRET_KEY)
+@click.option('--s3-endpoint-url', default=None)
 @click.option('--cassandra-data-dir', default='/var/lib/cassandra/data')
 @click.option('--cassandra-bin-dir', default='/bin')
 @click.option('--snapshot-type', type=click.Choice(['full', 'incremental']), default='full')
-@click.option('--upload-chunksize', default=10, type=int)
-@click.option('--upload-concurrency', default=25*1024, type=int)
+@click.option('--snapshot-id', default=None)
+@click.option('--upload-chunksize', default=None, type=int)
+@click.option('--multipart-threshold', default=16, type=int)
+@click.option('--upload-concurrency', default=None, type=int, hidden=True)
 @click.option('--upload-workers', default=1, type=int)
 @click.option('--keyspaces', default=None, type=str)
+@click.option('--crawl-workers', default=1, type=int)
+@click.option('--device-read-concurrency', default=None, type=int)
 @click.option('--s3-storage-class', type=click.Choice(['STANDARD', 'STANDARD_IA', 'REDUCED_REDUNDANCY']),
               default='STANDARD')
+@click.option('--dedup', is_flag=True)
+@click.option('--compress', type=click.Choice(['zstd', 'lz4']), default=None)
+@click.option('--compress-workers', default=multiprocessing.cpu_count(), type=int)
+@click.option('--bundle-threshold', default=0, type=int)
+@click.option('--bundle-size', default=16, type=int)
+@click.option('--max-upload-rate', default=None, type=float)
+@click.option('--max-read-rate', default=None, type=float)
+@click.option('--adaptive-throttle', is_flag=True)
+@click.option('--resume', is_flag=True)
+@click.option('--early-cleanup', is_flag=True)
+@click.option('--purge-backups', is_flag=True)
+@click.option('--journal-path', default=os.path.expanduser(JOURNAL_DEFAULT_PATH))
+@click.option('--catalog-path', default=os.path.expanduser(CATALOG_DEFAULT_PATH))
+@click.option('--metrics-file', default=None)
+@click.option('--metrics-format', type=click.Choice(['json', 'prometheus']), default='json')
+@click.option('--metrics-interval', default=METRICS_DEFAULT_INTERVAL, type=int)
 @click.option('--slack-alert', is_flag=True)
 @click.option('--slack-channel', default=None, required=False)
 @click.option('--slack-token', default=SLACK_TOKEN, required=False)
-def snapshot(log_level, verbose, ssl_no_verify, node, bucket, aws_access_key, aws_secret_key, cassandra_data_dir,
-             cassandra_bin_dir, snapshot_type, upload_chunksize, upload_concurrency, upload_workers, keyspaces,
-             s3_storage_class, slack_alert, slack_channel, slack_token):
+def snapshot(log_level, verbose, ssl_no_verify, node, bucket, repository_path, aws_access_key, aws_secret_key,
+             s3_endpoint_url, cassandra_data_dir, cassandra_bin_dir, snapshot_type, snapshot_id, upload_chunksize,
+             multipart_threshold, upload_concurrency, upload_workers, keyspaces, crawl_workers, device_read_concurrency,
+             s3_storage_class, dedup, compress, compress_workers, bundle_threshold, bundle_size, max_upload_rate,
+             max_read_rate, adaptive_throttle, resume, early_cleanup, purge_backups, journal_path, catalog_path,
+             metrics_file, metrics_format, metrics_interval, slack_alert, slack_channel, slack_token):
     logging.basicConfig(level=logging.getLevelName(log_level.upper()),
                         format='[%(levelname)s] [%(asctime)s] %(message)s')
 
+    metrics = SnapshotMetrics()
+    metrics_reporter = MetricsReporter(metrics, metrics_interval).start()
+    succeeded = False
+    compressor, disk_pressure_monitor = None, None
     try:
         if slack_alert is True:
             slack_client = SlackNotificationSender(slack_token, slack_channel)
             slack_client.send_notification("Starting snapshot", node=node, status="normal")
 
-        validate_aws_permissions(aws_access_key, aws_secret_key)
+        if upload_concurrency is not None:
+            logging.warning("--upload-concurrency is deprecated, uploads are bounded by --upload-workers")
+
+        if adaptive_throttle and max_read_rate is None:
+            raise click.UsageError("--adaptive-throttle requires --max-read-rate")
+        if early_cleanup and snapshot_type != "full":
+            raise click.UsageError("--early-cleanup applies to full snapshots only")
+        if early_cleanup and resume:
+            raise click.UsageError("--early-cleanup removes uploaded files, such a snapshot can't be resumed")
+        if purge_backups and snapshot_type != "incremental":
+            raise click.UsageError("--purge-backups applies to incremental snapshots only")
+        if snapshot_id is not None:
+            parse_snapshot_time(snapshot_id)
+
+        compressor = StreamCompressor(compress, compress_workers) if compress is not None else None
+        read_limiter = TokenBucket(convert_mb_to_byte(max_read_rate)) if max_read_rate is not None else None
+        network_limiter = TokenBucket(convert_mb_to_byte(max_upload_rate)) if max_upload_rate is not None else None
+        disk_pressure_monitor = DiskPressureMonitor(read_limiter, cassandra_data_dir.split(',')).start() \
+            if adaptive_throttle else None
+
+        repository_handler = create_repository(bucket, repository_path, aws_access_key, aws_secret_key, ssl_no_verify,
+                                               s3_endpoint_url, transfer_workers=upload_workers,
+                                               storage_class=s3_storage_class, metrics=metrics)
+        transfer_policy = TransferPolicy(upload_workers, S3Handler.convert_kb_to_byte(upload_chunksize)
+                                         if upload_chunksize is not None else None,
+                                         convert_mb_to_byte(multipart_threshold))
 
-        repository_handler = S3Handler(bucket, aws_access_key, aws_secret_key, ssl_no_verify, upload_chunksize,
-                                       upload_concurrency, upload_workers, s3_storage_class)
-        cassandra_handler = CassandraHandler(node, cassandra_data_dir, cassandra_bin_dir, keyspaces,  snapshot_type)
-        snapshot_metadata = SnapshotMetadata(cassandra_handler, repository_handler)
+        journal = CheckpointJournal(journal_path)
+        resumed_snapshot = journal.unfinished_snapshot(node, snapshot_type) if resume else None
+        if resumed_snapshot is not None and snapshot_id not in (None, resumed_snapshot["snapshot_date"]):
+            logging.warning("Unfinished snapshot {remote_path} isn't part of snapshot {snapshot_id}".format(
+                remote_path=resumed_snapshot["remote_base_path"], snapshot_id=snapshot_id))
+            resumed_snapshot = None
+        if resumed_snapshot is not None:
+            logging.info("Resuming snapshot {remote_path}".format(remote_path=resumed_snapshot["remote_base_path"]))
+        else:
+            if resume:
+                logging.warning("No unfinished snapshot to resume, starting a new snapshot")
+            for remote_path, upload_id in journal.abandon_unfinished_snapshots(node, snapshot_type):
+                repository_handler.abort_multipart_upload(remote_path, upload_id)
+            resumed_snapshot = dict()
+        # An interrupted snapshot whose files were removed early can't be resumed, it isn't journaled
+        upload_journal = journal if not early_cleanup else None
 
-        cassandra_backup_to_s3(snapshot_metadata, repository_handler, cassandra_handler, upload_workers, verbose)
-        cassandra_handler.clear_snapshot()
+        cassandra_handler = CassandraHandler(node, cassandra_data_dir, cassandra_bin_dir, keyspaces,  snapshot_type,
+                                             resumed_snapshot.get("cassandra_snapshot_id"), crawl_workers, metrics)
+        snapshot_metadata = SnapshotMetadata(cassandra_handler, repository_handler,
+                                             snapshot_date=resumed_snapshot.get("snapshot_date") or snapshot_id)
+        transfer_scheduler = TransferScheduler(repository_handler, upload_workers, verbose, compressor, read_limiter,
+                                               network_limiter, upload_journal, metrics, transfer_policy,
+                                               device_read_concurrency)
+
+        cassandra_backup_to_s3(snapshot_metadata, repository_handler, cassandra_handler, transfer_scheduler, dedup,
+                               upload_journal, S3Handler.convert_kb_to_byte(bundle_threshold),
+                               convert_mb_to_byte(bundle_size), metrics, early_cleanup,
+                               purge_backups)
+        with metrics.phase("clear_snapshot"):
+            cassandra_handler.clear_snapshot()
+        succeeded = True
+        try:
+            SnapshotCatalog(catalog_path).record_snapshot(
+                repository_handler.bucket, os.path.join(snapshot_metadata.snapshot_date, node, snapshot_type),
+                json.loads(snapshot_metadata.json()))
+        except Exception as e:
+            logging.warning("Failed to record snapshot in the local catalog - {error}".format(error=e))
         if slack_alert is True:
             slack_client.send_notification("Successfully snapshot", node=node, status="success")
     except Exception as e:
         print >> sys.stderr, e
         if slack_alert is True:
             slack_client.send_notification("Error snapshot", node=node, status="failure")
+    finally:
+        # Released whichever step failed, the compression processes and the monitor thread would outlive the command
+        if compressor is not None:
+            compressor.shutdown()
+        if disk_pressure_monitor is not None:
+            disk_pressure_monitor.stop()
+        metrics_reporter.stop()
+        if metrics_file is not None:
+            try:
+                metrics.write_report(metrics_file, metrics_format, {"node": node, "snapshot_type": snapshot_type},
+                                     succeeded)
+            except Exception as e:
+                logging.warning("Failed to write metrics report - {error}".format(error=e))
+
+
+@click.command(name='cluster-snapshot')
+@click.option('--log-level', default="info")
+@click.option('--ssl-no-verify', is_flag=True)
+@click.option('--nodes', required=True)
+@click.option('--bucket', default=None)
+@click.option('--repository-path', default=None)
+@click.option('--aws-access-key', default=AWS_ACCESS_KEY)
+@click.option('--aws-secret-key', default=AWS_SECRET_KEY)
+@click.option('--s3-endpoint-url', default=None)
+@click.option('--snapshot-type', type=click.Choice(['full', 'incremental']), default='full')
+@click.option('--snapshot-id', default=None)
+@click.option('--agent-command', default="apollo snapshot")
+@click.option('--parallelism', default=4, type=int)
+@click.option('--rack-parallelism', default=None, type=int)
+@click.option('--agent-log-dir', default=os.path.expanduser(CLUSTER_LOG_DEFAULT_PATH))
+def cluster_snapshot(log_level, ssl_no_verify, nodes, bucket, repository_path, aws_access_key, aws_secret_key,
+                     s3_endpoint_url, snapshot_type, snapshot_id, agent_command, parallelism, rack_parallelism,
+                     agent_log_dir):
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()),
+                        format='[%(levelname)s] [%(asctime)s] %(message)s')
+
+    try:
+        if snapshot_id is not None:
+            parse_snapshot_time(snapshot_id)
+        cluster_nodes = parse_cluster_nodes(nodes)
+        if len(set(cluster_node.node for cluster_node in cluster_nodes)) != len(cluster_nodes):
+            raise click.UsageError("--nodes lists a node more than once")
+        repository_handler = create_repository(bucket, repository_path, aws_access_key, aws_secret_key, ssl_no_verify,
+                                               s3_endpoint_url)
+        # Agents store their snapshots in the coordinator's repository, credentials are left to their environment
+        agent_options = ['--bucket', bucket] if bucket is not None else ['--repository-path',
+                                                                         os.path.abspath(repository_path)]
+        if s3_endpoint_url is not None:
+            agent_options += ['--s3-endpoint-url', s3_endpoint_url]
+        if ssl_no_verify:
+            agent_options.append('--ssl-no-verify')
+        coordinator = ClusterCoordinator(repository_handler, agent_command, agent_options, parallelism,
+                                         rack_parallelism, agent_log_dir)
+        manifest = coordinator.snapshot(cluster_nodes, snapshot_id or generate_snapshot_id(), snapshot_type)
+        click.echo("Snapshot {snapshot_id} - {status}, {files} files, {size} in {duration:.0f}s, {throughput}/s".format(
+            snapshot_id=manifest["snapshot_id"], status=manifest["status"], files=manifest["files"],
+            size=format_size(manifest["size"]), duration=manifest["duration"],
+            throughput=format_size(manifest["throughput"])))
+        click.echo("{:<24} {:<12} {:<8} {:>8} {:>12} {:>10} {:>12}".format(
+            "NODE", "RACK", "STATUS", "FILES", "SIZE", "DURATION", "THROUGHPUT"))
+        for node_result in manifest["nodes"]:
+            click.echo("{:<24} {:<12} {:<8} {:>8} {:>12} {:>9.0f}s {:>10}/s".format(
+                node_result["node"], node_result["rack"] or '-', node_result["status"], node_result["files"],
+                format_size(node_result["size"]), node_result["duration"], format_size(node_result["throughput"])))
+        if manifest["status"] != SUCCESS_FIELD_METADATA:
+            sys.exit(1)
+    except Exception as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+
+
+@click.command()
+@click.option('--log-level', default="info")
+@click.option('--ssl-no-verify', is_flag=True)
+@click.option('--node', default=HOSTNAME)
+@click.option('--bucket', default=None)
+@click.option('--repository-path', default=None)
+@click.option('--aws-access-key', default=AWS_ACCESS_KEY)
+@click.option('--aws-secret-key', default=AWS_SECRET_KEY)
+@click.option('--s3-endpoint-url', default=None)
+@click.option('--snapshot-date', default=None)
+@click.option('--target-time', default=None)
+@click.option('--snapshot-type', type=click.Choice(['full', 'incremental']), default='full')
+@click.option('--cassandra-data-dir', default='/var/lib/cassandra/data')
+@click.option('--keyspaces', default=None, type=str)
+@click.option('--tables', default=None, type=str)
+@click.option('--download-chunksize', default=8*1024, type=int)
+@click.option('--download-workers', default=8, type=int)
+@click.option('--dry-run', is_flag=True)
+def restore(log_level, ssl_no_verify, node, bucket, repository_path, aws_access_key, aws_secret_key, s3_endpoint_url,
+            snapshot_date, target_time, snapshot_type, cassandra_data_dir, keyspaces, tables, download_chunksize,
+            download_workers, dry_run):
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()),
+                        format='[%(levelname)s] [%(asctime)s] %(message)s')
+
+    try:
+        if (snapshot_date is None) == (target_time is None):
+            raise click.UsageError("Exactly one of --snapshot-date and --target-time is required")
+        if dry_run and target_time is None:
+            raise click.UsageError("--dry-run plans point in time restores only, it requires --target-time")
+        repository_handler = create_repository(bucket, repository_path, aws_access_key, aws_secret_key, ssl_no_verify,
+                                               s3_endpoint_url, transfer_workers=download_workers)
+        if snapshot_date is not None:
+            cassandra_restore_from_s3(repository_handler, node, snapshot_date, snapshot_type, cassandra_data_dir,
+                                      keyspaces, tables, download_workers,
+                                      S3Handler.convert_kb_to_byte(download_chunksize))
+            return
+
+        restore_plan = RestorePlanner(repository_handler, node).plan(parse_snapshot_time(target_time),
+                                                                     cassandra_data_dir, keyspaces, tables)
+        click.echo("Restore of {node} as of {time} - {files} files, {size}, {skipped} files ({skipped_size}) no "
+                   "longer live are skipped".format(node=node, time=restore_plan.target_time,
+                                                    files=restore_plan.files, size=format_size(restore_plan.size),
+                                                    skipped=restore_plan.skipped_files,
+                                                    skipped_size=format_size(restore_plan.skipped_size)))
+        click.echo("{:<48} {:>8} {:>12}".format("SNAPSHOT", "FILES", "SIZE"))
+        for chain_snapshot in restore_plan.snapshots:
+            files, size = restore_plan.snapshot_files(chain_snapshot)
+            click.echo("{:<48} {:>8} {:>12}".format(chain_snapshot.remote_base_path, files, format_size(size)))
+        if dry_run:
+            return
+        for compression, sstables_map in restore_plan.downloads.items():
+            parallel_download(download_workers, repository_handler, sstables_map,
+                              S3Handler.convert_kb_to_byte(download_chunksize), compression)
+        logging.info("Finished restore successfully")
+    except Exception as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+
+
+@click.command()
+@click.option('--log-level', default="info")
+@click.option('--ssl-no-verify', is_flag=True)
+@click.option('--node', default=HOSTNAME)
+@click.option('--bucket', default=None)
+@click.option('--repository-path', default=None)
+@click.option('--aws-access-key', default=AWS_ACCESS_KEY)
+@click.option('--aws-secret-key', default=AWS_SECRET_KEY)
+@click.option('--s3-endpoint-url', default=None)
+@click.option('--snapshot-date', required=True)
+@click.option('--snapshot-type', type=click.Choice(['full', 'incremental']), default='full')
+@click.option('--verify-workers', default=32, type=int)
+def verify(log_level, ssl_no_verify, node, bucket, repository_path, aws_access_key, aws_secret_key, s3_endpoint_url,
+           snapshot_date, snapshot_type, verify_workers):
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()),
+                        format='[%(levelname)s] [%(asctime)s] %(message)s')
+
+    try:
+        repository_handler = create_repository(bucket, repository_path, aws_access_key, aws_secret_key, ssl_no_verify,
+                                               s3_endpoint_url, transfer_workers=verify_workers)
+        cassandra_verify_s3(repository_handler, node, snapshot_date, snapshot_type, verify_workers)
+    except Exception as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+
+
+@click.command()
+@click.option('--log-level', default="info")
+@click.option('--ssl-no-verify', is_flag=True)
+@click.option('--node', default=HOSTNAME)
+@click.option('--bucket', default=None)
+@click.option('--repository-path', default=None)
+@click.option('--aws-access-key', default=AWS_ACCESS_KEY)
+@click.option('--aws-secret-key', default=AWS_SECRET_KEY)
+@click.option('--s3-endpoint-url', default=None)
+@click.option('--snapshot-date', default=None)
+@click.option('--s3-storage-class', type=click.Choice(['STANDARD', 'STANDARD_IA', 'REDUCED_REDUNDANCY']),
+              default='STANDARD')
+@click.option('--copy-workers', default=16, type=int)
+@click.option('--catalog-path', default=os.path.expanduser(CATALOG_DEFAULT_PATH))
+def consolidate(log_level, ssl_no_verify, node, bucket, repository_path, aws_access_key, aws_secret_key,
+                s3_endpoint_url, snapshot_date, s3_storage_class, copy_workers, catalog_path):
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()),
+                        format='[%(levelname)s] [%(asctime)s] %(message)s')
+
+    try:
+        snapshot_date = snapshot_date or generate_snapshot_timestamp()
+        repository_handler = create_repository(bucket, repository_path, aws_access_key, aws_secret_key, ssl_no_verify,
+                                               s3_endpoint_url, transfer_workers=copy_workers,
+                                               storage_class=s3_storage_class)
+        metadata = SnapshotConsolidator(repository_handler, node, copy_workers).consolidate(snapshot_date)
+        try:
+            SnapshotCatalog(catalog_path).record_snapshot(repository_handler.bucket,
+                                                          os.path.join(snapshot_date, node, "full"),
+                                                          json.loads(metadata.json()))
+        except Exception as e:
+            logging.warning("Failed to record snapshot in the local catalog - {error}".format(error=e))
+    except Exception as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+
+
+@click.command()
+@click.option('--log-level', default="info")
+@click.option('--ssl-no-verify', is_flag=True)
+@click.option('--node', default=None)
+@click.option('--bucket', default=None)
+@click.option('--repository-path', default=None)
+@click.option('--aws-access-key', default=AWS_ACCESS_KEY)
+@click.option('--aws-secret-key', default=AWS_SECRET_KEY)
+@click.option('--s3-endpoint-url', default=None)
+@click.option('--keep-daily', default=7, type=int)
+@click.option('--keep-weekly', default=4, type=int)
+@click.option('--gc-dedup', is_flag=True)
+@click.option('--delete-workers', default=16, type=int)
+@click.option('--dry-run', is_flag=True)
+@click.option('--catalog-path', default=os.path.expanduser(CATALOG_DEFAULT_PATH))
+def prune(log_level, ssl_no_verify, node, bucket, repository_path, aws_access_key, aws_secret_key, s3_endpoint_url,
+          keep_daily, keep_weekly, gc_dedup, delete_workers, dry_run, catalog_path):
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()),
+                        format='[%(levelname)s] [%(asctime)s] %(message)s')
+
+    try:
+        if keep_daily < 1 and keep_weekly < 1:
+            raise click.UsageError("--keep-daily or --keep-weekly must keep at least one snapshot")
+        repository_handler = create_repository(bucket, repository_path, aws_access_key, aws_secret_key, ssl_no_verify,
+                                               s3_endpoint_url, transfer_workers=delete_workers)
+        pruner = SnapshotPruner(repository_handler, delete_workers)
+        prune_plan = pruner.plan(keep_daily, keep_weekly, node, gc_dedup)
+        click.echo("{:<48} {:<12} {:<8} {:<10}".format("SNAPSHOT", "STATUS", "ACTION", "REASON"))
+        for action, planned_snapshots in (("keep", prune_plan.kept), ("prune", prune_plan.pruned)):
+            for planned_snapshot in planned_snapshots:
+                click.echo("{:<48} {:<12} {:<8} {:<10}".format(planned_snapshot.remote_base_path,
+                                                               planned_snapshot.status or '-', action,
+                                                               planned_snapshot.reason))
+        dedup_objects = sum(len(objects) for objects in prune_plan.dedup_objects.values())
+        click.echo("Pruning {snapshots} snapshots - {objects} objects and {dedup_objects} dedup objects, "
+                   "{size}".format(snapshots=len(prune_plan.pruned), objects=len(prune_plan.objects),
+                                   dedup_objects=dedup_objects, size=format_size(prune_plan.size)))
+        if dry_run:
+            return
+        pruner.prune(prune_plan)
+        try:
+            catalog = SnapshotCatalog(catalog_path)
+            for planned_snapshot in prune_plan.pruned:
+                catalog.remove_snapshot(repository_handler.bucket, planned_snapshot.remote_base_path)
+        except Exception as e:
+            logging.warning("Failed to remove pruned snapshots from the local catalog - {error}".format(error=e))
+        logging.info("Finished prune successfully")
+    except Exception as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+
+
+@click.command(name='list')
+@click.option('--log-level', default="info")
+@click.option('--ssl-no-verify', is_flag=True)
+@click.option('--node', default=None)
+@click.option('--bucket', default=None)
+@click.option('--repository-path', default=None)
+@click.option('--aws-access-key', default=AWS_ACCESS_KEY)
+@click.option('--aws-secret-key', default=AWS_SECRET_KEY)
+@click.option('--s3-endpoint-url', default=None)
+@click.option('--refresh', is_flag=True)
+@click.option('--catalog-path', default=os.path.expanduser(CATALOG_DEFAULT_PATH))
+def list_snapshots(log_level, ssl_no_verify, node, bucket, repository_path, aws_access_key, aws_secret_key,
+                   s3_endpoint_url, refresh, catalog_path):
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()),
+                        format='[%(levelname)s] [%(asctime)s] %(message)s')
+
+    try:
+        catalog = SnapshotCatalog(catalog_path)
+        name = repository_name(bucket, repository_path)
+        if refresh:
+            repository_handler = create_repository(bucket, repository_path, aws_access_key, aws_secret_key,
+                                                   ssl_no_verify, s3_endpoint_url)
+            refresh_snapshot_catalog(repository_handler, catalog, node)
+
+        click.echo("{:<26} {:<24} {:<12} {:<12} {:<6} {:>8} {:>12}".format(
+            "DATE", "NODE", "TYPE", "STATUS", "CODEC", "FILES", "SIZE"))
+        for snapshot_entry in catalog.snapshots(name, node):
+            click.echo("{:<26} {:<24} {:<12} {:<12} {:<6} {:>8} {:>12}".format(
+                snapshot_entry["snapshot_date"], snapshot_entry["node"], snapshot_entry["snapshot_type"],
+                snapshot_entry["status"], snapshot_entry["compression"] or '-', snapshot_entry["files"],
+                format_size(snapshot_entry["size"])))
+    except Exception as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+
+
+@click.command()
+@click.option('--log-level', default="info")
+@click.option('--ssl-no-verify', is_flag=True)
+@click.option('--node', default=HOSTNAME)
+@click.option('--bucket', default=None)
+@click.option('--repository-path', default=None)
+@click.option('--aws-access-key', default=AWS_ACCESS_KEY)
+@click.option('--aws-secret-key', default=AWS_SECRET_KEY)
+@click.option('--s3-endpoint-url', default=None)
+@click.option('--snapshot-date', required=True)
+@click.option('--snapshot-type', type=click.Choice(['full', 'incremental']), default='full')
+@click.option('--catalog-path', default=os.path.expanduser(CATALOG_DEFAULT_PATH))
+def describe(log_level, ssl_no_verify, node, bucket, repository_path, aws_access_key, aws_secret_key, s3_endpoint_url,
+             snapshot_date, snapshot_type, catalog_path):
+    logging.basicConfig(level=logging.getLevelName(log_level.upper()),
+                        format='[%(levelname)s] [%(asctime)s] %(message)s')
+
+    try:
+        catalog = SnapshotCatalog(catalog_path)
+        snapshot_remote_base_path = os.path.join(snapshot_date, node, snapshot_type)
+        name = repository_name(bucket, repository_path)
+        if catalog.snapshot_status(name, snapshot_remote_base_path) is None:
+            repository_handler = create_repository(bucket, repository_path, aws_access_key, aws_secret_key,
+                                                   ssl_no_verify, s3_endpoint_url)
+            metadata = repository_handler.load_metadata(os.path.join(snapshot_remote_base_path,
+                                                                     SNAPSHOT_METADATA_FILE))
+            if metadata is None:
+                raise click.ClickException("Snapshot not found - {remote_path}".format(
+                    remote_path=snapshot_remote_base_path))
+            catalog.record_snapshot(name, snapshot_remote_base_path, json.loads(metadata))
+
+        snapshot_entry = [entry for entry in catalog.snapshots(name, node)
+                          if entry["snapshot_date"] == snapshot_date and entry["snapshot_type"] == snapshot_type][0]
+        click.echo("Snapshot {remote_path} - status {status}, compression {compression}, {files} files, "
+                   "{size}".format(remote_path=snapshot_remote_base_path, status=snapshot_entry["status"],
+                                   compression=snapshot_entry["compression"] or '-', files=snapshot_entry["files"],
+                                   size=format_size(snapshot_entry["size"])))
+        click.echo("{:<32} {:<48} {:>8} {:>12}".format("KEYSPACE", "TABLE", "FILES", "SIZE"))
+        for table_entry in catalog.tables(name, snapshot_remote_base_path):
+            click.echo("{:<32} {:<48} {:>8} {:>12}".format(table_entry["keyspace"], table_entry["table"],
+                                                            table_entry["files"], format_size(table_entry["size"])))
+    except Exception as e:
+        print >> sys.stderr, e
+        sys.exit(1)
 
 
 cli.add_command(snapshot)
+cli.add_command(cluster_snapshot)
+cli.add_command(restore)
+cli.add_command(verify)
+cli.add_command(consolidate)
+cli.add_command(prune)
+cli.add_command(list_snapshots)
+cli.add_command(describe)
 
 if __name__ == "__main__":
     cli()
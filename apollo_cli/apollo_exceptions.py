@@ -20,3 +20,27 @@ class AWSCredentialsError(Exception):
 
 class NotificationError(Exception):
     pass
+
+
+class S3DownloadError(Exception):
+    pass
+
+
+class CompressionError(Exception):
+    pass
+
+
+class SnapshotVerificationError(Exception):
+    pass
+
+
+class SnapshotChainError(Exception):
+    pass
+
+
+class SnapshotConsolidationError(Exception):
+    pass
+
+
+class S3DeleteError(Exception):
+    pass
@@ -1,25 +1,61 @@
 import os
+import time
 import logging
+import threading
+import collections
+import concurrent.futures
 from subprocess import (Popen, PIPE)
-from constants import (NODETOOL_COMMAND, NODETOOL_FLUSH_ARG, NODETOOL_SNAPSHOT_ARG, NODETOOL_CLEAR_SNAPSHOT_ARG)
+from constants import (NODETOOL_COMMAND, NODETOOL_FLUSH_ARG, NODETOOL_SNAPSHOT_ARG, NODETOOL_CLEAR_SNAPSHOT_ARG,
+                       CRAWL_QUEUE_SIZE, CRAWL_QUEUE_TIMEOUT)
 from apollo_exceptions import (CassandraFlushError, CassandraSnapshotError, CassandraOSError)
 from cassandra_snapshot_exclude import (keyspaces_exclude, tables_exclude)
+from metrics import SnapshotMetrics
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 logger = logging.getLogger(__name__)
 
+SSTable = collections.namedtuple('SSTable', ['keyspace', 'table', 'path', 'size', 'mtime'])
+
 
 class CassandraHandler(object):
+    """
+    Flushes, snapshots and crawls the data directory of a node keyspace by keyspace.
 
-    def __init__(self, node, data_directory, bin_directory, keyspaces, snapshot_type="full"):
+    A keyspace is flushed and then snapshotted under a tag shared by the whole run only when the crawl reaches it,
+    so its SSTables include its memtables and the uploads of the previous keyspaces carry on while nodetool runs.
+    A resumed snapshot (`snapshot_id`) is crawled as it is on disk, only keyspaces the interrupted run didn't reach
+    are snapshotted. `data_directory` may list several comma separated data directories (JBOD), the directories of
+    a table are walked concurrently. Incremental snapshots also record the files live in every table directory once
+    its backups/ directory is walked, so a restore can tell which backed up SSTables were compacted away.
+    """
+
+    def __init__(self, node, data_directory, bin_directory, keyspaces, snapshot_type="full", snapshot_id=None,
+                 crawl_workers=1, metrics=None):
         self._node = node
         self._snapshot_type = snapshot_type
-        self._data_directory = data_directory
+        self._data_directories = data_directory.split(',')
         self.bin_directory = bin_directory
         self.keyspaces = keyspaces.split(',') if keyspaces != None else None
         self._nodetool = os.path.join(self.bin_directory, NODETOOL_COMMAND)
-        self._snapshot_id = self.export_snapshot() if self._snapshot_type == "full" else None
-        self._sstables_to_snapshot = self._return_sstables_list()
-        self._flushdb()
+        self._crawl_workers = crawl_workers
+        self._metrics = metrics if metrics is not None else SnapshotMetrics()
+        self._resumed = snapshot_id is not None
+        if self._snapshot_type == "full":
+            self._snapshot_id = snapshot_id if self._resumed else self.generate_snapshot_id()
+        else:
+            self._snapshot_id = None
+        self._tables_to_snapshot = self._list_tables()
+        self._live_sstables = dict()
+        self._live_sstables_lock = threading.Lock()
 
     @property
     def node(self):
@@ -30,47 +66,65 @@ class CassandraHandler(object):
         return self._snapshot_type
 
     @property
-    def sstables_to_snapshot(self):
-        return self._sstables_to_snapshot
+    def tables_to_snapshot(self):
+        return self._tables_to_snapshot
 
     @property
-    def data_directory(self):
-        return self._data_directory
+    def data_directories(self):
+        return self._data_directories
 
     @property
     def snapshot_id(self):
         return self._snapshot_id
 
-    def _flushdb(self):
+    @property
+    def live_sstables(self):
+        """
+        Names of the files in every crawled table directory by keyspace and table, recorded by incremental snapshots.
+        """
+        with self._live_sstables_lock:
+            return dict((keyspace, dict((table, sorted(names)) for table, names in tables.items()))
+                        for keyspace, tables in self._live_sstables.items())
+
+    def _flushdb(self, keyspace):
         try:
-            logger.info("Flushing Cassandra memtables")
-            process = Popen([self._nodetool, NODETOOL_FLUSH_ARG], stdout=PIPE)
+            logger.info("Flushing Cassandra memtables of {keyspace}".format(keyspace=keyspace))
+            process = Popen([self._nodetool, NODETOOL_FLUSH_ARG, keyspace], stdout=PIPE)
             process.communicate()
             exit_code = process.wait()
-            logger.info("Cassandra memtables are flushed to disk")
+            logger.info("Cassandra memtables of {keyspace} are flushed to disk".format(keyspace=keyspace))
         except Exception as e:
             raise CassandraFlushError(e)
 
         if exit_code == 0:
             return self
         else:
-            raise CassandraFlushError("Failed to flush DB")
+            raise CassandraFlushError("Failed to flush {keyspace}".format(keyspace=keyspace))
 
-    def export_snapshot(self):
+    def export_snapshot(self, keyspace):
         try:
-            logger.info("Performing snapshot to disk")
-            process = Popen([self._nodetool, NODETOOL_SNAPSHOT_ARG], stdout=PIPE)
-            snapshot_id = self.extract_snapshot_id(process.stdout.readlines())
+            logger.info("Performing snapshot of {keyspace} to disk".format(keyspace=keyspace))
+            process = Popen([self._nodetool, NODETOOL_SNAPSHOT_ARG, '-t', str(self._snapshot_id), keyspace],
+                            stdout=PIPE)
             process.communicate()
             exit_code = process.wait()
-            logger.info("Finished snapshot request - snapshot id: {snapshot_id}".format(snapshot_id=snapshot_id))
+            logger.info("Finished snapshot request of {keyspace} - snapshot id: {snapshot_id}".format(
+                keyspace=keyspace, snapshot_id=self._snapshot_id))
         except Exception as e:
             raise CassandraSnapshotError(e)
 
         if exit_code == 0:
-            return snapshot_id
+            return self._snapshot_id
         else:
-            raise CassandraSnapshotError("Failed to export snapshot")
+            raise CassandraSnapshotError("Failed to export snapshot of {keyspace}".format(keyspace=keyspace))
+
+    def _prepare_keyspace(self, keyspace):
+        # Flushed first, so the snapshot holds everything written to the keyspace until now
+        with self._metrics.phase("flush"):
+            self._flushdb(keyspace)
+        if self._snapshot_type == "full" and not (self._resumed and self._snapshot_exists([keyspace])):
+            with self._metrics.phase("snapshot"):
+                self.export_snapshot(keyspace)
 
     def clear_snapshot(self):
         try:
@@ -86,53 +140,155 @@ class CassandraHandler(object):
         else:
             raise CassandraSnapshotError("Failed to flush DB")
 
-    def _return_sstables_list(self):
-        sstables_to_snapshot = self._sstables_fs_tree_crawler()
-        return sstables_to_snapshot
-
-    def _sstables_fs_tree_crawler(self):
-        backup_dir_suffix = self._return_snapshot_suffix()
-        sstables_fs_tree = dict()
-
-        logger.info("Generating Cassandra data directory structure from path - {data_dir_path}".format(
-            data_dir_path=self._data_directory))
+    def _list_tables(self):
         if self.keyspaces is not None:
             keyspaces_include = self.keyspaces
         else:
             keyspaces_include = None
 
+        tables_to_snapshot = dict()
         try:
-            keyspaces = os.listdir(self.data_directory)
-
-            for keyspace in keyspaces:
-                if keyspace in keyspaces_exclude:
-                    continue
-                elif keyspaces_include is not None and keyspace not in keyspaces_include:
-                    continue
-                sstables_fs_tree[keyspace] = dict()
-                keyspace_path = os.path.join(self.data_directory, keyspace)
-                tables = os.listdir(keyspace_path)
-
-                for table in tables:
-                    if keyspace in tables_exclude and table in tables_exclude[keyspace]:
+            for data_directory in self._data_directories:
+                for keyspace_entry in scandir(data_directory):
+                    keyspace = keyspace_entry.name
+                    if keyspace in keyspaces_exclude or not keyspace_entry.is_dir():
                         continue
-                    sstables_fs_tree[keyspace][table] = list()
-                    table_path = os.path.join(keyspace_path, table)
-                    sstables_snapshot_path = os.path.join(table_path, backup_dir_suffix)
-                    try:
-                        sstables = os.listdir(sstables_snapshot_path)
-                    except:
+                    elif keyspaces_include is not None and keyspace not in keyspaces_include:
                         continue
+                    tables_to_snapshot.setdefault(keyspace, list())
 
-                    for sstable in sstables:
-                        sstable_path = os.path.join(sstables_snapshot_path, sstable)
-                        sstables_fs_tree[keyspace][table].append(sstable_path)
-
+                    for table_entry in scandir(keyspace_entry.path):
+                        if keyspace in tables_exclude and table_entry.name in tables_exclude[keyspace]:
+                            continue
+                        elif not table_entry.is_dir() or table_entry.name in tables_to_snapshot[keyspace]:
+                            continue
+                        tables_to_snapshot[keyspace].append(table_entry.name)
         except OSError as e:
             raise CassandraOSError(e)
+        return tables_to_snapshot
+
+    def _snapshot_exists(self, keyspaces):
+        backup_dir_suffix = self._return_snapshot_suffix()
+        return any(os.path.isdir(os.path.join(data_directory, keyspace, table, backup_dir_suffix))
+                   for data_directory in self._data_directories
+                   for keyspace in keyspaces for table in self._tables_to_snapshot[keyspace])
 
-        logger.info("Finished generating data directory structure")
-        return sstables_fs_tree
+    def iter_sstables(self):
+        """
+        Streams the SSTables to snapshot as (keyspace, table, [SSTable]) batches, one batch per table, while the data
+        directory is being walked. Every keyspace is flushed and snapshotted right before it is walked. With several
+        crawl workers, keyspaces are walked concurrently.
+        """
+        logger.info("Crawling Cassandra data directory - {data_dir_path}".format(
+            data_dir_path=', '.join(self._data_directories)))
+        keyspaces = sorted(self._tables_to_snapshot)
+        if self._crawl_workers <= 1:
+            for keyspace in keyspaces:
+                for table_batch in self._crawl_keyspace(keyspace):
+                    yield table_batch
+        else:
+            for table_batch in self._parallel_crawl(keyspaces):
+                yield table_batch
+        logger.info("Finished crawling Cassandra data directory")
+
+    def _parallel_crawl(self, keyspaces):
+        table_batches = queue.Queue(maxsize=CRAWL_QUEUE_SIZE)
+        # Set once the consumer stops, whether the crawl failed or the upload did, so no further keyspace is flushed
+        # and snapshotted and no crawl worker stays blocked on a full queue
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    table_batches.put(item, timeout=CRAWL_QUEUE_TIMEOUT)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def crawl(keyspace):
+            if stopped.is_set():
+                return
+            try:
+                for table_batch in self._crawl_keyspace(keyspace):
+                    if not put(table_batch):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(None)
+
+        executor = concurrent.futures.ThreadPoolExecutor(self._crawl_workers)
+        try:
+            for keyspace in keyspaces:
+                executor.submit(crawl, keyspace)
+
+            remaining_keyspaces = len(keyspaces)
+            while remaining_keyspaces > 0:
+                table_batch = table_batches.get()
+                if table_batch is None:
+                    remaining_keyspaces -= 1
+                elif isinstance(table_batch, Exception):
+                    # Raised as it is, like the crawl of a single worker does
+                    raise table_batch
+                else:
+                    yield table_batch
+        finally:
+            stopped.set()
+            while True:
+                try:
+                    table_batches.get_nowait()
+                except queue.Empty:
+                    break
+            executor.shutdown()
+
+    def _crawl_keyspace(self, keyspace):
+        self._prepare_keyspace(keyspace)
+        if len(self._data_directories) == 1:
+            for table in self._tables_to_snapshot[keyspace]:
+                sstables = self._crawl_table(self._data_directories[0], keyspace, table)
+                if sstables is not None:
+                    yield keyspace, table, sstables
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(len(self._data_directories))
+        try:
+            for table in self._tables_to_snapshot[keyspace]:
+                directories_sstables = [sstables for sstables in executor.map(
+                    lambda data_directory: self._crawl_table(data_directory, keyspace, table),
+                    self._data_directories) if sstables is not None]
+                if directories_sstables:
+                    yield keyspace, table, [sstable for sstables in directories_sstables for sstable in sstables]
+        finally:
+            executor.shutdown(wait=False)
+
+    def _crawl_table(self, data_directory, keyspace, table):
+        sstables_snapshot_path = os.path.join(data_directory, keyspace, table, self._return_snapshot_suffix())
+        try:
+            sstable_entries = scandir(sstables_snapshot_path)
+        except OSError:
+            return None
+
+        sstables = list()
+        for sstable_entry in sstable_entries:
+            if not sstable_entry.is_file():
+                continue
+            sstable_stat = sstable_entry.stat()
+            sstables.append(SSTable(keyspace, table, sstable_entry.path, sstable_stat.st_size,
+                                    sstable_stat.st_mtime))
+        if self._snapshot_type == "incremental":
+            # Listed after backups/, an SSTable flushed in between is missing here and the table is restored whole
+            self._record_live_sstables(data_directory, keyspace, table)
+        return sstables
+
+    def _record_live_sstables(self, data_directory, keyspace, table):
+        try:
+            live_names = [entry.name for entry in scandir(os.path.join(data_directory, keyspace, table))
+                          if entry.is_file()]
+        except OSError:
+            return
+        with self._live_sstables_lock:
+            self._live_sstables.setdefault(keyspace, dict()).setdefault(table, set()).update(live_names)
 
     def _return_snapshot_suffix(self):
         if self._snapshot_type == "full":
@@ -145,5 +301,6 @@ class CassandraHandler(object):
         return backup_dir_suffix
 
     @staticmethod
-    def extract_snapshot_id(snapshot_message):
-        return snapshot_message[1].split(' ')[2].rstrip()
+    def generate_snapshot_id():
+        # Same form as the tags nodetool picks when none is given
+        return str(int(time.time() * 1000))
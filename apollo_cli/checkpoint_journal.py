@@ -0,0 +1,137 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from constants import (INITIAL_FIELD_METADATA, SUCCESS_FIELD_METADATA, ABANDONED_FIELD_METADATA)
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    remote_base_path TEXT PRIMARY KEY,
+    node TEXT NOT NULL,
+    snapshot_type TEXT NOT NULL,
+    snapshot_date TEXT NOT NULL,
+    cassandra_snapshot_id TEXT,
+    status TEXT NOT NULL,
+    started_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    remote_base_path TEXT NOT NULL,
+    remote_path TEXT NOT NULL,
+    local_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    object_size INTEGER,
+    etag TEXT,
+    PRIMARY KEY (remote_base_path, remote_path)
+);
+CREATE TABLE IF NOT EXISTS multipart_uploads (
+    remote_base_path TEXT NOT NULL,
+    remote_path TEXT NOT NULL,
+    upload_id TEXT NOT NULL,
+    part_size INTEGER NOT NULL,
+    PRIMARY KEY (remote_base_path, remote_path)
+);
+CREATE TABLE IF NOT EXISTS parts (
+    upload_id TEXT NOT NULL,
+    part_number INTEGER NOT NULL,
+    etag TEXT NOT NULL,
+    PRIMARY KEY (upload_id, part_number)
+);
+"""
+
+
+class CheckpointJournal(object):
+    """
+    Local SQLite journal of a snapshot run: completed uploads, in-flight multipart upload ids and their parts.
+
+    Every record is committed as soon as the repository acknowledges it, so a run which dies partway can be resumed
+    with the same snapshot date and Cassandra snapshot id, skipping finished files and finishing multipart uploads.
+    """
+
+    def __init__(self, journal_path):
+        journal_directory = os.path.dirname(journal_path)
+        if journal_directory and not os.path.isdir(journal_directory):
+            os.makedirs(journal_directory)
+        self._connection = sqlite3.connect(journal_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(JOURNAL_SCHEMA)
+        upload_columns = [column[1] for column in self._connection.execute("PRAGMA table_info(uploads)")]
+        if "etag" not in upload_columns:
+            self._connection.execute("ALTER TABLE uploads ADD COLUMN object_size INTEGER")
+            self._connection.execute("ALTER TABLE uploads ADD COLUMN etag TEXT")
+        self._lock = threading.Lock()
+        self._remote_base_path = None
+
+    def _execute(self, statement, parameters=()):
+        with self._lock:
+            with self._connection:
+                return self._connection.execute(statement, parameters).fetchall()
+
+    def unfinished_snapshot(self, node, snapshot_type):
+        rows = self._execute("SELECT remote_base_path, snapshot_date, cassandra_snapshot_id FROM snapshots "
+                             "WHERE node = ? AND snapshot_type = ? AND status = ? ORDER BY started_at DESC LIMIT 1",
+                             (node, snapshot_type, INITIAL_FIELD_METADATA))
+        if not rows:
+            return None
+        remote_base_path, snapshot_date, cassandra_snapshot_id = rows[0]
+        return {"remote_base_path": remote_base_path, "snapshot_date": snapshot_date,
+                "cassandra_snapshot_id": cassandra_snapshot_id}
+
+    def abandon_unfinished_snapshots(self, node, snapshot_type):
+        abandoned_uploads = self._execute(
+            "SELECT multipart_uploads.remote_path, multipart_uploads.upload_id FROM multipart_uploads "
+            "JOIN snapshots ON snapshots.remote_base_path = multipart_uploads.remote_base_path "
+            "WHERE snapshots.node = ? AND snapshots.snapshot_type = ? AND snapshots.status = ?",
+            (node, snapshot_type, INITIAL_FIELD_METADATA))
+        self._execute("UPDATE snapshots SET status = ? WHERE node = ? AND snapshot_type = ? AND status = ?",
+                      (ABANDONED_FIELD_METADATA, node, snapshot_type, INITIAL_FIELD_METADATA))
+        return abandoned_uploads
+
+    def begin(self, remote_base_path, node, snapshot_type, snapshot_date, cassandra_snapshot_id):
+        self._remote_base_path = remote_base_path
+        self._execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (remote_base_path, node, snapshot_type, snapshot_date, cassandra_snapshot_id,
+                       INITIAL_FIELD_METADATA, time.time()))
+
+    def finish(self):
+        self._execute("UPDATE snapshots SET status = ? WHERE remote_base_path = ?",
+                      (SUCCESS_FIELD_METADATA, self._remote_base_path))
+        self._execute("DELETE FROM parts WHERE upload_id IN "
+                      "(SELECT upload_id FROM multipart_uploads WHERE remote_base_path = ?)", (self._remote_base_path,))
+        self._execute("DELETE FROM multipart_uploads WHERE remote_base_path = ?", (self._remote_base_path,))
+        self._execute("DELETE FROM uploads WHERE remote_base_path = ?", (self._remote_base_path,))
+
+    def uploaded_object(self, remote_path, size):
+        rows = self._execute("SELECT object_size, etag FROM uploads "
+                             "WHERE remote_base_path = ? AND remote_path = ? AND size = ?",
+                             (self._remote_base_path, remote_path, size))
+        return rows[0] if rows else None
+
+    def record_upload(self, local_path, remote_path, size, object_size, etag):
+        self._execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                      (self._remote_base_path, remote_path, local_path, size, object_size, etag))
+        self.discard_multipart_upload(remote_path)
+
+    def discard_multipart_upload(self, remote_path):
+        self._execute("DELETE FROM parts WHERE upload_id IN (SELECT upload_id FROM multipart_uploads "
+                      "WHERE remote_base_path = ? AND remote_path = ?)", (self._remote_base_path, remote_path))
+        self._execute("DELETE FROM multipart_uploads WHERE remote_base_path = ? AND remote_path = ?",
+                      (self._remote_base_path, remote_path))
+
+    def multipart_upload(self, remote_path):
+        rows = self._execute("SELECT upload_id, part_size FROM multipart_uploads "
+                             "WHERE remote_base_path = ? AND remote_path = ?", (self._remote_base_path, remote_path))
+        if not rows:
+            return None, None, dict()
+        upload_id, part_size = rows[0]
+        part_etags = dict(self._execute("SELECT part_number, etag FROM parts WHERE upload_id = ?", (upload_id,)))
+        return upload_id, part_size, part_etags
+
+    def record_multipart_upload(self, remote_path, upload_id, part_size):
+        self._execute("INSERT OR REPLACE INTO multipart_uploads VALUES (?, ?, ?, ?)",
+                      (self._remote_base_path, remote_path, upload_id, part_size))
+
+    def record_part(self, upload_id, part_number, etag):
+        self._execute("INSERT OR REPLACE INTO parts VALUES (?, ?, ?)", (upload_id, part_number, etag))
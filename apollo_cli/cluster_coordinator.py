@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import shlex
+import logging
+import datetime
+import threading
+import subprocess
+import collections
+from constants import (SNAPSHOT_METADATA_FILE, SUCCESS_FIELD_METADATA, FAILED_FIELD_METADATA, CLUSTER_MANIFEST_FILE,
+                       SNAPSHOT_TIME_FORMAT)
+from utils import format_size
+
+logger = logging.getLogger(__name__)
+
+ClusterNode = collections.namedtuple('ClusterNode', ['node', 'rack'])
+
+
+def parse_cluster_nodes(nodes):
+    """
+    Parses a comma separated list of nodes, each optionally prefixed by its rack - "rack1:node1,rack2:node2".
+    """
+    cluster_nodes = list()
+    for node_entry in nodes.split(','):
+        rack, _, node = node_entry.strip().rpartition(':')
+        if node:
+            cluster_nodes.append(ClusterNode(node, rack or None))
+    return cluster_nodes
+
+
+class ClusterCoordinator(object):
+    """
+    Snapshots a cluster under one snapshot ID by running a snapshot agent per node.
+
+    Agents are started as `agent_command` processes - `apollo snapshot` on the node itself, or over ssh - with the
+    coordinator's repository options (`agent_options`), the node, snapshot ID and snapshot type appended, and their
+    output is written to a log file per node. At most
+    `parallelism` agents run at once and at most `rack_parallelism` of them per rack. Nodes are started alternating
+    between racks, so concurrent uploads are spread over the racks' uplinks.
+
+    Each node's result is read back from its snapshot metadata, since a snapshot agent exits successfully even when the
+    snapshot fails, and a cluster manifest with the result, size and throughput of every node is stored as
+    <snapshot id>/.cluster.
+    """
+
+    def __init__(self, repository, agent_command, agent_options=None, parallelism=1, rack_parallelism=None,
+                 log_directory=None):
+        self._repository = repository
+        self._agent_command = agent_command
+        self._agent_options = agent_options if agent_options is not None else list()
+        self._parallelism = parallelism
+        self._rack_parallelism = rack_parallelism
+        self._log_directory = log_directory
+
+    def snapshot(self, cluster_nodes, snapshot_id, snapshot_type):
+        started = time.time()
+        logger.info("Starting snapshot {snapshot_id} of {nodes} nodes".format(snapshot_id=snapshot_id,
+                                                                             nodes=len(cluster_nodes)))
+        node_results = self._run_agents(cluster_nodes, snapshot_id, snapshot_type)
+        finished = time.time()
+
+        nodes = [node_results[cluster_node.node] for cluster_node in cluster_nodes]
+        size = sum(node_result["size"] for node_result in nodes)
+        manifest = {
+            "snapshot_id": snapshot_id,
+            "snapshot_type": snapshot_type,
+            "status": SUCCESS_FIELD_METADATA if all(node_result["status"] == SUCCESS_FIELD_METADATA
+                                                    for node_result in nodes) else FAILED_FIELD_METADATA,
+            "started": self._format_time(started),
+            "finished": self._format_time(finished),
+            "duration": round(finished - started, 3),
+            "parallelism": self._parallelism,
+            "rack_parallelism": self._rack_parallelism,
+            "files": sum(node_result["files"] for node_result in nodes),
+            "size": size,
+            "throughput": int(size / max(finished - started, 0.001)),
+            "nodes": nodes,
+        }
+        self._repository.save_metadata(json.dumps(manifest), os.path.join(snapshot_id, CLUSTER_MANIFEST_FILE))
+        logger.info("Snapshot {snapshot_id} {status} - {size} in {duration:.0f}s".format(
+            snapshot_id=snapshot_id, status=manifest["status"], size=format_size(size), duration=manifest["duration"]))
+        return manifest
+
+    def _run_agents(self, cluster_nodes, snapshot_id, snapshot_type):
+        pending = self._stagger(cluster_nodes)
+        running = collections.Counter()
+        node_results = dict()
+        condition = threading.Condition()
+
+        def run_agent(cluster_node):
+            started = time.time()
+            try:
+                node_results[cluster_node.node] = self._run_agent(cluster_node, snapshot_id, snapshot_type)
+            except Exception as e:
+                logger.error("Snapshot agent of {node} failed - {error}".format(node=cluster_node.node, error=e))
+                node_results[cluster_node.node] = self._node_result(cluster_node, False, None, started, time.time(),
+                                                                    error=str(e))
+            finally:
+                with condition:
+                    running[cluster_node.rack] -= 1
+                    condition.notify()
+
+        threads = list()
+        with condition:
+            while pending:
+                cluster_node = self._next_node(pending, running)
+                if cluster_node is None:
+                    condition.wait()
+                    continue
+                pending.remove(cluster_node)
+                running[cluster_node.rack] += 1
+                thread = threading.Thread(target=run_agent, args=(cluster_node,))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return node_results
+
+    def _next_node(self, pending, running):
+        if sum(running.values()) >= self._parallelism:
+            return None
+        for cluster_node in pending:
+            if self._rack_parallelism is None or running[cluster_node.rack] < self._rack_parallelism:
+                return cluster_node
+        return None
+
+    @staticmethod
+    def _stagger(cluster_nodes):
+        """
+        Orders the nodes taking one of every rack in turn.
+        """
+        rack_nodes = collections.OrderedDict()
+        for cluster_node in cluster_nodes:
+            rack_nodes.setdefault(cluster_node.rack, collections.deque()).append(cluster_node)
+        staggered_nodes = list()
+        while rack_nodes:
+            for rack in list(rack_nodes):
+                staggered_nodes.append(rack_nodes[rack].popleft())
+                if not rack_nodes[rack]:
+                    del rack_nodes[rack]
+        return staggered_nodes
+
+    def _run_agent(self, cluster_node, snapshot_id, snapshot_type):
+        command = shlex.split(self._agent_command.format(node=cluster_node.node)) + self._agent_options + [
+            '--node', cluster_node.node, '--snapshot-id', snapshot_id, '--snapshot-type', snapshot_type]
+        log_path = None
+        if self._log_directory is not None:
+            log_directory = os.path.join(self._log_directory, snapshot_id)
+            if not os.path.isdir(log_directory):
+                try:
+                    os.makedirs(log_directory)
+                except OSError:
+                    if not os.path.isdir(log_directory):
+                        raise
+            log_path = os.path.join(log_directory, cluster_node.node + '.log')
+
+        logger.info("Starting snapshot agent of {node}".format(node=cluster_node.node))
+        started, error = time.time(), None
+        try:
+            with open(log_path or os.devnull, 'ab') as log_file:
+                exit_code = subprocess.call(command, stdout=log_file, stderr=subprocess.STDOUT)
+        except OSError as e:
+            logger.error("Failed to start snapshot agent of {node} - {error}".format(node=cluster_node.node, error=e))
+            exit_code, error = None, str(e)
+        finished = time.time()
+
+        try:
+            metadata = self._repository.load_metadata(os.path.join(snapshot_id, cluster_node.node, snapshot_type,
+                                                                   SNAPSHOT_METADATA_FILE))
+        except Exception as e:
+            logger.error("Failed to load the snapshot metadata of {node} - {error}".format(node=cluster_node.node,
+                                                                                        error=e))
+            metadata, error = None, error or str(e)
+        metadata = json.loads(metadata) if metadata is not None else dict()
+        succeeded = exit_code == 0 and metadata.get("status") == SUCCESS_FIELD_METADATA
+        files, size = 0, 0
+        if metadata.get("manifest") is not None:
+            for keyspace_tables in metadata["manifest"]["tables"].values():
+                for table_index in keyspace_tables.values():
+                    files += table_index["files"]
+                    size += table_index["size"]
+        node_result = self._node_result(cluster_node, succeeded, exit_code, started, finished, files, size, log_path,
+                                        error)
+        log = logger.info if succeeded else logger.error
+        log("Snapshot agent of {node} finished - {status}, {size} in {duration:.0f}s".format(
+            node=cluster_node.node, status=node_result["status"], size=format_size(size),
+            duration=node_result["duration"]))
+        return node_result
+
+    @classmethod
+    def _node_result(cls, cluster_node, succeeded, exit_code, started, finished, files=0, size=0, log_path=None,
+                     error=None):
+        return {
+            "node": cluster_node.node,
+            "rack": cluster_node.rack,
+            "status": SUCCESS_FIELD_METADATA if succeeded else FAILED_FIELD_METADATA,
+            "exit_code": exit_code,
+            "error": error,
+            "started": cls._format_time(started),
+            "finished": cls._format_time(finished),
+            "duration": round(finished - started, 3),
+            "files": files,
+            "size": size,
+            "throughput": int(size / max(finished - started, 0.001)),
+            "log": log_path,
+        }
+
+    @staticmethod
+    def _format_time(timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).strftime(SNAPSHOT_TIME_FORMAT)
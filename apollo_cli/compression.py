@@ -0,0 +1,102 @@
+import collections
+import concurrent.futures
+from apollo_exceptions import CompressionError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+COMPRESSION_EXTENSIONS = {'zstd': '.zst', 'lz4': '.lz4'}
+COMPRESSION_CHUNK_SIZE = 4 * 1024 * 1024
+ZSTD_COMPRESSION_LEVEL = 3
+
+
+def validate_compression_codec(codec):
+    if codec == 'zstd' and zstandard is None:
+        raise CompressionError("zstd compression requires the zstandard package")
+    if codec == 'lz4' and lz4_frame is None:
+        raise CompressionError("lz4 compression requires the lz4 package")
+    if codec not in COMPRESSION_EXTENSIONS:
+        raise CompressionError("Unknown compression codec - {codec}".format(codec=codec))
+
+
+def compress_chunk(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_COMPRESSION_LEVEL).compress(data)
+    return lz4_frame.compress(data)
+
+
+class StreamCompressor(object):
+    """
+    Compresses file chunks on a process pool so compression isn't bound by the GIL.
+
+    Every chunk is compressed into an independent frame, a concatenation of zstd or lz4 frames is a valid stream
+    which decompresses to the concatenation of the chunks. At most `window` chunks per stream are in flight.
+    """
+
+    def __init__(self, codec, workers, window=4):
+        validate_compression_codec(codec)
+        self._codec = codec
+        self._window = window
+        self._executor = concurrent.futures.ProcessPoolExecutor(workers)
+        # The pool forks its processes when work is first submitted, forked from a transfer thread while a nodetool
+        # process is being started they would inherit its stdout pipe and keep it open, so they are forked upfront
+        list(self._executor.map(validate_compression_codec, [codec] * workers))
+
+    @property
+    def codec(self):
+        return self._codec
+
+    @property
+    def extension(self):
+        return COMPRESSION_EXTENSIONS[self._codec]
+
+    def compress(self, chunks):
+        in_flight = collections.deque()
+        for chunk in chunks:
+            in_flight.append(self._executor.submit(compress_chunk, self._codec, chunk))
+            if len(in_flight) >= self._window:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class StreamDecompressor(object):
+    """
+    File-like writer which decompresses a stream of concatenated frames into the wrapped file.
+    """
+
+    def __init__(self, codec, output_file):
+        validate_compression_codec(codec)
+        self._codec = codec
+        self._output_file = output_file
+        self._decompressor = None
+        if codec == 'zstd':
+            self._zstd_writer = zstandard.ZstdDecompressor().stream_writer(output_file)
+
+    def write(self, data):
+        if self._codec == 'zstd':
+            self._zstd_writer.write(data)
+            return
+        while data:
+            if self._decompressor is None:
+                self._decompressor = lz4_frame.LZ4FrameDecompressor()
+            self._output_file.write(self._decompressor.decompress(data))
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                self._decompressor = None
+            else:
+                data = b''
+
+    def finish(self):
+        if self._decompressor is not None:
+            raise CompressionError("Compressed stream is truncated")
@@ -1,7 +1,49 @@
 SNAPSHOT_METADATA_FILE = ".metadata"
 SUCCESS_FIELD_METADATA = "SUCCESS"
 INITIAL_FIELD_METADATA = "IN_PROGRESS"
+ABANDONED_FIELD_METADATA = "ABANDONED"
 NODETOOL_COMMAND = "nodetool"
 NODETOOL_FLUSH_ARG = "flush"
 NODETOOL_SNAPSHOT_ARG = "snapshot"
 NODETOOL_CLEAR_SNAPSHOT_ARG = "clearsnapshot"
+DEDUP_REMOTE_DIRECTORY = "sstables"
+DEDUP_INDEX_FILE = ".index"
+INCREMENTAL_REMOTE_DIRECTORY = "incremental"
+INCREMENTAL_INDEX_FILE = ".shipped"
+SSTABLE_DIGEST_COMPONENT = "Digest"
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+RESTORE_TEMPORARY_SUFFIX = ".apollo-restore"
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+DISKSTATS_PATH = "/proc/diskstats"
+DISK_PRESSURE_INTERVAL = 1
+DISK_PRESSURE_HIGH_UTILIZATION = 0.8
+DISK_PRESSURE_LOW_UTILIZATION = 0.5
+DISK_PRESSURE_MIN_RATE_RATIO = 0.05
+JOURNAL_DEFAULT_PATH = "~/.apollo/journal.db"
+CRAWL_QUEUE_SIZE = 64
+CRAWL_QUEUE_TIMEOUT = 1
+BUNDLE_REMOTE_DIRECTORY = "bundles"
+SNAPSHOT_MANIFEST_FILE = ".manifest.gz"
+CATALOG_DEFAULT_PATH = "~/.apollo/catalog.db"
+METRICS_DEFAULT_INTERVAL = 30
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+AUTO_PART_SIZE_MIN = 8 * 1024 * 1024
+AUTO_PART_SIZE_MAX = 64 * 1024 * 1024
+AUTO_PART_SECONDS = 4
+AUTO_THROUGHPUT_SMOOTHING = 0.2
+TRANSFER_BYTES_PER_SLOT = 128 * 1024 * 1024
+REPOSITORY_TEMPORARY_SUFFIX = ".apollo-upload"
+REPOSITORY_UPLOADS_DIRECTORY = ".uploads"
+S3_MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+S3_COPY_PART_SIZE = 512 * 1024 * 1024
+SNAPSHOT_DATE_FORMAT = "%Y-%m-%d"
+SNAPSHOT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+S3_MAX_DELETE_KEYS = 1000
+SNAPSHOT_ID_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+FAILED_FIELD_METADATA = "FAILED"
+CLUSTER_MANIFEST_FILE = ".cluster"
+CLUSTER_LOG_DEFAULT_PATH = "~/.apollo/cluster"
+SNAPSHOT_TYPES = ("full", "incremental")
+SNAPSHOT_CHAIN_LOAD_WORKERS = 16
+THROTTLE_READ_CHUNK_SIZE = 1024 * 1024
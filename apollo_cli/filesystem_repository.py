@@ -0,0 +1,301 @@
+import os
+import uuid
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+from snapshot_repository import RepositoryTemplate
+from apollo_exceptions import (S3UploadError, S3DownloadError, S3DeleteError)
+from constants import (DOWNLOAD_BUFFER_SIZE, REPOSITORY_TEMPORARY_SUFFIX, REPOSITORY_UPLOADS_DIRECTORY,
+                       THROTTLE_READ_CHUNK_SIZE)
+from compression import StreamDecompressor
+
+logger = logging.getLogger(__name__)
+
+# linux/fs.h, clones the extents of one file into another on copy-on-write filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+# copy_file_range refuses some source and target pairs, e.g. across filesystems before Linux 5.3
+COPY_FILE_RANGE_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+class FileSystemRepository(RepositoryTemplate):
+    """
+    Repository in a local or NFS mounted directory.
+
+    Keys and metadata are laid out exactly as in an S3 bucket, so the directory can be synced to S3 as it is. Whole
+    SSTables are copied without passing through user space - reflinked, or hardlinked when `hardlink` is set, if the
+    directory shares the filesystem of the data directory, otherwise with copy_file_range or sendfile where available.
+    Objects are written aside and renamed into place, multipart uploads are staged under .uploads/ until completed.
+    No ETags are kept, snapshots in a directory are verified by size.
+    """
+
+    local_file_copy = True
+
+    def __init__(self, repository_path, hardlink=True):
+        self._root = os.path.abspath(repository_path)
+        self._hardlink = hardlink
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+
+    @property
+    def bucket(self):
+        return self._root
+
+    def upload(self, local_file_path, s3_key_path, verbose=True):
+        object_size, _ = self.copy_file(local_file_path, s3_key_path)
+        if verbose:
+            logger.info("Uploaded {sstable} - {size} bytes".format(sstable=local_file_path, size=object_size))
+
+    def copy_file(self, local_file_path, s3_key_path, throttle=None):
+        target_path = self._object_path(s3_key_path)
+        temporary_path = self._temporary_path(target_path)
+        try:
+            if not self._link(local_file_path, temporary_path):
+                with open(local_file_path, 'rb') as local_file, open(temporary_path, 'wb') as target_file:
+                    copy_range(local_file.fileno(), target_file.fileno(), 0, os.fstat(local_file.fileno()).st_size,
+                               throttle)
+            os.rename(temporary_path, target_path)
+        except (IOError, OSError) as e:
+            self._discard(temporary_path)
+            raise S3UploadError(e)
+        return os.path.getsize(target_path), None
+
+    def copy_object(self, source_key_path, s3_key_path, size):
+        if not os.path.isfile(self._path(source_key_path)):
+            raise S3UploadError("Object not found - {s3_key_path}".format(s3_key_path=source_key_path))
+        return self.copy_file(self._path(source_key_path), s3_key_path)
+
+    def _link(self, local_file_path, target_path):
+        try:
+            with open(local_file_path, 'rb') as local_file, open(target_path, 'wb') as target_file:
+                fcntl.ioctl(target_file.fileno(), FICLONE, local_file.fileno())
+            return True
+        except (IOError, OSError):
+            self._discard(target_path)
+        if not self._hardlink:
+            return False
+        try:
+            os.link(local_file_path, target_path)
+            return True
+        except OSError:
+            return False
+
+    def put_object(self, s3_key_path, body):
+        target_path = self._object_path(s3_key_path)
+        self._write(target_path, body, S3UploadError)
+        return None
+
+    def create_multipart_upload(self, s3_key_path):
+        upload_id = uuid.uuid4().hex
+        try:
+            os.makedirs(self._upload_path(upload_id))
+        except OSError as e:
+            raise S3UploadError(e)
+        return upload_id
+
+    def upload_part(self, s3_key_path, upload_id, part_number, body):
+        self._write(os.path.join(self._upload_path(upload_id), str(part_number)), body, S3UploadError)
+        # The journal keeps a checksum for every uploaded part
+        return hashlib.md5(body).hexdigest()
+
+    def complete_multipart_upload(self, s3_key_path, upload_id, part_etags):
+        target_path = self._object_path(s3_key_path)
+        temporary_path = self._temporary_path(target_path)
+        try:
+            with open(temporary_path, 'wb') as target_file:
+                for part_number in sorted(part_etags):
+                    with open(os.path.join(self._upload_path(upload_id), str(part_number)), 'rb') as part_file:
+                        copy_range(part_file.fileno(), target_file.fileno(), 0,
+                                   os.fstat(part_file.fileno()).st_size)
+            os.rename(temporary_path, target_path)
+        except (IOError, OSError) as e:
+            self._discard(temporary_path)
+            raise S3UploadError(e)
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+        return None
+
+    def abort_multipart_upload(self, s3_key_path, upload_id):
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+
+    def download(self, s3_key_path, local_file_path, byte_range=None, compression=None, file_offset=None):
+        logger.debug("Downloading - {sstable} {byte_range}".format(sstable=s3_key_path, byte_range=byte_range or ''))
+        try:
+            with open(self._path(s3_key_path), 'rb') as source_file:
+                if byte_range is None:
+                    start, length = 0, os.fstat(source_file.fileno()).st_size
+                    file_mode, offset = 'wb', 0
+                else:
+                    start, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+                    file_mode, offset = 'r+b', byte_range[0] if file_offset is None else file_offset
+
+                with open(local_file_path, file_mode) as local_file:
+                    if compression is None:
+                        os.lseek(local_file.fileno(), offset, os.SEEK_SET)
+                        copy_range(source_file.fileno(), local_file.fileno(), start, length)
+                        return
+                    local_file.seek(offset)
+                    source_file.seek(start)
+                    writer = StreamDecompressor(compression, local_file)
+                    remaining = length
+                    while remaining > 0:
+                        chunk = source_file.read(min(remaining, DOWNLOAD_BUFFER_SIZE))
+                        if not chunk:
+                            break
+                        writer.write(chunk)
+                        remaining -= len(chunk)
+                    writer.finish()
+        except Exception as e:
+            raise S3DownloadError(e)
+
+    def list_objects(self, prefix):
+        objects = dict()
+        for directory, directory_names, file_names in os.walk(self._prefix_directory(prefix)):
+            if directory == self._root and REPOSITORY_UPLOADS_DIRECTORY in directory_names:
+                directory_names.remove(REPOSITORY_UPLOADS_DIRECTORY)
+            for file_name in file_names:
+                key = os.path.relpath(os.path.join(directory, file_name), self._root)
+                if key.startswith(prefix) and not file_name.endswith(REPOSITORY_TEMPORARY_SUFFIX):
+                    objects[key] = os.path.getsize(os.path.join(directory, file_name))
+        return objects
+
+    def head_object(self, s3_key_path):
+        try:
+            return os.path.getsize(self._path(s3_key_path)), None
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise S3DownloadError(e)
+
+    def list_prefixes(self, prefix):
+        directory = self._prefix_directory(prefix)
+        directory_prefix = os.path.relpath(directory, self._root) + '/' if directory != self._root else ''
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return list()
+            raise S3DownloadError(e)
+        return [directory_prefix + name + '/' for name in names
+                if (directory_prefix + name).startswith(prefix) and name != REPOSITORY_UPLOADS_DIRECTORY and
+                os.path.isdir(os.path.join(directory, name))]
+
+    def delete_objects(self, s3_key_paths):
+        directories = set()
+        for s3_key_path in s3_key_paths:
+            path = self._path(s3_key_path)
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise S3DeleteError(e)
+            directories.add(os.path.dirname(path))
+        # Directories left empty are removed, like S3 prefixes go away with their last object
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory != self._root:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    def save_metadata(self, metadata, remote_path):
+        logger.info("Saving snapshot metadata, remote path - {remote_path}".format(remote_path=remote_path))
+        self._write(self._object_path(remote_path),
+                    metadata.encode('utf-8') if not isinstance(metadata, bytes) else metadata, S3UploadError)
+        logger.info("Metadata is saved")
+
+    def load_metadata(self, remote_path, byte_range=None):
+        logger.debug("Loading metadata, remote path - {remote_path}".format(remote_path=remote_path))
+        try:
+            with open(self._path(remote_path), 'rb') as metadata_file:
+                if byte_range is None:
+                    return metadata_file.read()
+                metadata_file.seek(byte_range[0])
+                return metadata_file.read(byte_range[1] - byte_range[0] + 1)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise S3DownloadError(e)
+
+    def _path(self, s3_key_path):
+        return os.path.join(self._root, s3_key_path)
+
+    def _object_path(self, s3_key_path):
+        path = self._path(s3_key_path)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise S3UploadError(e)
+        return path
+
+    def _upload_path(self, upload_id):
+        return os.path.join(self._root, REPOSITORY_UPLOADS_DIRECTORY, upload_id)
+
+    def _prefix_directory(self, prefix):
+        # Like S3 prefixes, "2019-01-23/node1/" lists below that directory and "2019-01" matches names in the root
+        return os.path.join(self._root, prefix.rsplit('/', 1)[0]) if '/' in prefix else self._root
+
+    def _write(self, target_path, body, error_type):
+        temporary_path = self._temporary_path(target_path)
+        try:
+            with open(temporary_path, 'wb') as target_file:
+                if isinstance(body, bytes):
+                    target_file.write(body)
+                else:
+                    shutil.copyfileobj(body, target_file, DOWNLOAD_BUFFER_SIZE)
+            os.rename(temporary_path, target_path)
+        except (IOError, OSError) as e:
+            self._discard(temporary_path)
+            raise error_type(e)
+
+    @staticmethod
+    def _temporary_path(target_path):
+        return "{path}.{token}{suffix}".format(path=target_path, token=uuid.uuid4().hex[:8],
+                                               suffix=REPOSITORY_TEMPORARY_SUFFIX)
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def copy_range(source_fd, target_fd, offset, length, throttle=None):
+    """
+    Copies `length` bytes of the source from `offset` to the current position of the target, in the kernel when
+    copy_file_range (Python 3.8) or sendfile (Python 3.3) is available. With `throttle`, the range is copied in chunks
+    and `throttle(amount)` is called before each of them.
+    """
+    if throttle is None:
+        return _copy_range(source_fd, target_fd, offset, length)
+    while length > 0:
+        chunk_length = min(length, THROTTLE_READ_CHUNK_SIZE)
+        throttle(chunk_length)
+        _copy_range(source_fd, target_fd, offset, chunk_length)
+        offset += chunk_length
+        length -= chunk_length
+
+
+def _copy_range(source_fd, target_fd, offset, length):
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    while length > 0:
+        if use_copy_file_range:
+            try:
+                copied = os.copy_file_range(source_fd, target_fd, length, offset)
+            except OSError as e:
+                if e.errno not in COPY_FILE_RANGE_FALLBACK_ERRORS:
+                    raise
+                use_copy_file_range = False
+                continue
+        elif hasattr(os, 'sendfile'):
+            copied = os.sendfile(target_fd, source_fd, offset, length)
+        else:
+            os.lseek(source_fd, offset, os.SEEK_SET)
+            copied = os.write(target_fd, os.read(source_fd, min(length, DOWNLOAD_BUFFER_SIZE)))
+        if copied == 0:
+            raise IOError("Source ended {length} bytes short of the copied range".format(length=length))
+        offset += copied
+        length -= copied
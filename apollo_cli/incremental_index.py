@@ -0,0 +1,71 @@
+import os
+import json
+import logging
+import threading
+from constants import (INCREMENTAL_REMOTE_DIRECTORY, INCREMENTAL_INDEX_FILE)
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalBackupIndex(object):
+    """
+    Per-node index of the incremental backup files already shipped to the repository.
+
+    Cassandra hardlinks every flushed SSTable into the backups/ directory of its table and never removes it, so an
+    incremental snapshot uploads only the files missing from the index. A file is identified by its keyspace, table,
+    file name, size and modification time. Entries of files that are no longer in backups/ are dropped whenever their
+    table is crawled, so the index doesn't outgrow the directories it describes.
+    """
+
+    def __init__(self, repository, node):
+        self._repository = repository
+        self._node = node
+        self._index_remote_path = os.path.join(node, INCREMENTAL_REMOTE_DIRECTORY, INCREMENTAL_INDEX_FILE)
+        self._shipped_files = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        index = self._repository.load_metadata(self._index_remote_path)
+        if index is None:
+            logger.info("No incremental backup index found for node {node}, starting a new one".format(
+                node=self._node))
+            return dict()
+        return json.loads(index)
+
+    def save(self):
+        with self._lock:
+            index = json.dumps(self._shipped_files)
+        self._repository.save_metadata(index, self._index_remote_path)
+
+    def is_shipped(self, sstable):
+        return self.shipped_object(sstable) is not None
+
+    def shipped_object(self, sstable):
+        """
+        Remote path and object size the file was shipped as, None if it wasn't shipped.
+        """
+        with self._lock:
+            shipped_file = self._shipped_files.get(self._file_key(sstable.keyspace, sstable.table, sstable.path))
+        if shipped_file is None or shipped_file["size"] != sstable.size or \
+                shipped_file["mtime"] != int(sstable.mtime):
+            return None
+        return shipped_file["remote_path"], shipped_file["object_size"]
+
+    def register(self, sstable, remote_path, stored_object):
+        object_size = stored_object[0] if stored_object is not None else None
+        with self._lock:
+            self._shipped_files[self._file_key(sstable.keyspace, sstable.table, sstable.path)] = {
+                "size": sstable.size, "mtime": int(sstable.mtime), "remote_path": remote_path,
+                "object_size": object_size}
+
+    def forget_missing(self, keyspace, table, sstables):
+        present_keys = set(self._file_key(keyspace, table, sstable.path) for sstable in sstables)
+        table_prefix = self._file_key(keyspace, table, '')
+        with self._lock:
+            for file_key in [file_key for file_key in self._shipped_files
+                             if file_key.startswith(table_prefix) and file_key not in present_keys]:
+                del self._shipped_files[file_key]
+
+    @staticmethod
+    def _file_key(keyspace, table, path):
+        return '/'.join((keyspace, table, os.path.basename(path)))
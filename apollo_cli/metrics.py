@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+METRICS_COUNTERS = ('bytes_read', 'bytes_sent', 'objects_uploaded', 'objects_resumed', 'requests', 'retries',
+                    'bytes_released')
+METRICS_PREFIX = "apollo_snapshot"
+
+
+class ShardedCounter(object):
+    """
+    Counter with one cell per thread, increments never take a lock and the cells are summed when the value is read.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = list()
+        self._lock = threading.Lock()
+
+    def add(self, amount=1):
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = self._local.cell = [0]
+            with self._lock:
+                self._cells.append(cell)
+        cell[0] += amount
+
+    @property
+    def value(self):
+        with self._lock:
+            return sum(cell[0] for cell in self._cells)
+
+
+class SnapshotMetrics(object):
+    """
+    Aggregated counters, phase timings and per-keyspace SSTable statistics of a snapshot run.
+
+    Phases may overlap - SSTables are uploaded while the data directory is crawled - so every phase reports its own
+    wall time.
+    """
+
+    def __init__(self):
+        self._started_at = time.time()
+        self._counters = dict((name, ShardedCounter()) for name in METRICS_COUNTERS)
+        self._phases = dict()
+        self._keyspaces = dict()
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        self._counters[name].add(amount)
+
+    def value(self, name):
+        return self._counters[name].value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0) + time.time() - started_at
+
+    def record_sstable(self, keyspace, size, disposition):
+        """
+        Counts an SSTable of the keyspace by what happened to it - upload, dedup (already stored) or bundle.
+        """
+        with self._lock:
+            keyspace_stats = self._keyspaces.setdefault(keyspace, dict())
+            files, total_size = keyspace_stats.get(disposition, (0, 0))
+            keyspace_stats[disposition] = (files + 1, total_size + size)
+
+    def summary(self):
+        with self._lock:
+            phases = dict(self._phases)
+            keyspaces = dict((keyspace, dict((disposition, {"files": files, "bytes": size})
+                                             for disposition, (files, size) in keyspace_stats.items()))
+                             for keyspace, keyspace_stats in self._keyspaces.items())
+        summary = dict((name, counter.value) for name, counter in self._counters.items())
+        summary["elapsed_seconds"] = time.time() - self._started_at
+        summary["phases"] = phases
+        summary["keyspaces"] = keyspaces
+        return summary
+
+    def write_report(self, report_path, report_format, labels, succeeded):
+        summary = self.summary()
+        summary.update(labels)
+        summary["success"] = succeeded
+        report = self._prometheus_report(summary, labels) if report_format == 'prometheus' else \
+            json.dumps(summary, indent=2, sort_keys=True) + '\n'
+        # Written aside and renamed so scrapers never read a partial report
+        temporary_path = report_path + '.tmp'
+        with open(temporary_path, 'w') as report_file:
+            report_file.write(report)
+        os.rename(temporary_path, report_path)
+        logger.info("Metrics report is written to {path}".format(path=report_path))
+
+    @staticmethod
+    def _prometheus_report(summary, labels):
+        def sample(name, value, extra_labels=None):
+            sample_labels = dict(labels)
+            sample_labels.update(extra_labels or dict())
+            formatted_labels = ','.join('{key}="{value}"'.format(key=key, value=str(sample_labels[key]).replace(
+                '"', '\\"')) for key in sorted(sample_labels))
+            return "{prefix}_{name}{{{labels}}} {value}".format(prefix=METRICS_PREFIX, name=name,
+                                                                labels=formatted_labels, value=value)
+
+        lines = list()
+        for name in METRICS_COUNTERS:
+            lines.append("# TYPE {prefix}_{name}_total counter".format(prefix=METRICS_PREFIX, name=name))
+            lines.append(sample(name + "_total", summary[name]))
+        lines.append("# TYPE {prefix}_success gauge".format(prefix=METRICS_PREFIX))
+        lines.append(sample("success", int(summary["success"])))
+        lines.append("# TYPE {prefix}_elapsed_seconds gauge".format(prefix=METRICS_PREFIX))
+        lines.append(sample("elapsed_seconds", "{:.3f}".format(summary["elapsed_seconds"])))
+        lines.append("# TYPE {prefix}_phase_seconds gauge".format(prefix=METRICS_PREFIX))
+        for phase in sorted(summary["phases"]):
+            lines.append(sample("phase_seconds", "{:.3f}".format(summary["phases"][phase]), {"phase": phase}))
+        for name, stat in (("keyspace_files", "files"), ("keyspace_bytes", "bytes")):
+            lines.append("# TYPE {prefix}_{name} gauge".format(prefix=METRICS_PREFIX, name=name))
+            for keyspace in sorted(summary["keyspaces"]):
+                for disposition, stats in sorted(summary["keyspaces"][keyspace].items()):
+                    lines.append(sample(name, stats[stat], {"keyspace": keyspace, "disposition": disposition}))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsReporter(object):
+    """
+    Logs the transfer rates of a snapshot run every `interval` seconds.
+    """
+
+    def __init__(self, metrics, interval):
+        self._metrics = metrics
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._report, name="metrics-reporter")
+        self._thread.daemon = True
+
+    def start(self):
+        if self._interval > 0:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _report(self):
+        previous = self._metrics.summary()
+        while not self._stop_event.wait(self._interval):
+            current = self._metrics.summary()
+            elapsed = current["elapsed_seconds"] - previous["elapsed_seconds"]
+            logger.info("Uploaded {objects} objects, {sent:.1f} MB sent ({send_rate:.1f} MB/s), {read:.1f} MB read "
+                        "({read_rate:.1f} MB/s), {retries} retries".format(
+                            objects=current["objects_uploaded"], sent=current["bytes_sent"] / (1024.0 * 1024),
+                            send_rate=(current["bytes_sent"] - previous["bytes_sent"]) / elapsed / (1024 * 1024),
+                            read=current["bytes_read"] / (1024.0 * 1024),
+                            read_rate=(current["bytes_read"] - previous["bytes_read"]) / elapsed / (1024 * 1024),
+                            retries=current["retries"]))
+            previous = current
@@ -0,0 +1,117 @@
+import os
+import logging
+from snapshot_chain import SnapshotChain
+from utils import filter_sstables_remote_map
+
+logger = logging.getLogger(__name__)
+
+
+class RestorePlan(object):
+    """
+    Files to download for a point in time restore, by the compression of the snapshot storing them, and the files of
+    the chain which aren't needed.
+    """
+
+    def __init__(self, chain, target_time):
+        self._chain = chain
+        self._target_time = target_time
+        self._downloads = dict()
+        self._snapshot_files = dict()
+        self._skipped_files = 0
+        self._skipped_size = 0
+
+    @property
+    def snapshots(self):
+        return self._chain.snapshots
+
+    @property
+    def target_time(self):
+        return self._target_time
+
+    @property
+    def downloads(self):
+        """
+        {compression: {local path: (remote path, size, offset)}}, the form parallel_download takes.
+        """
+        return self._downloads
+
+    @property
+    def skipped_files(self):
+        return self._skipped_files
+
+    @property
+    def skipped_size(self):
+        return self._skipped_size
+
+    def add(self, chain_snapshot, local_sstable_path, entry):
+        self._downloads.setdefault(chain_snapshot.metadata.get("compression"), dict())[local_sstable_path] = (
+            entry["remote_path"], entry["size"], entry.get("offset"))
+        files, size = self._snapshot_files.get(chain_snapshot.remote_base_path, (0, 0))
+        self._snapshot_files[chain_snapshot.remote_base_path] = (files + 1, size + entry["size"])
+
+    def skip(self, entry):
+        self._skipped_files += 1
+        self._skipped_size += entry["size"]
+
+    def snapshot_files(self, chain_snapshot):
+        """
+        Files taken from a snapshot of the chain and their size.
+        """
+        return self._snapshot_files.get(chain_snapshot.remote_base_path, (0, 0))
+
+    @property
+    def files(self):
+        return sum(len(downloads) for downloads in self._downloads.values())
+
+    @property
+    def size(self):
+        return sum(size for downloads in self._downloads.values() for _, size, _ in downloads.values())
+
+
+class RestorePlanner(object):
+    """
+    Plans the restore of a node as of a point in time from its latest full snapshot and the incremental snapshots
+    taken since.
+
+    Files are merged across the chain by keyspace, table and file name, so a file stored by several snapshots is
+    fetched once. When every file live in a table at the end of the chain is stored in the chain, only those files
+    are restored and SSTables compacted or expired away in between are skipped. Other tables - compaction outputs
+    aren't backed up incrementally - are restored whole, their compacted SSTables still hold the data.
+    """
+
+    def __init__(self, repository, node):
+        self._repository = repository
+        self._node = node
+
+    def plan(self, target_time, data_directory, keyspaces=None, tables=None):
+        chain = SnapshotChain.load(self._repository, self._node, target_time)
+        logger.info("Restoring {node} as of {time} from {snapshots}".format(
+            node=self._node, time=target_time,
+            snapshots=', '.join(chain_snapshot.remote_base_path for chain_snapshot in chain.snapshots)))
+
+        table_files = dict()
+        for (keyspace, table, sstable_name), chain_file in chain.files().items():
+            table_files.setdefault(keyspace, dict()).setdefault(table, dict())[sstable_name] = chain_file
+        table_files = filter_sstables_remote_map(table_files, keyspaces, tables)
+        live_sstables = chain.live_sstables()
+
+        restore_plan = RestorePlan(chain, target_time)
+        for keyspace in sorted(table_files):
+            for table in sorted(table_files[keyspace]):
+                chain_files = table_files[keyspace][table]
+                live_names = live_sstables.get(keyspace, dict()).get(table)
+                live_names = set(live_names) if live_names is not None else None
+                if live_names is not None and not live_names.issubset(chain_files):
+                    logger.debug("Not every live file of {keyspace}.{table} is stored, restoring it whole".format(
+                        keyspace=keyspace, table=table))
+                    live_names = None
+                for sstable_name in sorted(chain_files):
+                    chain_snapshot, entry = chain_files[sstable_name]
+                    if live_names is not None and sstable_name not in live_names:
+                        restore_plan.skip(entry)
+                        continue
+                    restore_plan.add(chain_snapshot, os.path.join(data_directory, keyspace, table, sstable_name),
+                                     entry)
+        logger.info("Restoring {files} files, {skipped} files no longer live are skipped".format(
+            files=restore_plan.files, skipped=restore_plan.skipped_files))
+        return restore_plan
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    bucket TEXT NOT NULL,
+    remote_base_path TEXT NOT NULL,
+    node TEXT NOT NULL,
+    snapshot_type TEXT NOT NULL,
+    snapshot_date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    compression TEXT,
+    files INTEGER,
+    size INTEGER,
+    PRIMARY KEY (bucket, remote_base_path)
+);
+CREATE TABLE IF NOT EXISTS tables (
+    bucket TEXT NOT NULL,
+    remote_base_path TEXT NOT NULL,
+    keyspace TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    files INTEGER,
+    size INTEGER,
+    PRIMARY KEY (bucket, remote_base_path, keyspace, table_name)
+);
+"""
+
+
+class SnapshotCatalog(object):
+    """
+    Local SQLite cache of the snapshots stored in a repository and their per-table file counts and sizes.
+
+    Snapshots taken from this host are recorded when they finish, others are added by refreshing the catalog from
+    the snapshot metadata in the bucket, so listing and describing snapshots doesn't scan the bucket.
+    """
+
+    def __init__(self, catalog_path):
+        catalog_directory = os.path.dirname(catalog_path)
+        if catalog_directory and not os.path.isdir(catalog_directory):
+            os.makedirs(catalog_directory)
+        self._connection = sqlite3.connect(catalog_path, check_same_thread=False)
+        self._connection.executescript(CATALOG_SCHEMA)
+        self._lock = threading.Lock()
+
+    def _execute(self, statement, parameters=()):
+        with self._lock:
+            with self._connection:
+                return self._connection.execute(statement, parameters).fetchall()
+
+    def record_snapshot(self, bucket, remote_base_path, metadata):
+        tables = dict()
+        if metadata.get("manifest") is not None:
+            for keyspace, keyspace_tables in metadata["manifest"]["tables"].items():
+                for table, table_index in keyspace_tables.items():
+                    tables[(keyspace, table)] = (table_index["files"], table_index["size"])
+        else:
+            # Snapshots taken before manifests were introduced only list their files, sizes are unknown
+            for sstables_map in (metadata.get("sstables", dict()), metadata.get("bundled_sstables", dict())):
+                for keyspace, keyspace_tables in sstables_map.items():
+                    for table, sstables in keyspace_tables.items():
+                        files, _ = tables.get((keyspace, table), (0, None))
+                        tables[(keyspace, table)] = (files + len(sstables), None)
+
+        sizes = [size for _, size in tables.values()]
+        total_size = sum(sizes) if None not in sizes else None
+        self._execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (bucket, remote_base_path, metadata["node"], metadata["snapshot_type"],
+                       metadata["snapshot_date"], metadata["status"], metadata.get("compression"),
+                       sum(files for files, _ in tables.values()), total_size))
+        self._execute("DELETE FROM tables WHERE bucket = ? AND remote_base_path = ?", (bucket, remote_base_path))
+        for (keyspace, table), (files, size) in tables.items():
+            self._execute("INSERT INTO tables VALUES (?, ?, ?, ?, ?, ?)",
+                          (bucket, remote_base_path, keyspace, table, files, size))
+
+    def remove_snapshot(self, bucket, remote_base_path):
+        self._execute("DELETE FROM tables WHERE bucket = ? AND remote_base_path = ?", (bucket, remote_base_path))
+        self._execute("DELETE FROM snapshots WHERE bucket = ? AND remote_base_path = ?", (bucket, remote_base_path))
+
+    def snapshot_status(self, bucket, remote_base_path):
+        rows = self._execute("SELECT status FROM snapshots WHERE bucket = ? AND remote_base_path = ?",
+                             (bucket, remote_base_path))
+        return rows[0][0] if rows else None
+
+    def snapshots(self, bucket, node=None):
+        rows = self._execute("SELECT snapshot_date, node, snapshot_type, status, compression, files, size "
+                             "FROM snapshots WHERE bucket = ? AND (? IS NULL OR node = ?) "
+                             "ORDER BY snapshot_date, node, snapshot_type", (bucket, node, node))
+        return [dict(zip(("snapshot_date", "node", "snapshot_type", "status", "compression", "files", "size"), row))
+                for row in rows]
+
+    def tables(self, bucket, remote_base_path):
+        rows = self._execute("SELECT keyspace, table_name, files, size FROM tables "
+                             "WHERE bucket = ? AND remote_base_path = ? ORDER BY keyspace, table_name",
+                             (bucket, remote_base_path))
+        return [dict(zip(("keyspace", "table", "files", "size"), row)) for row in rows]
@@ -0,0 +1,143 @@
+import os
+import json
+import logging
+import collections
+import concurrent.futures
+from constants import (SNAPSHOT_METADATA_FILE, SUCCESS_FIELD_METADATA, SNAPSHOT_TYPES, SNAPSHOT_CHAIN_LOAD_WORKERS)
+from apollo_exceptions import (S3DownloadError, SnapshotChainError)
+from snapshot_manifest import SnapshotManifest
+from utils import (list_snapshot_dates, parse_snapshot_time)
+
+logger = logging.getLogger(__name__)
+
+ChainSnapshot = collections.namedtuple('ChainSnapshot', ['remote_base_path', 'metadata', 'entries'])
+
+
+class SnapshotChain(object):
+    """
+    The latest successful full snapshot of a node taken up to a point in time and the successful incremental
+    snapshots taken after it, oldest first, with their metadata and manifest entries.
+
+    Snapshots are placed in time by the `snapshot_time` of their metadata rather than by the date or snapshot ID they
+    are stored under, snapshots written before it was recorded count as taken at the end of their date. An incremental
+    snapshot of the full snapshot's date is kept unless it is known to be older, restoring SSTables the full snapshot
+    already holds is harmless. Metadata of every snapshot is loaded, manifests only of the snapshots of the chain.
+    """
+
+    def __init__(self, snapshots):
+        self._snapshots = snapshots
+
+    @classmethod
+    def load(cls, repository, node, target_time, skip_full_date=None):
+        snapshot_dates = list_snapshot_dates(repository)
+        snapshot_keys = [(snapshot_date, snapshot_type) for snapshot_date in snapshot_dates
+                         for snapshot_type in SNAPSHOT_TYPES]
+        executor = concurrent.futures.ThreadPoolExecutor(SNAPSHOT_CHAIN_LOAD_WORKERS)
+        try:
+            snapshots = dict(zip(snapshot_keys, executor.map(
+                lambda snapshot_key: cls._load_snapshot(repository, node, *snapshot_key), snapshot_keys)))
+        finally:
+            executor.shutdown()
+        chain = cls.select(snapshot_dates, lambda snapshot_date, snapshot_type: snapshots[snapshot_date, snapshot_type],
+                           node, target_time, skip_full_date)
+        return cls([cls._load_entries(repository, chain_snapshot) for chain_snapshot in chain.snapshots])
+
+    @classmethod
+    def select(cls, snapshot_dates, load_snapshot, node, target_time, skip_full_date=None):
+        """
+        Builds the chain from the dates holding snapshots and `load_snapshot(snapshot_date, snapshot_type)` returning
+        a successful snapshot or None. Snapshots are ordered by the time they were taken, not by their date or
+        snapshot ID, which a user may have chosen freely.
+        """
+        snapshots = list()
+        for snapshot_date in snapshot_dates:
+            for snapshot_type in SNAPSHOT_TYPES:
+                if snapshot_type == "full" and snapshot_date == skip_full_date:
+                    continue
+                chain_snapshot = load_snapshot(snapshot_date, snapshot_type)
+                if chain_snapshot is not None and cls.snapshot_time(chain_snapshot) <= target_time:
+                    snapshots.append(chain_snapshot)
+        snapshots.sort(key=lambda chain_snapshot: (cls.snapshot_time(chain_snapshot), chain_snapshot.remote_base_path))
+
+        full_snapshots = [chain_snapshot for chain_snapshot in snapshots
+                          if cls._snapshot_type(chain_snapshot) == "full"]
+        if not full_snapshots:
+            raise SnapshotChainError("No successful full snapshot of node {node} up to {time}".format(
+                node=node, time=target_time))
+        full_snapshot = full_snapshots[-1]
+        full_snapshot_time = cls.snapshot_time(full_snapshot)
+        incremental_snapshots = [chain_snapshot for chain_snapshot in snapshots
+                                 if cls._snapshot_type(chain_snapshot) == "incremental" and
+                                 (cls.snapshot_time(chain_snapshot) > full_snapshot_time or
+                                  chain_snapshot.metadata.get("snapshot_time") is None and
+                                  cls.snapshot_time(chain_snapshot) >= full_snapshot_time)]
+        return cls([full_snapshot] + incremental_snapshots)
+
+    @staticmethod
+    def _load_snapshot(repository, node, snapshot_date, snapshot_type):
+        remote_base_path = os.path.join(snapshot_date, node, snapshot_type)
+        metadata = repository.load_metadata(os.path.join(remote_base_path, SNAPSHOT_METADATA_FILE))
+        if metadata is None:
+            return None
+        metadata = json.loads(metadata)
+        if metadata["status"] != SUCCESS_FIELD_METADATA:
+            logger.warning("Skipping snapshot {remote_path} with status {status}".format(
+                remote_path=remote_base_path, status=metadata["status"]))
+            return None
+        return ChainSnapshot(remote_base_path, metadata, None)
+
+    @staticmethod
+    def _load_entries(repository, chain_snapshot):
+        if chain_snapshot.metadata.get("manifest") is None:
+            raise SnapshotChainError("Snapshot {remote_path} has no manifest, it can't be chained".format(
+                remote_path=chain_snapshot.remote_base_path))
+        manifest_data = repository.load_metadata(chain_snapshot.metadata["manifest"]["path"])
+        if manifest_data is None:
+            raise S3DownloadError("Snapshot manifest not found - {remote_path}".format(
+                remote_path=chain_snapshot.metadata["manifest"]["path"]))
+        return chain_snapshot._replace(entries=list(SnapshotManifest.parse(manifest_data)))
+
+    @staticmethod
+    def _snapshot_type(chain_snapshot):
+        return chain_snapshot.remote_base_path.split('/')[-1]
+
+    @staticmethod
+    def snapshot_time(chain_snapshot):
+        return parse_snapshot_time(chain_snapshot.metadata.get("snapshot_time") or
+                                   chain_snapshot.metadata["snapshot_date"])
+
+    @property
+    def snapshots(self):
+        return self._snapshots
+
+    def files(self):
+        """
+        Every file of the chain by (keyspace, table, file name) with the snapshot holding it, later snapshots win.
+        """
+        files = dict()
+        for chain_snapshot in self._snapshots:
+            for entry in chain_snapshot.entries:
+                files[(entry["keyspace"], entry["table"], entry["name"])] = (chain_snapshot, entry)
+        return files
+
+    def keyspaces(self):
+        keyspaces = dict()
+        for chain_snapshot in self._snapshots:
+            for keyspace, tables in chain_snapshot.metadata["keyspaces"].items():
+                keyspace_tables = keyspaces.setdefault(keyspace, list())
+                keyspace_tables.extend(table for table in tables if table not in keyspace_tables)
+        return keyspaces
+
+    def live_sstables(self):
+        """
+        Files of every table live on the node when the last snapshot of the chain was taken, by keyspace and table,
+        as far as they were recorded. A plain full snapshot holds exactly its live files.
+        """
+        last_snapshot = self._snapshots[-1]
+        if last_snapshot.metadata["snapshot_type"] == "full" and not last_snapshot.metadata.get("consolidated_from"):
+            live_sstables = dict()
+            for entry in last_snapshot.entries:
+                live_sstables.setdefault(entry["keyspace"], dict()).setdefault(entry["table"], list()).append(
+                    entry["name"])
+            return live_sstables
+        return last_snapshot.metadata.get("live_sstables") or dict()
@@ -0,0 +1,56 @@
+import os
+import logging
+import threading
+from metrics import SnapshotMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotCleaner(object):
+    """
+    Removes the hardlinks of a full snapshot while it is uploaded.
+
+    Every file is unlinked once its object is confirmed stored - uploaded, found in the dedup index or uploaded as
+    part of a bundle - and every snapshot directory of a table is removed once all of its files are gone, so
+    compacted SSTables are no longer pinned for the rest of the run. `nodetool clearsnapshot` still runs at the end
+    for whatever is left behind.
+    """
+
+    def __init__(self, metrics=None):
+        self._metrics = metrics if metrics is not None else SnapshotMetrics()
+        self._pending_files = dict()
+        self._lock = threading.Lock()
+
+    def track(self, sstables):
+        """
+        Registers the crawled files of a table, before any of them is handed to the uploader.
+        """
+        with self._lock:
+            for sstable in sstables:
+                table_snapshot_path = os.path.dirname(sstable.path)
+                self._pending_files[table_snapshot_path] = self._pending_files.get(table_snapshot_path, 0) + 1
+
+    def release(self, sstables):
+        for sstable in sstables:
+            try:
+                os.unlink(sstable.path)
+                self._metrics.increment('bytes_released', sstable.size)
+            except OSError as e:
+                logger.warning("Failed to remove snapshot file {sstable} - {error}".format(sstable=sstable.path,
+                                                                                        error=e))
+            table_snapshot_path = os.path.dirname(sstable.path)
+            with self._lock:
+                self._pending_files[table_snapshot_path] -= 1
+                table_released = self._pending_files[table_snapshot_path] == 0
+            if table_released:
+                self._remove_table_snapshot(table_snapshot_path)
+
+    @staticmethod
+    def _remove_table_snapshot(table_snapshot_path):
+        try:
+            os.rmdir(table_snapshot_path)
+            logger.debug("Removed table snapshot - {path}".format(path=table_snapshot_path))
+        except OSError as e:
+            # Secondary index directories aren't uploaded, they are left to clearsnapshot
+            logger.debug("Table snapshot {path} is left for clearsnapshot - {error}".format(path=table_snapshot_path,
+                                                                                         error=e))
@@ -0,0 +1,113 @@
+import os
+import json
+import logging
+import collections
+import concurrent.futures
+from constants import (SNAPSHOT_METADATA_FILE, SNAPSHOT_MANIFEST_FILE, SUCCESS_FIELD_METADATA)
+from apollo_exceptions import SnapshotConsolidationError
+from snapshot_chain import SnapshotChain
+from snapshot_metadata import SnapshotMetadata
+from utils import (parse_snapshot_time, format_size)
+
+logger = logging.getLogger(__name__)
+
+# Stands in for the Cassandra handler a snapshot's metadata is usually built from
+ConsolidatedNode = collections.namedtuple('ConsolidatedNode', ['node', 'snapshot_type', 'tables_to_snapshot'])
+
+
+class SnapshotConsolidator(object):
+    """
+    Builds a synthetic full snapshot of a node from its latest full snapshot and the incremental snapshots taken
+    since, without reading anything from the node.
+
+    Files are merged by keyspace, table and file name, later snapshots win. Objects of the source snapshots are
+    copied server side under the new snapshot, so it doesn't depend on the snapshots it was built from, while dedup
+    objects are shared by design and referenced where they are. Copies already made by an interrupted run are found
+    with a HEAD request and not made again. A full snapshot already stored under the consolidation date is replaced
+    only when it was consolidated itself.
+    """
+
+    def __init__(self, repository, node, copy_workers=1):
+        self._repository = repository
+        self._node = node
+        self._copy_workers = copy_workers
+
+    def consolidate(self, snapshot_date):
+        target_base_path = os.path.join(snapshot_date, self._node, "full")
+        target_metadata = self._repository.load_metadata(os.path.join(target_base_path, SNAPSHOT_METADATA_FILE))
+        if target_metadata is not None and not json.loads(target_metadata).get("consolidated_from"):
+            raise SnapshotConsolidationError("{remote_path} holds a full snapshot taken from the node, it isn't "
+                                             "replaced by a consolidation".format(remote_path=target_base_path))
+        # A full snapshot of the consolidation date itself is then an earlier consolidation, it is built again
+        chain = SnapshotChain.load(self._repository, self._node, parse_snapshot_time(snapshot_date),
+                                   skip_full_date=snapshot_date)
+        sources = chain.snapshots
+        compressions = set(source.metadata.get("compression") for source in sources)
+        if len(compressions) > 1:
+            raise SnapshotConsolidationError("Snapshots to consolidate are stored with different compression - "
+                                             "{codecs}".format(codecs=', '.join(str(codec) for codec in compressions)))
+        logger.info("Consolidating {sources} into {remote_path}".format(
+            sources=', '.join(source.remote_base_path for source in sources), remote_path=target_base_path))
+
+        entries = dict((file_key, (source.remote_base_path, entry))
+                       for file_key, (source, entry) in chain.files().items())
+        copies, stored_objects = dict(), dict()
+        for source_base_path, entry in entries.values():
+            remote_path = entry["remote_path"]
+            if remote_path.startswith(source_base_path + '/'):
+                copies[remote_path] = target_base_path + remote_path[len(source_base_path):]
+            elif "object_size" in entry:
+                stored_objects[remote_path] = (entry["object_size"], entry["etag"])
+        stored_objects.update(self._copy_objects(copies))
+
+        metadata = SnapshotMetadata(ConsolidatedNode(self._node, "full", chain.keyspaces()), self._repository,
+                                    snapshot_date=snapshot_date)
+        # Holds the node as it was when the last snapshot it is built from was taken
+        metadata.snapshot_time = sources[-1].metadata.get("snapshot_time")
+        metadata.compression = compressions.pop()
+        metadata.consolidated_from = [source.remote_base_path for source in sources]
+        metadata.live_sstables = chain.live_sstables() or None
+        for _, entry in sorted(entries.values(), key=lambda source_entry: source_entry[1]["remote_path"]):
+            remote_path = copies.get(entry["remote_path"], entry["remote_path"])
+            if entry.get("offset") is not None:
+                metadata.add_bundled_sstable(entry["keyspace"], entry["table"], entry["name"], remote_path,
+                                             entry["offset"], entry["size"])
+            else:
+                metadata.add_sstable(entry["keyspace"], entry["table"], entry["name"], remote_path, entry["size"])
+
+        manifest_remote_path = os.path.join(target_base_path, SNAPSHOT_MANIFEST_FILE)
+        manifest_data, manifest_index = metadata.manifest.serialize(stored_objects)
+        self._repository.save_metadata(manifest_data, manifest_remote_path)
+        metadata.set_manifest_location(manifest_remote_path, manifest_index)
+        metadata.status = SUCCESS_FIELD_METADATA
+        self._repository.save_metadata(metadata.json(), os.path.join(target_base_path, SNAPSHOT_METADATA_FILE))
+        logger.info("Consolidated {files} files into {remote_path}".format(files=len(entries),
+                                                                          remote_path=target_base_path))
+        return metadata
+
+    def _copy_objects(self, copies):
+        executor = concurrent.futures.ThreadPoolExecutor(self._copy_workers)
+        try:
+            source_paths = sorted(copies)
+            copied_objects = list(executor.map(lambda source_path: self._copy_object(source_path,
+                                                                                     copies[source_path]),
+                                               source_paths))
+        finally:
+            executor.shutdown()
+        copied_count = sum(1 for _, copied in copied_objects if copied)
+        copied_size = sum(stored_object[0] for stored_object, copied in copied_objects if copied)
+        logger.info("Copied {copied} of {total} objects, {size} - the rest were copied by an earlier run".format(
+            copied=copied_count, total=len(copied_objects), size=format_size(copied_size)))
+        return dict((copies[source_path], stored_object)
+                    for source_path, (stored_object, _) in zip(source_paths, copied_objects))
+
+    def _copy_object(self, source_path, target_path):
+        source_object = self._repository.head_object(source_path)
+        if source_object is None:
+            raise SnapshotConsolidationError("Object is missing from the repository - {remote_path}".format(
+                remote_path=source_path))
+        target_object = self._repository.head_object(target_path)
+        if target_object is not None and target_object[0] == source_object[0]:
+            return target_object, False
+        logger.debug("Copying {source} to {target}".format(source=source_path, target=target_path))
+        return self._repository.copy_object(source_path, target_path, source_object[0]), True
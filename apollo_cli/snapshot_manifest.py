@@ -0,0 +1,50 @@
+import io
+import gzip
+import json
+
+
+class SnapshotManifest(object):
+    """
+    Per-file listing of a snapshot stored next to its metadata as gzipped JSON lines.
+
+    Every table is written as a separate gzip member, a concatenation of gzip members is a valid gzip stream, so the
+    byte range of each table is recorded in the index kept in the snapshot metadata and a single table can be read
+    with a ranged GET without downloading the whole manifest.
+    """
+
+    def __init__(self):
+        self._tables = dict()
+
+    def add(self, keyspace, table, sstable_name, remote_path, size, offset=None):
+        entry = {"keyspace": keyspace, "table": table, "name": sstable_name, "remote_path": remote_path, "size": size}
+        if offset is not None:
+            entry["offset"] = offset
+        self._tables.setdefault((keyspace, table), list()).append(entry)
+
+    def serialize(self, stored_objects=None):
+        """
+        Returns the manifest and its per-table index, entries are completed with the size and ETag of the object
+        holding them when `stored_objects` knows it.
+        """
+        stored_objects = stored_objects or dict()
+        manifest_data, index = io.BytesIO(), dict()
+        for keyspace, table in sorted(self._tables):
+            entries = sorted(self._tables[(keyspace, table)], key=lambda entry: entry["name"])
+            offset = manifest_data.tell()
+            with gzip.GzipFile(fileobj=manifest_data, mode='wb', mtime=0) as table_member:
+                for entry in entries:
+                    if entry["remote_path"] in stored_objects:
+                        entry = dict(entry)
+                        entry["object_size"], entry["etag"] = stored_objects[entry["remote_path"]]
+                    table_member.write((json.dumps(entry, sort_keys=True) + '\n').encode('utf-8'))
+            index.setdefault(keyspace, dict())[table] = {"offset": offset, "length": manifest_data.tell() - offset,
+                                                        "files": len(entries),
+                                                        "size": sum(entry["size"] for entry in entries)}
+        return manifest_data.getvalue(), index
+
+    @staticmethod
+    def parse(manifest_data):
+        with gzip.GzipFile(fileobj=io.BytesIO(manifest_data), mode='rb') as manifest_file:
+            for line in manifest_file:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
@@ -1,21 +1,41 @@
 import json
-from utils import (generate_snapshot_timestamp, extract_keyspace_map)
+from utils import (generate_snapshot_timestamp, generate_snapshot_time, generate_snapshot_id)
 from constants import INITIAL_FIELD_METADATA
+from snapshot_manifest import SnapshotManifest
 
 
 class SnapshotMetadata(object):
-    def __init__(self, cassandra_object, s3_repo_object, snapshot_status=INITIAL_FIELD_METADATA):
+    def __init__(self, cassandra_object, s3_repo_object, snapshot_status=INITIAL_FIELD_METADATA, snapshot_date=None):
         self._snapshot_type = cassandra_object.snapshot_type
-        self._snapshot_date = generate_snapshot_timestamp()
+        # Incremental snapshots may run several times a day and each holds only the files it ships, every run gets
+        # its own snapshot ID rather than sharing the day's prefix
+        self._snapshot_date = snapshot_date or (generate_snapshot_id() if self._snapshot_type == "incremental"
+                                                else generate_snapshot_timestamp())
+        self._snapshot_time = generate_snapshot_time()
         self._node = cassandra_object.node
-        self._keyspace_map = extract_keyspace_map(cassandra_object.sstables_to_snapshot)
+        self._keyspace_map = cassandra_object.tables_to_snapshot
         self._bucket = s3_repo_object.bucket
         self._status = snapshot_status
+        self._sstables = dict()
+        self._bundled_sstables = dict()
+        self._manifest = SnapshotManifest()
+        self._manifest_location = None
+        self._compression = None
+        self._consolidated_from = None
+        self._live_sstables = None
 
     @property
     def snapshot_date(self):
         return self._snapshot_date
 
+    @property
+    def snapshot_time(self):
+        return self._snapshot_time
+
+    @snapshot_time.setter
+    def snapshot_time(self, value):
+        self._snapshot_time = value
+
     @property
     def status(self):
         return self._status
@@ -24,12 +44,67 @@ class SnapshotMetadata(object):
     def status(self, value):
         self._status = value
 
+    @property
+    def sstables(self):
+        return self._sstables
+
+    def add_sstable(self, keyspace, table, sstable_name, remote_path, size):
+        self._sstables.setdefault(keyspace, dict()).setdefault(table, dict())[sstable_name] = remote_path
+        self._manifest.add(keyspace, table, sstable_name, remote_path, size)
+
+    @property
+    def bundled_sstables(self):
+        return self._bundled_sstables
+
+    def add_bundled_sstable(self, keyspace, table, sstable_name, bundle_remote_path, offset, length):
+        self._bundled_sstables.setdefault(keyspace, dict()).setdefault(table, dict())[sstable_name] = [
+            bundle_remote_path, offset, length]
+        self._manifest.add(keyspace, table, sstable_name, bundle_remote_path, length, offset)
+
+    @property
+    def manifest(self):
+        return self._manifest
+
+    def set_manifest_location(self, remote_path, index):
+        self._manifest_location = {"path": remote_path, "tables": index}
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @compression.setter
+    def compression(self, value):
+        self._compression = value
+
+    @property
+    def consolidated_from(self):
+        return self._consolidated_from
+
+    @consolidated_from.setter
+    def consolidated_from(self, value):
+        self._consolidated_from = value
+
+    @property
+    def live_sstables(self):
+        return self._live_sstables
+
+    @live_sstables.setter
+    def live_sstables(self, value):
+        self._live_sstables = value
+
     def json(self):
         json_data = dict()
         json_data["snapshot_type"] = self._snapshot_type
         json_data["snapshot_date"] = self._snapshot_date
+        json_data["snapshot_time"] = self._snapshot_time
         json_data["node"] = self._node
         json_data["keyspaces"] = self._keyspace_map
+        json_data["sstables"] = self._sstables
+        json_data["bundled_sstables"] = self._bundled_sstables
+        json_data["manifest"] = self._manifest_location
+        json_data["compression"] = self._compression
+        json_data["consolidated_from"] = self._consolidated_from
+        json_data["live_sstables"] = self._live_sstables
         json_data["status"] = self._status
 
         return json.dumps(json_data)
@@ -0,0 +1,236 @@
+import os
+import json
+import logging
+import collections
+import concurrent.futures
+from constants import (SNAPSHOT_METADATA_FILE, SUCCESS_FIELD_METADATA, SNAPSHOT_DATE_FORMAT, S3_MAX_DELETE_KEYS,
+                       CLUSTER_MANIFEST_FILE, SNAPSHOT_TYPES)
+from apollo_exceptions import SnapshotChainError
+from snapshot_chain import (SnapshotChain, ChainSnapshot)
+from sstable_dedup import SSTableDedupIndex
+from utils import (list_snapshot_dates, parse_snapshot_time, format_size)
+
+logger = logging.getLogger(__name__)
+
+PlannedSnapshot = collections.namedtuple('PlannedSnapshot', ['remote_base_path', 'status', 'reason'])
+
+
+class PrunePlan(object):
+    """
+    Snapshots kept and pruned by a retention, with the objects to delete.
+    """
+
+    def __init__(self):
+        self._kept = list()
+        self._pruned = list()
+        self._objects = dict()
+        self._dedup_objects = dict()
+
+    @property
+    def kept(self):
+        return sorted(self._kept)
+
+    @property
+    def pruned(self):
+        return sorted(self._pruned)
+
+    def keep(self, remote_base_path, metadata, reason):
+        self._kept.append(PlannedSnapshot(remote_base_path, metadata["status"] if metadata else None, reason))
+
+    def prune(self, remote_base_path, metadata, reason):
+        self._pruned.append(PlannedSnapshot(remote_base_path, metadata["status"] if metadata else None, reason))
+
+    @property
+    def objects(self):
+        """
+        {remote path: size} of every object of the pruned snapshots.
+        """
+        return self._objects
+
+    def add_objects(self, objects):
+        self._objects.update(objects)
+
+    @property
+    def dedup_objects(self):
+        """
+        {node: {remote path: size}} of the dedup objects no kept snapshot references.
+        """
+        return self._dedup_objects
+
+    def add_dedup_objects(self, node, objects):
+        self._dedup_objects[node] = objects
+
+    @property
+    def size(self):
+        return sum(self._objects.values()) + sum(size or 0 for objects in self._dedup_objects.values()
+                                                 for size in objects.values())
+
+
+class SnapshotPruner(object):
+    """
+    Deletes the snapshots of a repository which fall out of a daily and weekly retention.
+
+    Per node, the latest `keep_daily` days holding a successful snapshot are kept, and the latest such day of each of
+    the latest `keep_weekly` weeks - snapshots named by a snapshot ID count for the day of the ID. A kept day stays
+    restorable as of its end, so the full snapshot and the incremental snapshots its chain is built from are kept as
+    well. Unfinished snapshots may still be running, they are pruned only when older than every kept day. The cluster
+    manifest of a snapshot ID goes with the last of its snapshots.
+
+    Prefixes are listed and metadata loaded on a thread pool. Objects are deleted in batches of up to 1000 keys, the
+    metadata of the pruned snapshots first, so a snapshot partially deleted by an interrupted run is never taken for a
+    successful one and the run can simply be repeated.
+    """
+
+    def __init__(self, repository, workers=1):
+        self._repository = repository
+        self._workers = workers
+
+    def plan(self, keep_daily, keep_weekly, node=None, gc_dedup=False):
+        prune_plan = PrunePlan()
+        node_snapshots = self._load_snapshots(node)
+        for snapshot_node in sorted(node_snapshots):
+            self._plan_node(prune_plan, snapshot_node, node_snapshots[snapshot_node], keep_daily, keep_weekly)
+            if gc_dedup:
+                self._plan_dedup(prune_plan, snapshot_node, node_snapshots[snapshot_node])
+
+        pruned_paths = [planned_snapshot.remote_base_path for planned_snapshot in prune_plan.pruned]
+        for objects in self._map(lambda remote_base_path: self._repository.list_objects(remote_base_path + '/'),
+                                 pruned_paths):
+            prune_plan.add_objects(objects)
+        if node is None:
+            kept_dates = set(planned_snapshot.remote_base_path.split('/')[0] for planned_snapshot in prune_plan.kept)
+            manifest_paths = [os.path.join(snapshot_date, CLUSTER_MANIFEST_FILE) for snapshot_date in
+                              sorted(set(remote_base_path.split('/')[0] for remote_base_path in pruned_paths))
+                              if snapshot_date not in kept_dates]
+            for manifest_path, stored_object in zip(manifest_paths, self._map(self._repository.head_object,
+                                                                              manifest_paths)):
+                if stored_object is not None:
+                    prune_plan.add_objects({manifest_path: stored_object[0]})
+        logger.info("Pruning {snapshots} snapshots - {objects} objects, {size}".format(
+            snapshots=len(pruned_paths), objects=len(prune_plan.objects), size=format_size(prune_plan.size)))
+        return prune_plan
+
+    def prune(self, prune_plan):
+        metadata_paths = [remote_path for remote_path in prune_plan.objects
+                          if os.path.basename(remote_path) == SNAPSHOT_METADATA_FILE]
+        self._delete(metadata_paths)
+        self._delete(set(prune_plan.objects) - set(metadata_paths))
+        for node, dedup_objects in sorted(prune_plan.dedup_objects.items()):
+            # Dropped from the index before they are deleted, so a later snapshot uploads them again rather than
+            # referencing a missing object
+            dedup_index = SSTableDedupIndex(self._repository, node)
+            dedup_index.forget(dedup_objects)
+            dedup_index.save()
+            self._delete(dedup_objects)
+        logger.info("Pruned {snapshots} snapshots".format(snapshots=len(prune_plan.pruned)))
+
+    def _load_snapshots(self, node):
+        """
+        {node: {remote base path: metadata}} of every snapshot, metadata is None when it was never written.
+        """
+        snapshot_paths = [remote_base_path for remote_base_paths in self._map(
+            lambda snapshot_date: self._list_snapshots(snapshot_date, node), list_snapshot_dates(self._repository))
+            for remote_base_path in remote_base_paths]
+        node_snapshots = dict()
+        for remote_base_path, metadata in zip(snapshot_paths, self._map(self._load_metadata, snapshot_paths)):
+            node_snapshots.setdefault(remote_base_path.split('/')[1], dict())[remote_base_path] = metadata
+        return node_snapshots
+
+    def _list_snapshots(self, snapshot_date, node):
+        node_prefixes = ([os.path.join(snapshot_date, node) + '/'] if node is not None
+                         else self._repository.list_prefixes(snapshot_date + '/'))
+        return [snapshot_prefix.rstrip('/') for node_prefix in node_prefixes
+                for snapshot_prefix in self._repository.list_prefixes(node_prefix)
+                if snapshot_prefix.rstrip('/').split('/')[-1] in SNAPSHOT_TYPES]
+
+    def _load_metadata(self, remote_base_path):
+        metadata = self._repository.load_metadata(os.path.join(remote_base_path, SNAPSHOT_METADATA_FILE))
+        return json.loads(metadata) if metadata is not None else None
+
+    @staticmethod
+    def _plan_node(prune_plan, node, snapshots, keep_daily, keep_weekly):
+        successful_snapshots = dict((remote_base_path, metadata) for remote_base_path, metadata in snapshots.items()
+                                    if metadata is not None and metadata["status"] == SUCCESS_FIELD_METADATA)
+        snapshot_dates = sorted(set(remote_base_path.split('/')[0] for remote_base_path in successful_snapshots))
+        snapshot_days = sorted(set(SnapshotPruner._snapshot_day(snapshot_date) for snapshot_date in snapshot_dates))
+
+        kept_days, kept_weeks = dict(), list()
+        for snapshot_day in reversed(snapshot_days[-keep_daily:] if keep_daily > 0 else list()):
+            kept_days[snapshot_day] = "daily"
+        for snapshot_day in reversed(snapshot_days):
+            week = parse_snapshot_time(snapshot_day).isocalendar()[:2]
+            if week in kept_weeks:
+                continue
+            if len(kept_weeks) >= keep_weekly:
+                break
+            kept_weeks.append(week)
+            kept_days.setdefault(snapshot_day, "weekly")
+
+        def load_snapshot(snapshot_date, snapshot_type):
+            remote_base_path = os.path.join(snapshot_date, node, snapshot_type)
+            if remote_base_path not in successful_snapshots:
+                return None
+            return ChainSnapshot(remote_base_path, successful_snapshots[remote_base_path], None)
+
+        kept_snapshots = dict()
+        for kept_day, reason in sorted(kept_days.items()):
+            for remote_base_path in successful_snapshots:
+                if SnapshotPruner._snapshot_day(remote_base_path) == kept_day:
+                    kept_snapshots[remote_base_path] = reason
+            try:
+                chain = SnapshotChain.select(snapshot_dates, load_snapshot, node, parse_snapshot_time(kept_day))
+                chain_paths = [chain_snapshot.remote_base_path for chain_snapshot in chain.snapshots]
+            except SnapshotChainError:
+                # Incremental snapshots taken before any full snapshot are all there is to restore from
+                chain_paths = [remote_base_path for remote_base_path in successful_snapshots
+                               if SnapshotPruner._snapshot_day(remote_base_path) <= kept_day]
+            for remote_base_path in chain_paths:
+                kept_snapshots.setdefault(remote_base_path, "chain")
+
+        oldest_kept_day = min(kept_days) if kept_days else None
+        for remote_base_path, metadata in sorted(snapshots.items()):
+            if remote_base_path in kept_snapshots:
+                prune_plan.keep(remote_base_path, metadata, kept_snapshots[remote_base_path])
+            elif remote_base_path in successful_snapshots:
+                prune_plan.prune(remote_base_path, metadata, "expired")
+            elif oldest_kept_day is None or SnapshotPruner._snapshot_day(remote_base_path) >= oldest_kept_day:
+                prune_plan.keep(remote_base_path, metadata, "unfinished")
+            else:
+                prune_plan.prune(remote_base_path, metadata, "unfinished")
+
+    @staticmethod
+    def _snapshot_day(remote_base_path):
+        return parse_snapshot_time(remote_base_path.split('/')[0]).strftime(SNAPSHOT_DATE_FORMAT)
+
+    def _plan_dedup(self, prune_plan, node, snapshots):
+        kept_paths = set(planned_snapshot.remote_base_path for planned_snapshot in prune_plan.kept
+                         if planned_snapshot.remote_base_path.split('/')[1] == node)
+        if any(snapshots[remote_base_path] is None or
+               snapshots[remote_base_path]["status"] != SUCCESS_FIELD_METADATA for remote_base_path in kept_paths):
+            logger.warning("Node {node} has unfinished snapshots, its dedup objects are left as they are".format(
+                node=node))
+            return
+        referenced_paths = set(remote_path for remote_base_path in kept_paths
+                               for tables in snapshots[remote_base_path].get("sstables", dict()).values()
+                               for sstables in tables.values() for remote_path in sstables.values())
+        # Only objects of the index are collected, objects being uploaded by a running snapshot aren't in it yet
+        dedup_objects = dict((remote_path, size) for remote_path, size in
+                             SSTableDedupIndex(self._repository, node).stored_objects().items()
+                             if remote_path not in referenced_paths)
+        if dedup_objects:
+            prune_plan.add_dedup_objects(node, dedup_objects)
+
+    def _delete(self, remote_paths):
+        remote_paths = sorted(remote_paths)
+        batches = [remote_paths[start:start + S3_MAX_DELETE_KEYS]
+                   for start in range(0, len(remote_paths), S3_MAX_DELETE_KEYS)]
+        self._map(self._repository.delete_objects, batches)
+        logger.info("Deleted {objects} objects in {batches} requests".format(objects=len(remote_paths),
+                                                                            batches=len(batches)))
+
+    def _map(self, function, items):
+        executor = concurrent.futures.ThreadPoolExecutor(self._workers)
+        try:
+            return list(executor.map(function, items))
+        finally:
+            executor.shutdown()
@@ -1,12 +1,16 @@
-import threading
 import boto3
 import os
-import sys
+import base64
+import hashlib
 import logging
-from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from botocore.exceptions import ClientError
 from abc import (ABCMeta, abstractmethod)
-from apollo_exceptions import S3UploadError
+from apollo_exceptions import (S3UploadError, S3DownloadError, S3DeleteError)
+from constants import (DOWNLOAD_BUFFER_SIZE, S3_MAX_COPY_OBJECT_SIZE, S3_COPY_PART_SIZE, S3_MAX_PARTS,
+                       S3_MAX_DELETE_KEYS)
+from compression import StreamDecompressor
+from metrics import SnapshotMetrics
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +18,9 @@ logger = logging.getLogger(__name__)
 class RepositoryTemplate(object):
     __metaclass__ = ABCMeta
 
+    # Repositories that can store a local file as is implement copy_file(local_file_path, s3_key_path, throttle=None)
+    local_file_copy = False
+
     @abstractmethod
     def upload(self, *args, **kwargs):
         pass
@@ -24,8 +31,8 @@ class RepositoryTemplate(object):
 
 
 class S3Handler(RepositoryTemplate):
-    def __init__(self, bucket_name, aws_access_key_id, aws_secret_key_id, ssl_no_verify, upload_chunksize,
-                 upload_concurrency, upload_workers, storage_class):
+    def __init__(self, bucket_name, aws_access_key_id, aws_secret_key_id, ssl_no_verify, transfer_workers=1,
+                 storage_class='STANDARD', endpoint_url=None, metrics=None):
         self._bucket_name = bucket_name
         self._aws_access_key_id = aws_access_key_id
         self._aws_secret_key_id = aws_secret_key_id
@@ -33,40 +40,186 @@ class S3Handler(RepositoryTemplate):
             aws_access_key_id=self._aws_access_key_id,
             aws_secret_access_key=self._aws_secret_key_id
         )
-        self._upload_chunksize = self.convert_kb_to_byte(upload_chunksize)
-        self._upload_workers = upload_workers
-        self._s3_conn = self._session.resource('s3', verify=not ssl_no_verify,
-                                               config=Config(max_pool_connections=self._upload_workers * 15))
-        self._upload_concurrency = upload_concurrency
-        self._storage_class =  storage_class
+        self._transfer_workers = transfer_workers
+        # One connection per transfer worker plus one for metadata requests issued by the main thread
+        config = Config(max_pool_connections=self._transfer_workers + 1)
+        if endpoint_url is not None:
+            # S3 compatible stores seldom resolve virtual hosted bucket names
+            config = config.merge(Config(s3={'addressing_style': 'path'}))
+        self._s3_conn = self._session.resource('s3', verify=not ssl_no_verify, endpoint_url=endpoint_url,
+                                               config=config)
+        self._storage_class = storage_class
+        self._metrics = metrics if metrics is not None else SnapshotMetrics()
 
     @property
     def bucket(self):
         return self._bucket_name
 
     def upload(self, local_file_path, s3_key_path, verbose=True):
-        if self._upload_concurrency > 1:
-            threaded_upload = True
-        else:
-            threaded_upload = False
+        logger.debug("Uploading - {sstable}".format(sstable=local_file_path))
+        with open(local_file_path, 'rb') as local_file:
+            self.put_object(s3_key_path, local_file)
+        if verbose:
+            logger.info("Uploaded {sstable} - {size} bytes".format(sstable=local_file_path,
+                                                                   size=os.path.getsize(local_file_path)))
 
-        config = TransferConfig(multipart_threshold=self._upload_chunksize, max_concurrency=self._upload_concurrency,
-                                multipart_chunksize=self._upload_chunksize, use_threads=threaded_upload)
+    def _record_response(self, response):
+        self._metrics.increment('requests')
+        retries = response.get('ResponseMetadata', dict()).get('RetryAttempts', 0)
+        if retries:
+            self._metrics.increment('retries', retries)
+        return response
 
-        logger.debug("Uploading - {sstable}".format(sstable=local_file_path))
+    def put_object(self, s3_key_path, body):
+        try:
+            if isinstance(body, bytes):
+                response = self._s3_conn.meta.client.put_object(Bucket=self._bucket_name, Key=s3_key_path, Body=body,
+                                                                ContentMD5=self.content_md5(body),
+                                                                StorageClass=self._storage_class)
+            else:
+                response = self._s3_conn.meta.client.put_object(Bucket=self._bucket_name, Key=s3_key_path, Body=body,
+                                                                StorageClass=self._storage_class)
+            return self._record_response(response)['ETag']
+        except Exception as e:
+            raise S3UploadError(e)
 
-        if verbose:
-            self._s3_conn.meta.client.upload_file(local_file_path, self._bucket_name, s3_key_path,
-                                                  Config=config,
-                                                  Callback=_UploadProgressPercentage(local_file_path),
-                                                  ExtraArgs={'StorageClass': self._storage_class}
-                                                  )
-        else:
-            self._s3_conn.meta.client.upload_file(local_file_path, self._bucket_name, s3_key_path, Config=config,
-                                                  ExtraArgs={'StorageClass': self._storage_class})
-
-    def download(self):
-        pass
+    def create_multipart_upload(self, s3_key_path):
+        try:
+            response = self._s3_conn.meta.client.create_multipart_upload(Bucket=self._bucket_name, Key=s3_key_path,
+                                                                         StorageClass=self._storage_class)
+            return self._record_response(response)['UploadId']
+        except Exception as e:
+            raise S3UploadError(e)
+
+    def upload_part(self, s3_key_path, upload_id, part_number, body):
+        try:
+            response = self._s3_conn.meta.client.upload_part(Bucket=self._bucket_name, Key=s3_key_path,
+                                                             UploadId=upload_id, PartNumber=part_number, Body=body,
+                                                             ContentMD5=self.content_md5(body))
+            return self._record_response(response)['ETag']
+        except Exception as e:
+            raise S3UploadError(e)
+
+    def complete_multipart_upload(self, s3_key_path, upload_id, part_etags):
+        parts = [{'PartNumber': part_number, 'ETag': part_etags[part_number]} for part_number in sorted(part_etags)]
+        try:
+            response = self._s3_conn.meta.client.complete_multipart_upload(Bucket=self._bucket_name, Key=s3_key_path,
+                                                                           UploadId=upload_id,
+                                                                           MultipartUpload={'Parts': parts})
+            return self._record_response(response)['ETag']
+        except Exception as e:
+            raise S3UploadError(e)
+
+    def abort_multipart_upload(self, s3_key_path, upload_id):
+        try:
+            self._s3_conn.meta.client.abort_multipart_upload(Bucket=self._bucket_name, Key=s3_key_path,
+                                                             UploadId=upload_id)
+        except Exception as e:
+            logger.warning("Failed to abort multipart upload of {s3_key_path} - {error}".format(
+                s3_key_path=s3_key_path, error=e))
+
+    def copy_object(self, source_key_path, s3_key_path, size):
+        """
+        Copies an object of the bucket server side, with UploadPartCopy above the CopyObject size limit. Returns the
+        size and ETag of the copy.
+        """
+        if size <= S3_MAX_COPY_OBJECT_SIZE:
+            try:
+                response = self._s3_conn.meta.client.copy_object(
+                    Bucket=self._bucket_name, Key=s3_key_path,
+                    CopySource={'Bucket': self._bucket_name, 'Key': source_key_path},
+                    StorageClass=self._storage_class)
+                return size, self._record_response(response)['CopyObjectResult']['ETag']
+            except Exception as e:
+                raise S3UploadError(e)
+
+        part_size = max(S3_COPY_PART_SIZE, -(-size // S3_MAX_PARTS))
+        upload_id = self.create_multipart_upload(s3_key_path)
+        part_etags = dict()
+        try:
+            for part_number, start in enumerate(range(0, size, part_size), 1):
+                response = self._s3_conn.meta.client.upload_part_copy(
+                    Bucket=self._bucket_name, Key=s3_key_path, UploadId=upload_id, PartNumber=part_number,
+                    CopySource={'Bucket': self._bucket_name, 'Key': source_key_path},
+                    CopySourceRange='bytes={start}-{end}'.format(start=start, end=min(start + part_size, size) - 1))
+                part_etags[part_number] = self._record_response(response)['CopyPartResult']['ETag']
+            return size, self.complete_multipart_upload(s3_key_path, upload_id, part_etags)
+        except Exception as e:
+            self.abort_multipart_upload(s3_key_path, upload_id)
+            raise S3UploadError(e)
+
+    def download(self, s3_key_path, local_file_path, byte_range=None, compression=None, file_offset=None):
+        logger.debug("Downloading - {sstable} {byte_range}".format(sstable=s3_key_path, byte_range=byte_range or ''))
+        try:
+            if byte_range is None:
+                response = self._s3_conn.meta.client.get_object(Bucket=self._bucket_name, Key=s3_key_path)
+                file_mode, offset = 'wb', 0
+            else:
+                response = self._s3_conn.meta.client.get_object(
+                    Bucket=self._bucket_name, Key=s3_key_path,
+                    Range='bytes={start}-{end}'.format(start=byte_range[0], end=byte_range[1]))
+                file_mode, offset = 'r+b', byte_range[0] if file_offset is None else file_offset
+            self._record_response(response)
+
+            with open(local_file_path, file_mode) as local_file:
+                local_file.seek(offset)
+                writer = StreamDecompressor(compression, local_file) if compression is not None else local_file
+                for chunk in iter(lambda: response['Body'].read(DOWNLOAD_BUFFER_SIZE), b''):
+                    writer.write(chunk)
+                if compression is not None:
+                    writer.finish()
+        except Exception as e:
+            raise S3DownloadError(e)
+
+    def list_objects(self, prefix):
+        objects = dict()
+        try:
+            paginator = self._s3_conn.meta.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self._bucket_name, Prefix=prefix):
+                for s3_object in page.get('Contents', list()):
+                    objects[s3_object['Key']] = s3_object['Size']
+        except Exception as e:
+            raise S3DownloadError(e)
+        return objects
+
+    def head_object(self, s3_key_path):
+        try:
+            response = self._record_response(
+                self._s3_conn.meta.client.head_object(Bucket=self._bucket_name, Key=s3_key_path))
+            return response['ContentLength'], response['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise S3DownloadError(e)
+
+    def list_prefixes(self, prefix):
+        prefixes = list()
+        try:
+            paginator = self._s3_conn.meta.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self._bucket_name, Prefix=prefix, Delimiter='/'):
+                for common_prefix in page.get('CommonPrefixes', list()):
+                    prefixes.append(common_prefix['Prefix'])
+        except Exception as e:
+            raise S3DownloadError(e)
+        return prefixes
+
+    def delete_objects(self, s3_key_paths):
+        """
+        Deletes up to 1000 objects with a single DeleteObjects request.
+        """
+        if len(s3_key_paths) > S3_MAX_DELETE_KEYS:
+            raise S3DeleteError("At most {limit} objects are deleted per request, got {count}".format(
+                limit=S3_MAX_DELETE_KEYS, count=len(s3_key_paths)))
+        try:
+            response = self._record_response(self._s3_conn.meta.client.delete_objects(
+                Bucket=self._bucket_name,
+                Delete={'Objects': [{'Key': s3_key_path} for s3_key_path in s3_key_paths], 'Quiet': True}))
+        except Exception as e:
+            raise S3DeleteError(e)
+        errors = response.get('Errors', list())
+        if errors:
+            raise S3DeleteError("Failed to delete {count} objects, {key} - {message}".format(
+                count=len(errors), key=errors[0]['Key'], message=errors[0].get('Message')))
 
     def save_metadata(self, metadata, remote_path):
         logger.info("Saving snapshot metadata to S3, remote path - {remote_path}".format(remote_path=remote_path))
@@ -81,26 +234,26 @@ class S3Handler(RepositoryTemplate):
         except Exception as e:
             raise S3UploadError(e)
 
+    def load_metadata(self, remote_path, byte_range=None):
+        logger.debug("Loading metadata from S3, remote path - {remote_path}".format(remote_path=remote_path))
+        try:
+            if byte_range is None:
+                response = self._s3_conn.meta.client.get_object(Bucket=self._bucket_name, Key=remote_path)
+            else:
+                response = self._s3_conn.meta.client.get_object(
+                    Bucket=self._bucket_name, Key=remote_path,
+                    Range='bytes={start}-{end}'.format(start=byte_range[0], end=byte_range[1]))
+            return response['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise S3DownloadError(e)
+
+    @staticmethod
+    def content_md5(data):
+        # Uploaded bodies are already in memory, S3 rejects them if they don't match the digest of the bytes read
+        return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
     @staticmethod
     def convert_kb_to_byte(num):
         return num * 1024
-
-
-class _UploadProgressPercentage(object):
-    def __init__(self, filename):
-        self._filename = filename
-        self._file_size = float(os.path.getsize(filename))
-        self._uploaded = 0
-        self._lock = threading.Lock()
-
-    def __call__(self, bytes_amount):
-        with self._lock:
-            self._uploaded += bytes_amount
-            percentage = (self._uploaded / self._file_size) * 100
-            sys.stdout.write(
-                "\r%s  %s bytes / %s bytes (%.2f%%)" % (
-                    self._filename, self._uploaded, self._file_size,
-                    percentage))
-            sys.stdout.write("\n")
-            sys.stdout.flush()
-
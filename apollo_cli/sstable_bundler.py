@@ -0,0 +1,70 @@
+import os
+import hashlib
+import functools
+import logging
+from constants import BUNDLE_REMOTE_DIRECTORY
+
+logger = logging.getLogger(__name__)
+
+
+class SSTableBundler(object):
+    """
+    Packs small SSTable components into bundle objects stored under <snapshot>/bundles/.
+
+    Components are appended to the open bundle until it reaches the bundle size, then the bundle is handed to the
+    transfer scheduler as a single PUT and the offset of every component is recorded in the snapshot metadata.
+    Bundles are named after the identity of their members, so a resumed run recognizes bundles it already uploaded.
+    Bundled components are stored uncompressed so restore can fetch each one with a plain byte range.
+    """
+
+    def __init__(self, metadata, transfer_scheduler, snapshot_remote_base_path, threshold, bundle_size, cleaner=None):
+        self._metadata = metadata
+        self._cleaner = cleaner
+        self._transfer_scheduler = transfer_scheduler
+        self._remote_base_path = os.path.join(snapshot_remote_base_path, BUNDLE_REMOTE_DIRECTORY)
+        self._threshold = threshold
+        self._bundle_size = bundle_size
+        self._members = list()
+        self._size = 0
+        self._bundles_count = 0
+        self._bundled_count = 0
+
+    def accepts(self, sstable):
+        return sstable.size < self._threshold
+
+    def add(self, sstable):
+        self._members.append(sstable)
+        self._size += sstable.size
+        if self._size >= self._bundle_size:
+            self._seal()
+
+    def close(self):
+        if self._members:
+            self._seal()
+        logger.info("Packed {sstables} sstables into {bundles} bundles".format(sstables=self._bundled_count,
+                                                                               bundles=self._bundles_count))
+
+    def _seal(self):
+        bundle_remote_path = os.path.join(self._remote_base_path, self._bundle_name(self._members))
+        offset = 0
+        for sstable in self._members:
+            self._metadata.add_bundled_sstable(sstable.keyspace, sstable.table, os.path.basename(sstable.path),
+                                               bundle_remote_path, offset, sstable.size)
+            offset += sstable.size
+        self._transfer_scheduler.submit_bundle(self._members, bundle_remote_path,
+                                               functools.partial(self._cleaner.release, self._members)
+                                               if self._cleaner is not None else None)
+
+        self._bundles_count += 1
+        self._bundled_count += len(self._members)
+        self._members, self._size = list(), 0
+
+    @staticmethod
+    def _bundle_name(members):
+        bundle_identity = hashlib.sha1()
+        for sstable in members:
+            for field in (sstable.path, str(sstable.size), str(int(sstable.mtime))):
+                # Paths are text on Python 3 and may keep undecodable bytes as surrogates
+                bundle_identity.update(field if isinstance(field, bytes) else field.encode('utf-8', 'surrogateescape'))
+                bundle_identity.update(b'\0')
+        return bundle_identity.hexdigest()
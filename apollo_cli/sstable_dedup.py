@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from constants import (DEDUP_REMOTE_DIRECTORY, DEDUP_INDEX_FILE, SSTABLE_DIGEST_COMPONENT)
+
+logger = logging.getLogger(__name__)
+
+
+class SSTableDedupIndex(object):
+    """
+    Per-node index of content-addressed SSTables already stored in the repository.
+
+    SSTables are immutable, so an SSTable is identified by its keyspace, table, file name (which carries the
+    generation), size and the checksum Cassandra wrote into the Digest component of its generation. Objects are
+    stored once under <node>/sstables/<keyspace>/<table>/<fingerprint>/<sstable> and snapshots reference them.
+    """
+
+    def __init__(self, repository, node):
+        self._repository = repository
+        self._node = node
+        self._remote_base_path = os.path.join(node, DEDUP_REMOTE_DIRECTORY)
+        self._index_remote_path = os.path.join(self._remote_base_path, DEDUP_INDEX_FILE)
+        self._stored_sstables = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        index = self._repository.load_metadata(self._index_remote_path)
+        if index is None:
+            logger.info("No dedup index found for node {node}, starting a new one".format(node=self._node))
+            return dict()
+        return json.loads(index)
+
+    def save(self):
+        with self._lock:
+            index = json.dumps(self._stored_sstables)
+        self._repository.save_metadata(index, self._index_remote_path)
+
+    def is_stored(self, remote_path):
+        with self._lock:
+            return remote_path in self._stored_sstables
+
+    def stored_object(self, remote_path):
+        with self._lock:
+            stored_sstable = self._stored_sstables.get(remote_path)
+        # Entries registered before ETags were tracked only hold the SSTable size
+        if not isinstance(stored_sstable, dict):
+            return None
+        return stored_sstable["object_size"], stored_sstable["etag"]
+
+    def register(self, uploaded_sstables, uploaded_objects):
+        with self._lock:
+            for remote_path, size in uploaded_sstables:
+                object_size, etag = uploaded_objects[remote_path]
+                self._stored_sstables[remote_path] = {"size": size, "object_size": object_size, "etag": etag}
+
+    def stored_objects(self):
+        """
+        Every object of the index with its size.
+        """
+        with self._lock:
+            # Entries registered before ETags were tracked only hold the SSTable size, objects weren't compressed
+            return dict((remote_path, stored_sstable["object_size"] if isinstance(stored_sstable, dict)
+                         else stored_sstable) for remote_path, stored_sstable in self._stored_sstables.items())
+
+    def forget(self, remote_paths):
+        with self._lock:
+            for remote_path in remote_paths:
+                self._stored_sstables.pop(remote_path, None)
+
+    def remote_paths(self, keyspace, table, sstables):
+        generation_digests = self._generation_digests(sstables)
+        remote_paths = dict()
+        for sstable in sstables:
+            fingerprint = self._fingerprint(keyspace, table, sstable,
+                                            generation_digests.get(self._generation_prefix(sstable.path)))
+            remote_paths[sstable.path] = os.path.join(self._remote_base_path, keyspace, table, fingerprint,
+                                                      os.path.basename(sstable.path))
+        return remote_paths
+
+    def _generation_digests(self, sstables):
+        generation_digests = dict()
+        for sstable in sstables:
+            if self._sstable_component(sstable.path).startswith(SSTABLE_DIGEST_COMPONENT):
+                with open(sstable.path, 'rb') as digest_file:
+                    generation_digests[self._generation_prefix(sstable.path)] = digest_file.read().strip()
+        return generation_digests
+
+    @staticmethod
+    def _fingerprint(keyspace, table, sstable, generation_digest):
+        # Without a Digest component fall back to the modification time, which snapshot hardlinks preserve
+        content_identity = generation_digest if generation_digest is not None else str(int(sstable.mtime))
+        fingerprint = hashlib.sha1()
+        for field in (keyspace, table, os.path.basename(sstable.path), str(sstable.size), content_identity):
+            # The digest is read as bytes, names are text on Python 3 and may keep undecodable bytes as surrogates
+            fingerprint.update(field if isinstance(field, bytes) else field.encode('utf-8', 'surrogateescape'))
+            fingerprint.update(b'\0')
+        return fingerprint.hexdigest()
+
+    @staticmethod
+    def _sstable_component(sstable):
+        return os.path.basename(sstable).rsplit('-', 1)[-1]
+
+    @staticmethod
+    def _generation_prefix(sstable):
+        return os.path.basename(sstable).rsplit('-', 1)[0]
@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+import threading
+from constants import (DISKSTATS_PATH, DISK_PRESSURE_HIGH_UTILIZATION, DISK_PRESSURE_LOW_UTILIZATION,
+                       DISK_PRESSURE_MIN_RATE_RATIO, DISK_PRESSURE_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter shared by all transfer workers.
+
+    A request larger than the available tokens is granted immediately and puts the bucket into debt, the caller then
+    sleeps outside the lock until the debt is paid, so workers never block each other while waiting.
+    """
+
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._capacity = float(rate)
+        self._tokens = self._capacity
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, value):
+        with self._lock:
+            self._refill()
+            self._rate = float(value)
+            self._capacity = float(value)
+            self._tokens = min(self._tokens, self._capacity)
+
+    def consume(self, amount):
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            wait_seconds = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+
+class DiskPressureMonitor(object):
+    """
+    Adapts a rate limiter to the utilization of the disks holding the Cassandra data directories.
+
+    Utilization is the share of wall time a device spent doing I/O (io_ticks in /proc/diskstats), the busiest device
+    counts. Above the high watermark the rate is halved, below the low watermark it grows back by a tenth of the
+    configured maximum.
+    """
+
+    def __init__(self, rate_limiter, data_directories):
+        self._rate_limiter = rate_limiter
+        self._max_rate = rate_limiter.rate
+        self._devices = sorted(set((os.major(os.stat(data_directory).st_dev), os.minor(os.stat(data_directory).st_dev))
+                                   for data_directory in data_directories))
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._monitor, name="disk-pressure-monitor")
+        self._thread.daemon = True
+
+    def start(self):
+        if not os.path.exists(DISKSTATS_PATH) or len(self._read_io_ticks()) < len(self._devices):
+            logger.warning("Devices {devices} not found in {path}, adaptive throttling is disabled".format(
+                devices=', '.join('{major}:{minor}'.format(major=major, minor=minor) for major, minor in self._devices),
+                path=DISKSTATS_PATH))
+            return self
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _monitor(self):
+        previous_ticks, previous_time = self._read_io_ticks(), time.time()
+        while not self._stop_event.wait(DISK_PRESSURE_INTERVAL):
+            # A failed interval is skipped, ending the thread would leave the read rate wherever it was
+            try:
+                ticks, now = self._read_io_ticks(), time.time()
+                devices = set(ticks) & set(previous_ticks)
+                if devices:
+                    utilization = max(ticks[device] - previous_ticks[device] for device in devices) / \
+                        ((now - previous_time) * 1000.0)
+                    self._adjust(utilization)
+                else:
+                    logger.warning("Devices not found in {path}, skipping disk utilization interval".format(
+                        path=DISKSTATS_PATH))
+                previous_ticks, previous_time = ticks, now
+            except Exception as e:
+                logger.warning("Failed to measure disk utilization - {error}".format(error=e))
+
+    def _adjust(self, utilization):
+        rate = self._rate_limiter.rate
+        if utilization > DISK_PRESSURE_HIGH_UTILIZATION:
+            rate = max(rate / 2, self._max_rate * DISK_PRESSURE_MIN_RATE_RATIO)
+        elif utilization < DISK_PRESSURE_LOW_UTILIZATION:
+            rate = min(rate + self._max_rate / 10, self._max_rate)
+        if rate != self._rate_limiter.rate:
+            logger.debug("Disk utilization {utilization:.0%}, read rate is now {rate:.1f} MB/s".format(
+                utilization=utilization, rate=rate / (1024 * 1024)))
+            self._rate_limiter.rate = rate
+
+    def _read_io_ticks(self):
+        io_ticks = dict()
+        with open(DISKSTATS_PATH) as diskstats:
+            for line in diskstats:
+                fields = line.split()
+                if (int(fields[0]), int(fields[1])) in self._devices:
+                    io_ticks[(int(fields[0]), int(fields[1]))] = int(fields[12])
+        return io_ticks
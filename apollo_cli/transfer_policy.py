@@ -0,0 +1,58 @@
+import math
+import threading
+from constants import (S3_MIN_PART_SIZE, S3_MAX_PARTS, S3_MULTIPART_THRESHOLD, AUTO_PART_SIZE_MIN,
+                       AUTO_PART_SIZE_MAX, AUTO_PART_SECONDS, AUTO_THROUGHPUT_SMOOTHING, TRANSFER_BYTES_PER_SLOT)
+
+
+class TransferPolicy(object):
+    """
+    Decides how every file is uploaded from its size and the throughput observed so far.
+
+    Files up to the multipart threshold are a single PUT. Larger files are split into parts sized so that a part
+    takes a few seconds on one connection - a fixed part size can be forced instead - and never into more than the
+    S3 part limit. A file may have one part in flight per TRANSFER_BYTES_PER_SLOT of its size, so very large files
+    spread over more connections while medium files don't crowd out the rest of the queue.
+    """
+
+    def __init__(self, workers, part_size=None, multipart_threshold=S3_MULTIPART_THRESHOLD):
+        self._workers = workers
+        self._fixed_part_size = part_size
+        self._multipart_threshold = max(multipart_threshold, S3_MIN_PART_SIZE)
+        self._throughput = None
+        self._lock = threading.Lock()
+
+    @property
+    def throughput(self):
+        """
+        Smoothed bytes per second of a single transfer connection, None until a transfer is recorded.
+        """
+        with self._lock:
+            return self._throughput
+
+    def record(self, transferred_bytes, seconds):
+        # Request latency dominates the transfer time of small objects, they say nothing about the bandwidth
+        if transferred_bytes < S3_MIN_PART_SIZE or seconds <= 0:
+            return
+        with self._lock:
+            throughput = transferred_bytes / seconds
+            if self._throughput is None:
+                self._throughput = throughput
+            else:
+                self._throughput += AUTO_THROUGHPUT_SMOOTHING * (throughput - self._throughput)
+
+    def single_put(self, file_size):
+        return file_size <= self._multipart_threshold
+
+    def part_size(self, file_size):
+        if self._fixed_part_size is not None:
+            part_size = self._fixed_part_size
+        else:
+            throughput = self.throughput
+            part_size = AUTO_PART_SIZE_MIN if throughput is None else \
+                min(max(int(throughput * AUTO_PART_SECONDS), AUTO_PART_SIZE_MIN), AUTO_PART_SIZE_MAX)
+            # Whole MBs keep part sizes stable across small throughput changes
+            part_size -= part_size % (1024 * 1024)
+        return max(part_size, S3_MIN_PART_SIZE, int(math.ceil(float(file_size) / S3_MAX_PARTS)))
+
+    def max_in_flight(self, file_size):
+        return max(1, min(self._workers, int(math.ceil(float(file_size) / TRANSFER_BYTES_PER_SLOT))))
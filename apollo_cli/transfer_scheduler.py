@@ -0,0 +1,533 @@
+import os
+import time
+import heapq
+import logging
+import collections
+import functools
+import itertools
+import threading
+from apollo_exceptions import S3UploadError
+from compression import COMPRESSION_CHUNK_SIZE
+from constants import THROTTLE_READ_CHUNK_SIZE
+from metrics import SnapshotMetrics
+from transfer_policy import TransferPolicy
+
+logger = logging.getLogger(__name__)
+
+# Compressed parts are uploaded from memory, their queue doesn't count against the reads of a device
+_BUFFERED_PARTS = 'buffered-parts'
+
+
+class TransferScheduler(object):
+    """
+    Single pool of transfer workers shared by a whole snapshot run.
+
+    Files above the multipart threshold of the transfer policy are split into multipart upload parts. Parts and
+    small files are taken from one queue, largest first, so a fixed number of threads and connections keeps the uplink
+    busy without small files waiting behind whole large files. A file whose parts already fill its share of the
+    workers is passed over while other files are queued.
+
+    Tasks are queued per device holding the file, so with `device_concurrency` no disk serves more than that many
+    reads at once while tasks of idle disks are taken first. Parts of compressed files are buffered in memory and are
+    queued apart from the devices.
+    """
+
+    def __init__(self, repository, workers, verbose=False, compressor=None, read_limiter=None, network_limiter=None,
+                 journal=None, metrics=None, policy=None, device_concurrency=None):
+        self._repository = repository
+        self._policy = policy if policy is not None else TransferPolicy(workers)
+        self._journal = journal
+        self._verbose = verbose
+        self._compressor = compressor
+        self._metrics = metrics if metrics is not None else SnapshotMetrics()
+        self._throttle = _Throttle(read_limiter, network_limiter, self._metrics)
+        self._device_concurrency = device_concurrency
+        self._queues = collections.defaultdict(list)
+        self._devices = dict()
+        self._device_reads = collections.Counter()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._pending_tasks = 0
+        self._closed = False
+        self._dropped = False
+        self._errors = list()
+        self._uploaded_objects = dict()
+        self._workers = [threading.Thread(target=self._worker, name="transfer-worker-{index}".format(index=index))
+                         for index in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    @property
+    def workers(self):
+        return len(self._workers)
+
+    @property
+    def compressor(self):
+        return self._compressor
+
+    @property
+    def uploaded_objects(self):
+        """
+        Size and ETag of every object stored by this run, including objects a resumed run found in the journal.
+        """
+        with self._condition:
+            return dict(self._uploaded_objects)
+
+    def submit(self, local_file_path, remote_path, size=None, callback=None):
+        """
+        Queues a file upload, `callback` is called without arguments once the object is stored.
+        """
+        on_uploaded = functools.partial(self._record_uploaded_object, callback=callback)
+        if self._compressor is not None:
+            file_upload = _CompressedFileUpload(self._repository, local_file_path, remote_path, size, self._throttle,
+                                                self._journal, on_uploaded, self._policy, self._compressor,
+                                                functools.partial(self._enqueue, device=_BUFFERED_PARTS))
+        else:
+            file_upload = _FileUpload(self._repository, local_file_path, remote_path, size, self._throttle,
+                                      self._journal, on_uploaded, self._policy)
+        self._enqueue(file_upload.tasks(), self._device(local_file_path))
+
+    def submit_bundle(self, sstables, remote_path, callback=None):
+        on_uploaded = functools.partial(self._record_uploaded_object, callback=callback)
+        # Bundled SSTables are small, the bundle is accounted to the device of its first member
+        self._enqueue(_BundleUpload(self._repository, sstables, remote_path, self._throttle, self._journal,
+                                    on_uploaded).tasks(), self._device(sstables[0].path))
+
+    def _record_uploaded_object(self, remote_path, object_size, etag, resumed=False, callback=None):
+        with self._condition:
+            self._uploaded_objects[remote_path] = (object_size, etag)
+        self._metrics.increment('objects_resumed' if resumed else 'objects_uploaded')
+        if self._verbose and not resumed:
+            logger.info("Uploaded {remote_path} - {size} bytes".format(remote_path=remote_path, size=object_size))
+        if callback is not None:
+            callback()
+
+    def _device(self, local_file_path):
+        directory = os.path.dirname(local_file_path)
+        if directory not in self._devices:
+            try:
+                self._devices[directory] = os.stat(directory).st_dev
+            except OSError:
+                self._devices[directory] = None
+        return self._devices[directory]
+
+    def _enqueue(self, tasks, device):
+        with self._condition:
+            if self._dropped:
+                raise S3UploadError("The transfer scheduler is closed, {count} transfers weren't queued".format(
+                    count=len(tasks)))
+            for task in tasks:
+                heapq.heappush(self._queues[device], (-task.length, next(self._sequence), task))
+                self._pending_tasks += 1
+            self._condition.notify_all()
+
+    def join(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            while self._pending_tasks > 0:
+                self._condition.wait()
+        for worker in self._workers:
+            worker.join()
+        if self._errors:
+            raise S3UploadError("{count} transfers failed, first error - {error}".format(
+                count=len(self._errors), error=self._errors[0]))
+
+    def close(self):
+        """
+        Stops the workers without waiting for the queued tasks, which are dropped along with the multipart uploads
+        they belong to. Running tasks are finished. Does nothing once the scheduler is joined.
+        """
+        with self._condition:
+            self._closed, self._dropped = True, True
+            dropped_tasks = [entry[2] for queue in self._queues.values() for entry in queue]
+            self._queues.clear()
+            self._pending_tasks -= len(dropped_tasks)
+            self._condition.notify_all()
+        if dropped_tasks:
+            logger.warning("Dropping {count} queued transfers".format(count=len(dropped_tasks)))
+        for task in dropped_tasks:
+            try:
+                task.fail()
+            except Exception as e:
+                logger.error("Failed to abort the upload of {sstable} - {error}".format(sstable=task.local_file_path,
+                                                                                      error=e))
+        for worker in self._workers:
+            worker.join()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                task, device = self._next_task()
+                while task is None:
+                    # Running tasks may still queue compressed parts
+                    if self._closed and self._pending_tasks == 0:
+                        return
+                    self._condition.wait()
+                    task, device = self._next_task()
+                task.file_upload.in_flight += 1
+                self._device_reads[device] += 1
+
+            started_at = time.time()
+            try:
+                task.run()
+                self._policy.record(task.length, time.time() - started_at)
+            except Exception as e:
+                logger.error("Failed to upload {sstable} - {error}".format(sstable=task.local_file_path, error=e))
+                task.fail()
+                with self._condition:
+                    self._errors.append(e)
+            finally:
+                with self._condition:
+                    task.file_upload.in_flight -= 1
+                    self._device_reads[device] -= 1
+                    self._pending_tasks -= 1
+                    self._condition.notify_all()
+
+    def _next_task(self):
+        """
+        Takes the largest task of the devices below their concurrency limit, (None, None) if there is none. Called
+        with the condition held.
+        """
+        devices = sorted((queue[0], device) for device, queue in self._queues.items() if queue and (
+            device == _BUFFERED_PARTS or self._device_concurrency is None or
+            self._device_reads[device] < self._device_concurrency))
+        for _, device in devices:
+            task = self._pop_task(self._queues[device])
+            if task is not None:
+                return task, device
+        if devices:
+            # Only files at their concurrency limit are queued, exceeding it beats leaving the worker idle
+            device = devices[0][1]
+            return heapq.heappop(self._queues[device])[2], device
+        return None, None
+
+    @staticmethod
+    def _pop_task(queue):
+        passed_over = list()
+        task = None
+        while queue:
+            entry = heapq.heappop(queue)
+            if entry[2].file_upload.in_flight < entry[2].file_upload.max_in_flight:
+                task = entry[2]
+                break
+            passed_over.append(entry)
+        for entry in passed_over:
+            heapq.heappush(queue, entry)
+        return task
+
+
+class _Throttle(object):
+    def __init__(self, read_limiter, network_limiter, metrics):
+        self._read_limiter = read_limiter
+        self._network_limiter = network_limiter
+        self._metrics = metrics
+
+    def read(self, amount):
+        self._metrics.increment('bytes_read', amount)
+        if self._read_limiter is not None:
+            self._read_limiter.consume(amount)
+
+    def send(self, amount):
+        self._metrics.increment('bytes_sent', amount)
+        if self._network_limiter is not None:
+            self._network_limiter.consume(amount)
+
+    def copy(self, amount):
+        self.read(amount)
+        self.send(amount)
+
+
+class _FileUpload(object):
+    def __init__(self, repository, local_file_path, remote_path, size, throttle, journal, on_uploaded, policy):
+        self._repository = repository
+        self._throttle = throttle
+        self._journal = journal
+        self._on_uploaded = on_uploaded
+        self._local_file_path = local_file_path
+        self._remote_path = remote_path
+        self._size = size if size is not None else os.path.getsize(local_file_path)
+        self._failed = False
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = policy.max_in_flight(self._size)
+
+        self._upload_id, part_size, self._part_etags = None, None, dict()
+        if journal is not None:
+            self._upload_id, part_size, self._part_etags = journal.multipart_upload(remote_path)
+        # A resumed multipart upload keeps the part size its uploaded parts were cut with
+        self._part_size = part_size or policy.part_size(self._size)
+        self._parts_count = -(-self._size // self._part_size)
+        self._single_put = self._upload_id is None and (policy.single_put(self._size) or
+                                                        self._size <= self._part_size)
+
+    @property
+    def local_file_path(self):
+        return self._local_file_path
+
+    def tasks(self):
+        if self._journaled_upload():
+            return list()
+        if self._repository.local_file_copy and self._upload_id is None:
+            return [_TransferTask(self, self._size, self._copy_object)]
+        if self._single_put:
+            return [_TransferTask(self, self._size, self._upload_object)]
+
+        if self._upload_id is not None:
+            logger.info("Resuming multipart upload of {sstable}, {uploaded} of {parts} parts are uploaded".format(
+                sstable=self._local_file_path, uploaded=len(self._part_etags), parts=self._parts_count))
+        tasks = list()
+        for part_number, offset in enumerate(range(0, self._size, self._part_size), 1):
+            if part_number in self._part_etags:
+                continue
+            length = min(self._part_size, self._size - offset)
+            tasks.append(_TransferTask(self, length, functools.partial(self._upload_part, part_number, offset, length)))
+        return tasks or [_TransferTask(self, 0, self._complete_multipart_upload)]
+
+    def _journaled_upload(self):
+        uploaded_object = self._journal.uploaded_object(self._remote_path, self._size) \
+            if self._journal is not None else None
+        if uploaded_object is None:
+            return False
+        logger.debug("Skipping already uploaded - {sstable}".format(sstable=self._local_file_path))
+        self._on_uploaded(self._remote_path, *uploaded_object, resumed=True)
+        return True
+
+    def read(self, offset, length):
+        # Tokens are taken per chunk as it is read, so the disk sees a steady rate rather than bursts of whole parts
+        chunks = list()
+        with open(self._local_file_path, 'rb') as local_file:
+            local_file.seek(offset)
+            while length > 0:
+                chunk_length = min(length, THROTTLE_READ_CHUNK_SIZE)
+                self._throttle.read(chunk_length)
+                chunk = local_file.read(chunk_length)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                length -= len(chunk)
+        return b''.join(chunks)
+
+    def _upload_object(self):
+        data = self.read(0, self._size)
+        self._throttle.send(len(data))
+        logger.debug("Uploading - {sstable}".format(sstable=self._local_file_path))
+        etag = self._repository.put_object(self._remote_path, data)
+        self._uploaded(self._size, etag)
+
+    def _copy_object(self):
+        logger.debug("Copying - {sstable}".format(sstable=self._local_file_path))
+        # Charged per copied chunk, a reflinked or hardlinked file isn't read at all
+        object_size, etag = self._repository.copy_file(self._local_file_path, self._remote_path, self._throttle.copy)
+        self._uploaded(object_size, etag)
+
+    def _upload_part(self, part_number, offset, length):
+        if self._failed:
+            return
+        data = self.read(offset, length)
+        self._throttle.send(len(data))
+        upload_id = self._multipart_upload_id()
+        etag = self._repository.upload_part(self._remote_path, upload_id, part_number, data)
+        if self._journal is not None:
+            self._journal.record_part(upload_id, part_number, etag)
+
+        with self._lock:
+            self._part_etags[part_number] = etag
+            completed = len(self._part_etags) == self._parts_count
+        if completed:
+            self._complete_multipart_upload()
+
+    def _multipart_upload_id(self):
+        with self._lock:
+            if self._upload_id is None:
+                logger.debug("Starting multipart upload - {sstable}".format(sstable=self._local_file_path))
+                self._upload_id = self._repository.create_multipart_upload(self._remote_path)
+                if self._journal is not None:
+                    self._journal.record_multipart_upload(self._remote_path, self._upload_id, self._part_size)
+            return self._upload_id
+
+    def _complete_multipart_upload(self, object_size=None):
+        etag = self._repository.complete_multipart_upload(self._remote_path, self._upload_id, self._part_etags)
+        self._uploaded(object_size if object_size is not None else self._size, etag)
+
+    def _uploaded(self, object_size, etag):
+        if self._journal is not None:
+            self._journal.record_upload(self._local_file_path, self._remote_path, self._size, object_size, etag)
+        self._on_uploaded(self._remote_path, object_size, etag)
+
+    def fail(self):
+        with self._lock:
+            if self._failed:
+                return
+            self._failed = True
+            upload_id = self._upload_id
+        # A journaled multipart upload is kept so that a resumed run can finish it
+        if upload_id is not None and self._journal is None:
+            self._repository.abort_multipart_upload(self._remote_path, upload_id)
+
+
+class _CompressedFileUpload(_FileUpload):
+    """
+    Streams a file through the compressor and uploads the compressed output as it is produced.
+
+    The compressed size isn't known up front, so the file is read and compressed by a single task which buffers up to
+    one part of compressed data and falls back to a single PUT when the whole output fits in one part. Every full part
+    is queued as a task of its own, up to the share of the workers of the file, past it the part is uploaded by the
+    compressing task itself so the buffered parts stay bounded. Whichever task stores the last part completes the
+    upload. An interrupted compressed upload is restarted from the beginning of the file.
+    """
+
+    def __init__(self, repository, local_file_path, remote_path, size, throttle, journal, on_uploaded, policy,
+                 compressor, enqueue):
+        super(_CompressedFileUpload, self).__init__(repository, local_file_path, remote_path, size, throttle, journal,
+                                                    on_uploaded, policy)
+        self._compressor = compressor
+        self._enqueue = enqueue
+        self._queued_parts = 0
+        self._parts_count, self._compressed_size = None, None
+
+    def tasks(self):
+        if self._journaled_upload():
+            return list()
+        return [_TransferTask(self, self._size, self._upload_compressed)]
+
+    def _upload_compressed(self):
+        if self._upload_id is not None:
+            self._repository.abort_multipart_upload(self._remote_path, self._upload_id)
+            self._journal.discard_multipart_upload(self._remote_path)
+            self._upload_id, self._part_etags = None, dict()
+
+        logger.debug("Uploading compressed - {sstable}".format(sstable=self._local_file_path))
+        buffered_chunks, buffered_size, part_number, compressed_size = list(), 0, 0, 0
+        for compressed_chunk in self._compressor.compress(self._read_chunks()):
+            if self._failed:
+                return
+            buffered_chunks.append(compressed_chunk)
+            buffered_size += len(compressed_chunk)
+            compressed_size += len(compressed_chunk)
+            if buffered_size >= self._part_size:
+                part_number += 1
+                self._schedule_compressed_part(part_number, b''.join(buffered_chunks))
+                buffered_chunks, buffered_size = list(), 0
+
+        if part_number == 0:
+            self._throttle.send(buffered_size)
+            etag = self._repository.put_object(self._remote_path, b''.join(buffered_chunks))
+            self._uploaded(compressed_size, etag)
+            return
+        if buffered_chunks:
+            part_number += 1
+            self._upload_compressed_part(part_number, b''.join(buffered_chunks))
+        with self._lock:
+            self._parts_count, self._compressed_size = part_number, compressed_size
+            completed = len(self._part_etags) == self._parts_count and not self._failed
+        if completed:
+            self._complete_multipart_upload(compressed_size)
+
+    def _read_chunks(self):
+        with open(self._local_file_path, 'rb') as local_file:
+            for chunk in iter(lambda: local_file.read(COMPRESSION_CHUNK_SIZE), b''):
+                self._throttle.read(len(chunk))
+                yield chunk
+
+    def _schedule_compressed_part(self, part_number, data):
+        # The compressing task is in flight as well
+        with self._lock:
+            queued = self._queued_parts < self.max_in_flight - 1
+            if queued:
+                self._queued_parts += 1
+        if not queued:
+            self._upload_compressed_part(part_number, data)
+            return
+        self._enqueue([_TransferTask(self, len(data), functools.partial(self._upload_queued_part, part_number,
+                                                                        data))])
+
+    def _upload_queued_part(self, part_number, data):
+        try:
+            if not self._failed:
+                self._upload_compressed_part(part_number, data)
+        finally:
+            with self._lock:
+                self._queued_parts -= 1
+
+    def _upload_compressed_part(self, part_number, data):
+        self._throttle.send(len(data))
+        etag = self._repository.upload_part(self._remote_path, self._multipart_upload_id(), part_number, data)
+        with self._lock:
+            self._part_etags[part_number] = etag
+            # The parts count is only known once the compressing task is done
+            completed = len(self._part_etags) == self._parts_count and not self._failed
+        if completed:
+            self._complete_multipart_upload(self._compressed_size)
+
+
+class _BundleUpload(object):
+    """
+    Concatenates a list of small SSTables and uploads them as a single object.
+    """
+
+    def __init__(self, repository, sstables, remote_path, throttle, journal, on_uploaded):
+        self._repository = repository
+        self._sstables = sstables
+        self._remote_path = remote_path
+        self._throttle = throttle
+        self._journal = journal
+        self._on_uploaded = on_uploaded
+        self._size = sum(sstable.size for sstable in sstables)
+        self.in_flight = 0
+        self.max_in_flight = 1
+
+    @property
+    def local_file_path(self):
+        return self._remote_path
+
+    def tasks(self):
+        uploaded_object = self._journal.uploaded_object(self._remote_path, self._size) \
+            if self._journal is not None else None
+        if uploaded_object is not None:
+            logger.debug("Skipping already uploaded bundle - {bundle}".format(bundle=self._remote_path))
+            self._on_uploaded(self._remote_path, *uploaded_object, resumed=True)
+            return list()
+        return [_TransferTask(self, self._size, self._upload_bundle)]
+
+    def _upload_bundle(self):
+        chunks = list()
+        for sstable in self._sstables:
+            self._throttle.read(sstable.size)
+            with open(sstable.path, 'rb') as local_file:
+                chunks.append(local_file.read())
+            # The offsets in the snapshot metadata were computed from the crawled sizes
+            if len(chunks[-1]) != sstable.size:
+                raise S3UploadError("SSTable size changed while bundling - {sstable}".format(sstable=sstable.path))
+        self._throttle.send(self._size)
+        logger.debug("Uploading bundle of {count} sstables - {bundle}".format(count=len(self._sstables),
+                                                                            bundle=self._remote_path))
+        etag = self._repository.put_object(self._remote_path, b''.join(chunks))
+        if self._journal is not None:
+            self._journal.record_upload(self._sstables[0].path, self._remote_path, self._size, self._size, etag)
+        self._on_uploaded(self._remote_path, self._size, etag)
+
+    def fail(self):
+        pass
+
+
+class _TransferTask(object):
+    def __init__(self, file_upload, length, action):
+        self._file_upload = file_upload
+        self._action = action
+        self.length = length
+
+    @property
+    def file_upload(self):
+        return self._file_upload
+
+    @property
+    def local_file_path(self):
+        return self._file_upload.local_file_path
+
+    def run(self):
+        self._action()
+
+    def fail(self):
+        self._file_upload.fail()
@@ -1,34 +1,251 @@
 import os
+import json
 import logging
 import datetime
+import functools
+import threading
 import concurrent.futures
-from constants import (SNAPSHOT_METADATA_FILE, SUCCESS_FIELD_METADATA)
-from apollo_exceptions import AWSCredentialsError
+from constants import (SNAPSHOT_METADATA_FILE, SNAPSHOT_MANIFEST_FILE, SUCCESS_FIELD_METADATA,
+                       RESTORE_TEMPORARY_SUFFIX, SNAPSHOT_DATE_FORMAT, SNAPSHOT_TIME_FORMAT, SNAPSHOT_ID_FORMAT,
+                       SNAPSHOT_TYPES)
+from apollo_exceptions import (AWSCredentialsError, S3DownloadError, SnapshotVerificationError)
+from sstable_dedup import SSTableDedupIndex
+from incremental_index import IncrementalBackupIndex
+from sstable_bundler import SSTableBundler
+from snapshot_cleaner import SnapshotCleaner
+from snapshot_manifest import SnapshotManifest
+from metrics import SnapshotMetrics
 
 logger = logging.getLogger(__name__)
 
 
-def cassandra_backup_to_s3(metadata, s3_repository, cassandra, upload_workers, verbose=True):
+def cassandra_backup_to_s3(metadata, s3_repository, cassandra, transfer_scheduler, dedup=False, journal=None,
+                           bundle_threshold=0, bundle_size=0, metrics=None, early_cleanup=False, purge_backups=False):
+    metrics = metrics if metrics is not None else SnapshotMetrics()
     snapshot_timestamp = metadata.snapshot_date
     snapshot_remote_base_path = os.path.join(snapshot_timestamp, cassandra.node, cassandra.snapshot_type)
     metadata_remote_path = os.path.join(snapshot_remote_base_path, SNAPSHOT_METADATA_FILE)
 
-    s3_repository.save_metadata(metadata.json(), metadata_remote_path)
+    if journal is not None:
+        journal.begin(snapshot_remote_base_path, cassandra.node, cassandra.snapshot_type, snapshot_timestamp,
+                      cassandra.snapshot_id)
+
+    with metrics.phase("metadata"):
+        s3_repository.save_metadata(metadata.json(), metadata_remote_path)
+        dedup_index = SSTableDedupIndex(s3_repository, cassandra.node) if dedup else None
+        incremental_index = IncrementalBackupIndex(s3_repository, cassandra.node) \
+            if cassandra.snapshot_type == "incremental" else None
+    compressor = transfer_scheduler.compressor
+    if compressor is not None:
+        metadata.compression = compressor.codec
+    # Incremental backups are hardlinked by Cassandra itself, only snapshot hardlinks are removed early
+    cleaner = SnapshotCleaner(metrics) if early_cleanup and cassandra.snapshot_type == "full" else None
+    bundler = SSTableBundler(metadata, transfer_scheduler, snapshot_remote_base_path, bundle_threshold,
+                             bundle_size, cleaner) if bundle_threshold > 0 else None
 
-    sstables_map = generate_sstables_map_to_upload(cassandra, snapshot_remote_base_path)
     logging.info("Starting upload snapshots to S3")
-    parallel_upload(upload_workers, s3_repository, sstables_map, verbose)
+    uploaded_sstables, stored_sstables = list(), list()
+    crawled_backups, shipped_backups = list(), list()
+    # The crawl runs while uploads are in flight, a failed crawl must not leave the workers uploading and a failed
+    # upload must not leave the crawl snapshotting keyspaces
+    table_batches = cassandra.iter_sstables()
+    try:
+        with metrics.phase("upload"):
+            with metrics.phase("crawl"):
+                for keyspace, table, sstables in table_batches:
+                    if incremental_index is not None:
+                        incremental_index.forget_missing(keyspace, table, sstables)
+                        crawled_backups.extend(sstables)
+                        sstables = [sstable for sstable in sstables if not incremental_index.is_shipped(sstable)]
+                        shipped_backups.extend(sstables)
+                    sstables_map = generate_sstables_map_to_upload(keyspace, table, sstables, snapshot_remote_base_path,
+                                                                   dedup_index)
+                    if cleaner is not None:
+                        cleaner.track(sstables)
+                    for sstable in sstables:
+                        remote_path = sstables_map[sstable.path]
+                        if compressor is not None:
+                            remote_path += compressor.extension
+                        if dedup_index is not None and dedup_index.is_stored(remote_path):
+                            metadata.add_sstable(keyspace, table, os.path.basename(sstable.path), remote_path,
+                                                 sstable.size)
+                            metrics.record_sstable(keyspace, sstable.size, "dedup")
+                            stored_sstables.append(remote_path)
+                            if cleaner is not None:
+                                cleaner.release([sstable])
+                            continue
+                        # Bundled components belong to this snapshot only, they aren't registered in the dedup index
+                        if bundler is not None and bundler.accepts(sstable):
+                            bundler.add(sstable)
+                            metrics.record_sstable(keyspace, sstable.size, "bundle")
+                            continue
+                        metadata.add_sstable(keyspace, table, os.path.basename(sstable.path), remote_path, sstable.size)
+                        metrics.record_sstable(keyspace, sstable.size, "upload")
+                        transfer_scheduler.submit(sstable.path, remote_path, sstable.size,
+                                                  functools.partial(cleaner.release, [sstable])
+                                                  if cleaner is not None else None)
+                        uploaded_sstables.append((remote_path, sstable.size))
+                if bundler is not None:
+                    bundler.close()
+            transfer_scheduler.join()
+    finally:
+        table_batches.close()
+        transfer_scheduler.close()
+    stored_objects = transfer_scheduler.uploaded_objects
+
+    if dedup_index is not None:
+        logger.info("{stored} of {total} sstables were already stored in the repository".format(
+            stored=len(stored_sstables), total=len(stored_sstables) + len(uploaded_sstables)))
+        for remote_path in stored_sstables:
+            stored_object = dedup_index.stored_object(remote_path)
+            if stored_object is not None:
+                stored_objects[remote_path] = stored_object
+        dedup_index.register(uploaded_sstables, stored_objects)
+    if incremental_index is not None:
+        logger.info("{shipped} of {total} incremental backup files were shipped by earlier snapshots".format(
+            shipped=len(crawled_backups) - len(shipped_backups), total=len(crawled_backups)))
+        register_shipped_backups(incremental_index, metadata, shipped_backups, stored_objects)
+        metadata.live_sstables = cassandra.live_sstables
+
+    with metrics.phase("metadata"):
+        if dedup_index is not None:
+            dedup_index.save()
+        manifest_remote_path = os.path.join(snapshot_remote_base_path, SNAPSHOT_MANIFEST_FILE)
+        manifest_data, manifest_index = metadata.manifest.serialize(stored_objects)
+        s3_repository.save_metadata(manifest_data, manifest_remote_path)
+        metadata.set_manifest_location(manifest_remote_path, manifest_index)
 
-    metadata.status = SUCCESS_FIELD_METADATA
-    s3_repository.save_metadata(metadata.json(), metadata_remote_path)
+        metadata.status = SUCCESS_FIELD_METADATA
+        s3_repository.save_metadata(metadata.json(), metadata_remote_path)
+        # Saved once the snapshot holding the newly shipped files is marked successful
+        if incremental_index is not None:
+            incremental_index.save()
+    if journal is not None:
+        journal.finish()
+    if incremental_index is not None and purge_backups:
+        with metrics.phase("purge"):
+            purge_shipped_backups(s3_repository, incremental_index, crawled_backups, transfer_scheduler.workers)
     logger.info("Finished backup successfully")
 
 
+def cassandra_restore_from_s3(s3_repository, node, snapshot_date, snapshot_type, data_directory, keyspaces, tables,
+                              download_workers, download_chunksize):
+    snapshot_remote_base_path = os.path.join(snapshot_date, node, snapshot_type)
+    metadata_remote_path = os.path.join(snapshot_remote_base_path, SNAPSHOT_METADATA_FILE)
+
+    metadata = s3_repository.load_metadata(metadata_remote_path)
+    if metadata is None:
+        raise S3DownloadError("Snapshot metadata not found - {remote_path}".format(remote_path=metadata_remote_path))
+    metadata = json.loads(metadata)
+    if metadata["status"] != SUCCESS_FIELD_METADATA:
+        logger.warning("Restoring snapshot with status {status}".format(status=metadata["status"]))
+
+    if metadata.get("manifest") is not None:
+        sstables_map = generate_manifest_map_to_download(s3_repository, metadata["manifest"], data_directory,
+                                                         keyspaces, tables)
+    else:
+        if "sstables" in metadata:
+            sstables_remote_map = metadata["sstables"]
+        else:
+            sstables_remote_map = list_sstables_remote_map(s3_repository, snapshot_remote_base_path)
+        sstables_remote_map = filter_sstables_remote_map(sstables_remote_map, keyspaces, tables)
+        sstables_map = generate_sstables_map_to_download(s3_repository, sstables_remote_map, data_directory)
+        bundled_sstables_map = filter_sstables_remote_map(metadata.get("bundled_sstables", dict()), keyspaces,
+                                                          tables)
+        sstables_map.update(generate_bundled_sstables_map_to_download(bundled_sstables_map, data_directory))
+
+    logger.info("Starting download of {count} sstables from S3".format(count=len(sstables_map)))
+    parallel_download(download_workers, s3_repository, sstables_map, download_chunksize, metadata.get("compression"))
+    logger.info("Finished restore successfully")
+
+
+def cassandra_verify_s3(s3_repository, node, snapshot_date, snapshot_type, verify_workers):
+    """
+    Checks with HEAD requests that every object referenced by the snapshot manifest exists with the size and ETag
+    recorded at upload time, without downloading any data.
+    """
+    snapshot_remote_base_path = os.path.join(snapshot_date, node, snapshot_type)
+    metadata_remote_path = os.path.join(snapshot_remote_base_path, SNAPSHOT_METADATA_FILE)
+
+    metadata = s3_repository.load_metadata(metadata_remote_path)
+    if metadata is None:
+        raise S3DownloadError("Snapshot metadata not found - {remote_path}".format(remote_path=metadata_remote_path))
+    metadata = json.loads(metadata)
+    if metadata.get("manifest") is None:
+        raise SnapshotVerificationError("Snapshot {remote_path} has no manifest, it can't be verified".format(
+            remote_path=snapshot_remote_base_path))
+    manifest_data = s3_repository.load_metadata(metadata["manifest"]["path"])
+    if manifest_data is None:
+        raise S3DownloadError("Snapshot manifest not found - {remote_path}".format(
+            remote_path=metadata["manifest"]["path"]))
+
+    expected_objects = dict()
+    for entry in SnapshotManifest.parse(manifest_data):
+        if "object_size" in entry:
+            expected_objects[entry["remote_path"]] = (entry["object_size"], entry["etag"])
+        elif entry.get("offset") is None and metadata.get("compression") is None:
+            expected_objects.setdefault(entry["remote_path"], (entry["size"], None))
+        else:
+            expected_objects.setdefault(entry["remote_path"], (None, None))
+
+    logger.info("Verifying {count} objects of snapshot {remote_path}".format(count=len(expected_objects),
+                                                                             remote_path=snapshot_remote_base_path))
+    executor = concurrent.futures.ThreadPoolExecutor(verify_workers)
+    remote_paths = sorted(expected_objects)
+    mismatches = list()
+    for remote_path, stored_object in zip(remote_paths, executor.map(s3_repository.head_object, remote_paths)):
+        expected_size, expected_etag = expected_objects[remote_path]
+        if stored_object is None:
+            mismatches.append("{remote_path} is missing".format(remote_path=remote_path))
+        elif expected_size is not None and stored_object[0] != expected_size:
+            mismatches.append("{remote_path} size is {size}, expected {expected}".format(
+                remote_path=remote_path, size=stored_object[0], expected=expected_size))
+        elif expected_etag is not None and stored_object[1] != expected_etag:
+            mismatches.append("{remote_path} ETag is {etag}, expected {expected}".format(
+                remote_path=remote_path, etag=stored_object[1], expected=expected_etag))
+    executor.shutdown()
+
+    for mismatch in mismatches:
+        logger.error(mismatch)
+    if mismatches:
+        raise SnapshotVerificationError("{count} of {total} objects failed verification".format(
+            count=len(mismatches), total=len(expected_objects)))
+    logger.info("Snapshot {remote_path} is verified".format(remote_path=snapshot_remote_base_path))
+
+
 def generate_snapshot_timestamp():
     snapshot_timestamp = datetime.datetime.today().strftime('%Y-%m-%d')
     return snapshot_timestamp
 
 
+def generate_snapshot_time():
+    return datetime.datetime.now().strftime(SNAPSHOT_TIME_FORMAT)
+
+
+def generate_snapshot_id():
+    """
+    Names a snapshot shared by several nodes, it takes the place of the date in the repository layout.
+    """
+    return datetime.datetime.now().strftime(SNAPSHOT_ID_FORMAT)
+
+
+def parse_snapshot_time(value):
+    """
+    Parses a local time (YYYY-MM-DDTHH:MM[:SS]), a snapshot ID (YYYY-MM-DDTHH:MM:SS.ffffff) or a date (YYYY-MM-DD),
+    which stands for the end of that day.
+    """
+    for time_format in (SNAPSHOT_ID_FORMAT, SNAPSHOT_TIME_FORMAT, SNAPSHOT_TIME_FORMAT[:-3]):
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    try:
+        return datetime.datetime.strptime(value, SNAPSHOT_DATE_FORMAT).replace(hour=23, minute=59, second=59)
+    except ValueError:
+        raise ValueError("Invalid time {value}, expected YYYY-MM-DD or YYYY-MM-DDTHH:MM[:SS[.ffffff]]".format(
+            value=value))
+
+
 def get_environment_variable(environment_variable_key):
     try:
         environment_variable_value = os.environ[environment_variable_key]
@@ -44,29 +261,255 @@ def validate_aws_permissions(access_key, secret_key):
         pass
 
 
-def extract_keyspace_map(cassandra_sstable_fs_tree):
-    keyspace_map = dict()
-    for keyspace in cassandra_sstable_fs_tree.keys():
-        keyspace_map[keyspace] = list()
-        for table in cassandra_sstable_fs_tree[keyspace].keys():
-            keyspace_map[keyspace].append(table)
-    return keyspace_map
+def convert_mb_to_byte(num):
+    return num * 1024 * 1024
 
 
-def parallel_upload(upload_workers, s3_repository, sstables_map, verbosity):
-    executor = concurrent.futures.ThreadPoolExecutor(upload_workers)
-    futures = [executor.submit(s3_repository.upload, sstable, sstables_map[sstable], verbosity) for sstable in sstables_map]
-    concurrent.futures.wait(futures)
+def format_size(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return "{size:.1f} {unit}".format(size=size, unit=unit)
+        size /= 1024.0
+    return "{size:.1f} TB".format(size=size)
+
+
+def register_shipped_backups(incremental_index, metadata, sstables, stored_objects):
+    for sstable in sstables:
+        sstable_name = os.path.basename(sstable.path)
+        remote_path = metadata.sstables.get(sstable.keyspace, dict()).get(sstable.table, dict()).get(sstable_name)
+        if remote_path is None:
+            remote_path = metadata.bundled_sstables[sstable.keyspace][sstable.table][sstable_name][0]
+        incremental_index.register(sstable, remote_path, stored_objects.get(remote_path))
+
+
+def purge_shipped_backups(s3_repository, incremental_index, sstables, purge_workers):
+    """
+    Removes backups/ hardlinks whose objects are confirmed in the repository by a HEAD request.
+    """
+    shipped_objects = dict()
+    for sstable in sstables:
+        shipped_object = incremental_index.shipped_object(sstable)
+        if shipped_object is not None:
+            shipped_objects.setdefault(shipped_object, list()).append(sstable)
 
+    shipped_keys = list(shipped_objects)
+    executor = concurrent.futures.ThreadPoolExecutor(purge_workers)
+    try:
+        stored_objects = list(executor.map(lambda shipped_key: s3_repository.head_object(shipped_key[0]),
+                                           shipped_keys))
+    finally:
+        executor.shutdown()
+
+    purged_count, purged_size = 0, 0
+    for (remote_path, object_size), stored_object in zip(shipped_keys, stored_objects):
+        if stored_object is None or (object_size is not None and stored_object[0] != object_size):
+            logger.warning("{remote_path} isn't stored as shipped, keeping its backup files".format(
+                remote_path=remote_path))
+            continue
+        for sstable in shipped_objects[(remote_path, object_size)]:
+            try:
+                os.unlink(sstable.path)
+                purged_count += 1
+                purged_size += sstable.size
+            except OSError as e:
+                logger.warning("Failed to purge backup file {sstable} - {error}".format(sstable=sstable.path,
+                                                                                     error=e))
+    logger.info("Purged {count} shipped backup files, {size}".format(count=purged_count,
+                                                                    size=format_size(purged_size)))
+
+
+def generate_sstables_map_to_upload(keyspace, table, sstables, snapshot_remote_base_path, dedup_index=None):
+    if dedup_index is not None:
+        return dedup_index.remote_paths(keyspace, table, sstables)
 
-def generate_sstables_map_to_upload(cassandra, snapshot_remote_base_path):
     repository_full_sstable_paths = dict()
-    for keyspace in cassandra.sstables_to_snapshot.keys():
-        for table in cassandra.sstables_to_snapshot[keyspace].keys():
-            for sstable in cassandra.sstables_to_snapshot[keyspace][table]:
-                sstable_name = os.path.basename(sstable)
-                full_repository_sstable_path = os.path.join(snapshot_remote_base_path,
-                                                            keyspace, table, sstable_name)
-                repository_full_sstable_paths[sstable] = full_repository_sstable_path
+    for sstable in sstables:
+        sstable_name = os.path.basename(sstable.path)
+        full_repository_sstable_path = os.path.join(snapshot_remote_base_path, keyspace, table, sstable_name)
+        repository_full_sstable_paths[sstable.path] = full_repository_sstable_path
 
     return repository_full_sstable_paths
+
+
+def list_sstables_remote_map(s3_repository, snapshot_remote_base_path):
+    sstables_remote_map = dict()
+    for remote_path in s3_repository.list_objects(snapshot_remote_base_path + '/'):
+        relative_path = os.path.relpath(remote_path, snapshot_remote_base_path)
+        if relative_path.count('/') != 2:
+            continue
+        keyspace, table, sstable_name = relative_path.split('/')
+        sstables_remote_map.setdefault(keyspace, dict()).setdefault(table, dict())[sstable_name] = remote_path
+    return sstables_remote_map
+
+
+def filter_sstables_remote_map(sstables_remote_map, keyspaces, tables):
+    keyspaces_include = keyspaces.split(',') if keyspaces is not None else None
+    tables_include = tables.split(',') if tables is not None else None
+    filtered_remote_map = dict()
+    for keyspace in sstables_remote_map.keys():
+        if keyspaces_include is not None and keyspace not in keyspaces_include:
+            continue
+        for table in sstables_remote_map[keyspace].keys():
+            # Table directories are named <table>-<table id>, the id can be omitted from the filter
+            if tables_include is not None and not set(tables_include) & {
+                    "{keyspace}.{table}".format(keyspace=keyspace, table=table),
+                    "{keyspace}.{table}".format(keyspace=keyspace, table=table.rsplit('-', 1)[0])}:
+                continue
+            filtered_remote_map.setdefault(keyspace, dict())[table] = sstables_remote_map[keyspace][table]
+    return filtered_remote_map
+
+
+def generate_sstables_map_to_download(s3_repository, sstables_remote_map, data_directory):
+    local_sstable_paths = dict()
+    for keyspace in sstables_remote_map.keys():
+        for table in sstables_remote_map[keyspace].keys():
+            remote_paths = sstables_remote_map[keyspace][table].values()
+            remote_prefix = os.path.commonprefix(remote_paths).rsplit('/', 1)[0] + '/'
+            remote_sizes = s3_repository.list_objects(remote_prefix)
+            for sstable_name, remote_path in sstables_remote_map[keyspace][table].items():
+                if remote_path not in remote_sizes:
+                    raise S3DownloadError("SSTable is missing from the repository - {remote_path}".format(
+                        remote_path=remote_path))
+                local_sstable_path = os.path.join(data_directory, keyspace, table, sstable_name)
+                local_sstable_paths[local_sstable_path] = (remote_path, remote_sizes[remote_path], None)
+    return local_sstable_paths
+
+
+def generate_bundled_sstables_map_to_download(bundled_sstables_map, data_directory):
+    local_sstable_paths = dict()
+    for keyspace in bundled_sstables_map.keys():
+        for table in bundled_sstables_map[keyspace].keys():
+            for sstable_name, (bundle_remote_path, offset, length) in bundled_sstables_map[keyspace][table].items():
+                local_sstable_path = os.path.join(data_directory, keyspace, table, sstable_name)
+                local_sstable_paths[local_sstable_path] = (bundle_remote_path, length, offset)
+    return local_sstable_paths
+
+
+def generate_manifest_map_to_download(s3_repository, manifest, data_directory, keyspaces, tables):
+    manifest_index = filter_sstables_remote_map(manifest["tables"], keyspaces, tables)
+    table_ranges = sorted((table_index["offset"], table_index["offset"] + table_index["length"] - 1)
+                          for keyspace_index in manifest_index.values() for table_index in keyspace_index.values())
+    tables_count = sum(len(keyspace_index) for keyspace_index in manifest["tables"].values())
+    if len(table_ranges) == tables_count:
+        manifest_members = [s3_repository.load_metadata(manifest["path"])]
+    else:
+        manifest_members = [s3_repository.load_metadata(manifest["path"], byte_range) for byte_range in table_ranges]
+    if None in manifest_members:
+        raise S3DownloadError("Snapshot manifest not found - {remote_path}".format(remote_path=manifest["path"]))
+
+    local_sstable_paths = dict()
+    for manifest_member in manifest_members:
+        if not manifest_member:
+            continue
+        for entry in SnapshotManifest.parse(manifest_member):
+            local_sstable_path = os.path.join(data_directory, entry["keyspace"], entry["table"], entry["name"])
+            local_sstable_paths[local_sstable_path] = (entry["remote_path"], entry["size"], entry.get("offset"))
+    return local_sstable_paths
+
+
+def list_snapshot_dates(s3_repository):
+    """
+    Dates and snapshot IDs holding snapshots in the repository, oldest first. Per-node directories at the root of the
+    repository (dedup objects, incremental index) are skipped.
+    """
+    snapshot_dates = list()
+    for date_prefix in s3_repository.list_prefixes(''):
+        snapshot_date = date_prefix.rstrip('/')
+        try:
+            parse_snapshot_time(snapshot_date)
+        except ValueError:
+            continue
+        snapshot_dates.append(snapshot_date)
+    return sorted(snapshot_dates)
+
+
+def refresh_snapshot_catalog(s3_repository, catalog, node=None):
+    """
+    Adds the snapshots of the bucket which aren't yet in the local catalog, walking the <date>/<node>/ prefixes of
+    the dates and snapshot IDs and reading only the metadata file of each snapshot type. Per-node dedup objects and
+    incremental indexes are never listed.
+    """
+    refreshed_count = 0
+    for snapshot_date in list_snapshot_dates(s3_repository):
+        node_prefixes = [os.path.join(snapshot_date, node) + '/'] if node is not None \
+            else s3_repository.list_prefixes(snapshot_date + '/')
+        for node_prefix in node_prefixes:
+            for snapshot_type in SNAPSHOT_TYPES:
+                snapshot_remote_base_path = node_prefix + snapshot_type
+                if catalog.snapshot_status(s3_repository.bucket, snapshot_remote_base_path) == SUCCESS_FIELD_METADATA:
+                    continue
+                metadata = s3_repository.load_metadata(os.path.join(snapshot_remote_base_path,
+                                                                    SNAPSHOT_METADATA_FILE))
+                if metadata is None:
+                    continue
+                catalog.record_snapshot(s3_repository.bucket, snapshot_remote_base_path, json.loads(metadata))
+                refreshed_count += 1
+    logger.info("Added {count} snapshots to the catalog".format(count=refreshed_count))
+
+
+def parallel_download(download_workers, s3_repository, sstables_map, download_chunksize, compression=None):
+    executor = concurrent.futures.ThreadPoolExecutor(download_workers)
+    futures = list()
+    # Largest files first so a single huge SSTable doesn't become the tail of the restore
+    for sstable in sorted(sstables_map, key=lambda path: sstables_map[path][1], reverse=True):
+        remote_path, size, remote_offset = sstables_map[sstable]
+        # Bundled SSTables are stored uncompressed at an offset of their bundle
+        sstable_compression = compression if remote_offset is None else None
+        if sstable_compression is None and os.path.isfile(sstable) and os.path.getsize(sstable) == size:
+            logger.debug("Skipping already restored sstable - {sstable}".format(sstable=sstable))
+            continue
+        ranged_download = _RangedDownload(sstable, size, download_chunksize, sstable_compression, remote_offset)
+        for byte_range in ranged_download.byte_ranges:
+            futures.append(executor.submit(ranged_download.download_range, s3_repository, remote_path, byte_range))
+    concurrent.futures.wait(futures)
+    executor.shutdown()
+    for future in futures:
+        if future.exception() is not None:
+            raise S3DownloadError(future.exception())
+
+
+class _RangedDownload(object):
+    """
+    Downloads a single SSTable as byte ranges into a temporary file which is renamed once every range is written.
+
+    Compressed SSTables are streamed through the decompressor with a single GET, their frames don't line up with
+    byte ranges. Bundled SSTables are read from their offset within the bundle object.
+    """
+
+    def __init__(self, sstable, size, chunksize, compression=None, remote_offset=None):
+        self._sstable = sstable
+        self._temporary_path = sstable + RESTORE_TEMPORARY_SUFFIX
+        self._compression = compression
+        self._remote_offset = remote_offset
+        if compression is not None:
+            self._byte_ranges = [None]
+        else:
+            self._byte_ranges = [(start, min(start + chunksize, size) - 1) for start in range(0, size, chunksize)]
+        self._remaining = len(self._byte_ranges)
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(os.path.dirname(sstable)):
+            os.makedirs(os.path.dirname(sstable))
+        with open(self._temporary_path, 'wb') as temporary_file:
+            temporary_file.truncate(size if compression is None else 0)
+        if not self._byte_ranges:
+            os.rename(self._temporary_path, self._sstable)
+
+    @property
+    def byte_ranges(self):
+        return self._byte_ranges
+
+    def download_range(self, s3_repository, remote_path, byte_range):
+        if self._remote_offset is not None:
+            s3_repository.download(remote_path, self._temporary_path,
+                                   (byte_range[0] + self._remote_offset, byte_range[1] + self._remote_offset),
+                                   file_offset=byte_range[0])
+        else:
+            s3_repository.download(remote_path, self._temporary_path, byte_range, self._compression)
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining == 0:
+                os.rename(self._temporary_path, self._sstable)
+                logger.debug("Restored - {sstable}".format(sstable=self._sstable))
@@ -0,0 +1,305 @@
+"""
+Minimal in-process S3 stand-in for benchmarking Apollo without a real bucket.
+
+Only the calls Apollo issues are implemented (path-style addressing): PutObject, CopyObject, GetObject (with Range),
+HeadObject, ListObjectsV2, DeleteObjects, multipart upload (including UploadPartCopy) and ListParts.
+"""
+import re
+import sys
+import uuid
+import base64
+import hashlib
+import threading
+from xml.sax.saxutils import escape
+
+try:
+    from BaseHTTPServer import (HTTPServer, BaseHTTPRequestHandler)
+    from SocketServer import ThreadingMixIn
+    from urlparse import (urlparse, parse_qs)
+    from urllib import unquote
+except ImportError:
+    from http.server import (HTTPServer, BaseHTTPRequestHandler)
+    from socketserver import ThreadingMixIn
+    from urllib.parse import (urlparse, parse_qs, unquote)
+
+
+class LocalS3Store(object):
+    def __init__(self, keep_data=True):
+        self.keep_data = keep_data
+        self.objects = dict()
+        self.uploads = dict()
+        self.requests = dict()
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    def count(self, operation, received=0):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            self.bytes_received += received
+
+    def put(self, key, data, etag=None):
+        with self._lock:
+            self.objects[key] = {
+                'data': data if self.keep_data else None,
+                'size': len(data),
+                'etag': etag or hashlib.md5(data).hexdigest()
+            }
+        return self.objects[key]['etag']
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _S3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store = None
+    _expect_handled = hasattr(BaseHTTPRequestHandler, 'handle_expect_100')
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = parts[0]
+        key = unquote(parts[1]) if len(parts) > 1 else ''
+        query = dict((k, v[0]) for k, v in parse_qs(url.query, keep_blank_values=True).items())
+        return bucket, key, query
+
+    def _body(self):
+        if self.headers.get('Expect', '').lower() == '100-continue' and not self._expect_handled:
+            self.wfile.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        if 'aws-chunked' in (self.headers.get('Content-Encoding') or ''):
+            data = self._decode_aws_chunked(data)
+        return data
+
+    @staticmethod
+    def _decode_aws_chunked(data):
+        decoded = list()
+        position = 0
+        while True:
+            line_end = data.index(b'\r\n', position)
+            chunk_size = int(data[position:line_end].split(b';')[0], 16)
+            if chunk_size == 0:
+                break
+            decoded.append(data[line_end + 2:line_end + 2 + chunk_size])
+            position = line_end + 2 + chunk_size + 2
+        return b''.join(decoded)
+
+    def _reply(self, status, body=b'', headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        self._reply(status, '<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code></Error>'.format(
+            code=code), {'Content-Type': 'application/xml'})
+
+    def _copy_source(self):
+        source = unquote(self.headers.get('x-amz-copy-source')).lstrip('/')
+        return source.split('/', 1)[1].split('?')[0]
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        store = self.store
+        if 'partNumber' in query:
+            upload = store.uploads.get(query['uploadId'])
+            if upload is None:
+                self._body()
+                return self._error(404, 'NoSuchUpload')
+            if self.headers.get('x-amz-copy-source'):
+                source = store.objects[self._copy_source()]
+                data = source['data'] or b'\0' * source['size']
+                copy_range = self.headers.get('x-amz-copy-source-range')
+                if copy_range:
+                    start, end = [int(x) for x in copy_range.split('=')[1].split('-')]
+                    data = data[start:end + 1]
+                store.count('UploadPartCopy')
+                etag = hashlib.md5(data).hexdigest()
+                upload['parts'][int(query['partNumber'])] = (data, etag)
+                return self._reply(200, '<CopyPartResult><ETag>"{etag}"</ETag></CopyPartResult>'.format(etag=etag))
+            data = self._body()
+            store.count('UploadPart', len(data))
+            etag = hashlib.md5(data).hexdigest()
+            if not self._content_md5_matches(data):
+                return self._error(400, 'BadDigest')
+            upload['parts'][int(query['partNumber'])] = (data, etag)
+            return self._reply(200, headers={'ETag': '"{etag}"'.format(etag=etag)})
+        if self.headers.get('x-amz-copy-source'):
+            self._body()
+            source = store.objects[self._copy_source()]
+            store.count('CopyObject')
+            with store._lock:
+                store.objects[key] = dict(source)
+            return self._reply(200, '<CopyObjectResult><ETag>"{etag}"</ETag></CopyObjectResult>'.format(
+                etag=source['etag']))
+        data = self._body()
+        store.count('PutObject', len(data))
+        if not self._content_md5_matches(data):
+            return self._error(400, 'BadDigest')
+        etag = store.put(key, data)
+        self._reply(200, headers={'ETag': '"{etag}"'.format(etag=etag)})
+
+    def _content_md5_matches(self, data):
+        content_md5 = self.headers.get('Content-MD5')
+        return content_md5 is None or base64.b64decode(content_md5) == hashlib.md5(data).digest()
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        store = self.store
+        body = self._body()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            store.uploads[upload_id] = {'key': key, 'parts': dict()}
+            store.count('CreateMultipartUpload')
+            return self._reply(200, '<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                                    '<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'.format(
+                                        bucket=bucket, key=escape(key), upload_id=upload_id))
+        if 'uploadId' in query:
+            upload = store.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                return self._error(404, 'NoSuchUpload')
+            numbers = [int(n) for n in re.findall(br'<PartNumber>(\d+)</PartNumber>', body)]
+            parts = [upload['parts'][n] for n in numbers]
+            digest = hashlib.md5(b''.join(hashlib.md5(data).digest() for data, _ in parts)).hexdigest()
+            etag = '{digest}-{count}'.format(digest=digest, count=len(parts))
+            store.put(key, b''.join(data for data, _ in parts), etag)
+            store.count('CompleteMultipartUpload')
+            return self._reply(200, '<CompleteMultipartUploadResult><Key>{key}</Key><ETag>"{etag}"</ETag>'
+                                    '</CompleteMultipartUploadResult>'.format(key=escape(key), etag=etag))
+        if 'delete' in query:
+            keys = [unquote(k.decode('utf-8')) for k in re.findall(br'<Key>(.*?)</Key>', body)]
+            with store._lock:
+                for deleted_key in keys:
+                    store.objects.pop(deleted_key.replace('&amp;', '&'), None)
+            store.count('DeleteObjects')
+            deleted = ''.join('<Deleted><Key>{key}</Key></Deleted>'.format(key=escape(k)) for k in keys)
+            return self._reply(200, '<DeleteResult>{deleted}</DeleteResult>'.format(deleted=deleted))
+        self._error(400, 'NotImplemented')
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        if 'uploadId' in query:
+            self.store.uploads.pop(query['uploadId'], None)
+            self.store.count('AbortMultipartUpload')
+        else:
+            with self.store._lock:
+                self.store.objects.pop(key, None)
+            self.store.count('DeleteObject')
+        self._reply(204)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        store = self.store
+        if not key:
+            return self._list(bucket, query)
+        if 'uploadId' in query:
+            upload = store.uploads.get(query['uploadId'])
+            if upload is None:
+                return self._error(404, 'NoSuchUpload')
+            parts = ''.join('<Part><PartNumber>{n}</PartNumber><ETag>"{etag}"</ETag><Size>{size}</Size></Part>'.format(
+                n=n, etag=etag, size=len(data)) for n, (data, etag) in sorted(upload['parts'].items()))
+            store.count('ListParts')
+            return self._reply(200, '<ListPartsResult><IsTruncated>false</IsTruncated>{parts}</ListPartsResult>'.format(
+                parts=parts))
+        obj = store.objects.get(key)
+        store.count(self.command == 'HEAD' and 'HeadObject' or 'GetObject')
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+        data = obj['data'] if obj['data'] is not None else b'\0' * obj['size']
+        headers = {'ETag': '"{etag}"'.format(etag=obj['etag']), 'Accept-Ranges': 'bytes'}
+        byte_range = self.headers.get('Range')
+        if byte_range and self.command == 'GET':
+            start, end = byte_range.split('=')[1].split('-')
+            start, end = int(start), min(int(end or obj['size'] - 1), obj['size'] - 1)
+            headers['Content-Range'] = 'bytes {start}-{end}/{size}'.format(start=start, end=end, size=obj['size'])
+            return self._reply(206, data[start:end + 1], headers)
+        if self.command == 'HEAD':
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(obj['size']))
+            return self.end_headers()
+        self._reply(200, data, headers)
+
+    def _list(self, bucket, query):
+        store = self.store
+        store.count('ListObjectsV2')
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        start_after = query.get('continuation-token') or query.get('start-after') or ''
+        max_keys = int(query.get('max-keys', 1000))
+        with store._lock:
+            keys = sorted(k for k in store.objects if k.startswith(prefix) and k > start_after)
+        contents, prefixes, last_key, truncated = list(), list(), None, False
+        for key in keys:
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            if delimiter and delimiter in key[len(prefix):]:
+                common = prefix + key[len(prefix):].split(delimiter, 1)[0] + delimiter
+                if common not in prefixes:
+                    prefixes.append(common)
+                last_key = common + u'\uffff'
+                continue
+            contents.append(key)
+            last_key = key
+        body = ['<ListBucketResult><Name>{bucket}</Name><Prefix>{prefix}</Prefix><KeyCount>{count}</KeyCount>'
+                '<IsTruncated>{truncated}</IsTruncated>'.format(bucket=bucket, prefix=escape(prefix),
+                                                                count=len(contents) + len(prefixes),
+                                                                truncated=str(truncated).lower())]
+        if truncated:
+            body.append('<NextContinuationToken>{token}</NextContinuationToken>'.format(token=escape(last_key)))
+        for key in contents:
+            obj = store.objects[key]
+            body.append('<Contents><Key>{key}</Key><Size>{size}</Size><ETag>"{etag}"</ETag></Contents>'.format(
+                key=escape(key), size=obj['size'], etag=obj['etag']))
+        for common in prefixes:
+            body.append('<CommonPrefixes><Prefix>{prefix}</Prefix></CommonPrefixes>'.format(prefix=escape(common)))
+        body.append('</ListBucketResult>')
+        self._reply(200, ''.join(body), {'Content-Type': 'application/xml'})
+
+
+class LocalS3Server(object):
+    def __init__(self, host='127.0.0.1', port=0, keep_data=True):
+        self.store = LocalS3Store(keep_data)
+        store = self.store
+
+        class handler(_S3RequestHandler):
+            pass
+        handler.store = store
+        self._server = _ThreadingHTTPServer((host, port), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def endpoint_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{host}:{port}'.format(host=host, port=port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    server = LocalS3Server(port=int(sys.argv[1]) if len(sys.argv) > 1 else 9000).start()
+    print(server.endpoint_url)
+    server._thread.join()
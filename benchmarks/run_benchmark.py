@@ -0,0 +1,178 @@
+"""
+Measures `cassandra_backup_to_s3` throughput against the local S3 stand-in across upload settings.
+
+A synthetic data directory is generated once (or reused with --data-dir), then a full snapshot of it is taken for
+every combination of the comma separated settings, each one into a fresh in-process S3 store. Snapshots are taken
+with the stub nodetool next to this script.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import argparse
+import itertools
+import threading
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIRECTORY))
+
+from local_s3 import LocalS3Server
+from synthetic_data import (generate_data_directory, SIZE_DISTRIBUTIONS)
+from apollo_cli.snapshot_repository import S3Handler
+from apollo_cli.cassandra_handler import CassandraHandler
+from apollo_cli.snapshot_metadata import SnapshotMetadata
+from apollo_cli.transfer_scheduler import TransferScheduler
+from apollo_cli.transfer_policy import TransferPolicy
+from apollo_cli.compression import StreamCompressor
+from apollo_cli.utils import (cassandra_backup_to_s3, convert_mb_to_byte)
+
+BENCHMARK_BUCKET = "apollo-benchmark"
+BENCHMARK_NODE = "benchmark-node"
+SAMPLE_INTERVAL = 0.05
+PUT_OPERATIONS = ('PutObject', 'UploadPart')
+
+
+class ResourceSampler(object):
+    """
+    Samples the resident set size and thread count of this process while a benchmark runs, keeping the peaks.
+    """
+
+    def __init__(self):
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="resource-sampler")
+        self._thread.daemon = True
+        self.peak_rss = 0
+        self.peak_threads = 0
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _sample(self):
+        while True:
+            with open('/proc/self/statm') as statm:
+                self.peak_rss = max(self.peak_rss, int(statm.read().split()[1]) * self._page_size)
+            # The sampler thread itself isn't counted
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+            if self._stop_event.wait(SAMPLE_INTERVAL):
+                return
+
+
+def run_backup(data_directory, upload_workers, upload_chunksize, crawl_workers, compress, compress_workers,
+               bundle_threshold):
+    server = LocalS3Server(keep_data=False).start()
+    compressor = StreamCompressor(compress, compress_workers) if compress is not None else None
+    try:
+        repository = S3Handler(BENCHMARK_BUCKET, 'benchmark', 'benchmark', False, upload_workers,
+                               endpoint_url=server.endpoint_url)
+        # A part size of 0 benchmarks the automatic part size
+        policy = TransferPolicy(upload_workers, S3Handler.convert_kb_to_byte(upload_chunksize) or None)
+        with ResourceSampler() as sampler:
+            started_at = time.time()
+            cassandra = CassandraHandler(BENCHMARK_NODE, data_directory, BENCHMARKS_DIRECTORY, None,
+                                         crawl_workers=crawl_workers)
+            metadata = SnapshotMetadata(cassandra, repository)
+            transfer_scheduler = TransferScheduler(repository, upload_workers, compressor=compressor,
+                                                   policy=policy)
+            cassandra_backup_to_s3(metadata, repository, cassandra, transfer_scheduler,
+                                   bundle_threshold=S3Handler.convert_kb_to_byte(bundle_threshold),
+                                   bundle_size=convert_mb_to_byte(16))
+            elapsed = time.time() - started_at
+        cassandra.clear_snapshot()
+    finally:
+        if compressor is not None:
+            compressor.shutdown()
+        server.stop()
+
+    files_count = sum(len(sstables) for keyspace_tables in metadata.sstables.values()
+                      for sstables in keyspace_tables.values())
+    files_count += sum(len(sstables) for keyspace_tables in metadata.bundled_sstables.values()
+                       for sstables in keyspace_tables.values())
+    return {
+        "upload_workers": upload_workers,
+        "upload_chunksize": upload_chunksize,
+        "crawl_workers": crawl_workers,
+        "seconds": round(elapsed, 3),
+        "files": files_count,
+        "files_per_second": round(files_count / elapsed, 1),
+        "mb_per_second": round(server.store.bytes_received / elapsed / (1024 * 1024), 1),
+        "put_requests": sum(server.store.requests.get(operation, 0) for operation in PUT_OPERATIONS),
+        "requests": sum(server.store.requests.values()),
+        "peak_rss_mb": round(sampler.peak_rss / (1024.0 * 1024), 1),
+        "peak_threads": sampler.peak_threads,
+    }
+
+
+def format_table(results):
+    columns = ("upload_workers", "upload_chunksize", "crawl_workers", "seconds", "files", "files_per_second",
+               "mb_per_second", "put_requests", "requests", "peak_rss_mb", "peak_threads")
+    widths = [max(len(column), max(len(str(result[column])) for result in results)) for column in columns]
+    lines = ["  ".join(column.rjust(width) for column, width in zip(columns, widths))]
+    for result in results:
+        lines.append("  ".join(str(result[column]).rjust(width) for column, width in zip(columns, widths)))
+    return "\n".join(lines)
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', default=None, help='reuse an existing data directory instead of generating one')
+    parser.add_argument('--keyspaces', type=int, default=2)
+    parser.add_argument('--tables', type=int, default=8)
+    parser.add_argument('--sstables', type=int, default=4)
+    parser.add_argument('--data-size', type=int, default=4096, help='mean Data.db size (KB)')
+    parser.add_argument('--distribution', choices=SIZE_DISTRIBUTIONS, default='exponential')
+    parser.add_argument('--upload-workers', type=_int_list, default=[1, 4, 16])
+    parser.add_argument('--upload-chunksize', type=_int_list, default=[0],
+                        help='multipart part sizes (KB), 0 for the automatic part size')
+    parser.add_argument('--crawl-workers', type=_int_list, default=[1])
+    parser.add_argument('--compress', choices=['zstd', 'lz4'], default=None)
+    parser.add_argument('--compress-workers', type=int, default=2)
+    parser.add_argument('--bundle-threshold', type=int, default=0, help='bundle components below this size (KB)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print one JSON document per run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='[%(levelname)s] [%(asctime)s] %(message)s')
+
+    data_directory = args.data_dir
+    if data_directory is None:
+        data_directory = tempfile.mkdtemp(prefix='apollo-benchmark-')
+        files_count, total_size = generate_data_directory(data_directory, args.keyspaces, args.tables,
+                                                          args.sstables, args.data_size * 1024, args.distribution)
+        sys.stderr.write("Generated {files} files, {size:.1f} MB in {path}\n".format(
+            files=files_count, size=total_size / (1024.0 * 1024), path=data_directory))
+    os.environ['FAKE_NODETOOL_DATA_DIR'] = data_directory
+
+    results = list()
+    try:
+        for upload_workers, upload_chunksize, crawl_workers in itertools.product(
+                args.upload_workers, args.upload_chunksize, args.crawl_workers):
+            for _ in range(args.repeat):
+                result = run_backup(data_directory, upload_workers, upload_chunksize, crawl_workers, args.compress,
+                                    args.compress_workers, args.bundle_threshold)
+                if args.json:
+                    sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+                    sys.stdout.flush()
+                results.append(result)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_directory, ignore_errors=True)
+
+    if not args.json:
+        sys.stdout.write(format_table(results) + "\n")
+
+
+if __name__ == '__main__':
+    main()
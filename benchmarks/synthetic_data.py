@@ -0,0 +1,82 @@
+"""
+Generates synthetic Cassandra data directories for benchmarking Apollo.
+
+Every table gets `sstables` generations of the usual SSTable components. Data.db sizes follow the chosen distribution
+around `data_size` bytes and the other components are sized relative to Data.db, so most of them are a few KB.
+"""
+import os
+import sys
+import uuid
+import random
+import argparse
+
+SSTABLE_COMPONENTS = (
+    ('TOC.txt', 0.0001), ('Digest.crc32', 0.00001), ('CRC.db', 0.0002), ('Filter.db', 0.002),
+    ('Summary.db', 0.001), ('Statistics.db', 0.001), ('CompressionInfo.db', 0.0005), ('Index.db', 0.02),
+    ('Data.db', 1.0)
+)
+SIZE_DISTRIBUTIONS = ('exponential', 'uniform', 'fixed')
+MIN_COMPONENT_SIZE = 32
+WRITE_BLOCK_SIZE = 1024 * 1024
+
+
+def _data_size(rng, distribution, data_size):
+    if distribution == 'fixed':
+        return data_size
+    if distribution == 'uniform':
+        return int(rng.uniform(0, 2 * data_size)) + 1
+    return int(rng.expovariate(1.0 / data_size)) + 1
+
+
+def _write_component(path, size):
+    # A repeated random block keeps generation fast and makes the data moderately compressible
+    block = os.urandom(min(size, WRITE_BLOCK_SIZE) // 4 + 1) * 4
+    with open(path, 'wb') as component_file:
+        remaining = size
+        while remaining > 0:
+            component_file.write(block[:min(remaining, len(block))])
+            remaining -= len(block)
+
+
+def generate_data_directory(data_dir, keyspaces=2, tables=4, sstables=4, data_size=1024 * 1024,
+                            distribution='exponential', seed=0):
+    """
+    Writes keyspace<k>/table<t>-<id>/mc-<generation>-big-<component> files and returns (files, bytes) written.
+    """
+    rng = random.Random(seed)
+    files_count, total_size = 0, 0
+    for keyspace_index in range(keyspaces):
+        for table_index in range(tables):
+            table_path = os.path.join(data_dir, 'keyspace{keyspace}'.format(keyspace=keyspace_index),
+                                      'table{table}-{table_id}'.format(
+                                          table=table_index, table_id=uuid.UUID(int=rng.getrandbits(128)).hex))
+            os.makedirs(os.path.join(table_path, 'backups'))
+            for generation in range(1, sstables + 1):
+                sstable_size = _data_size(rng, distribution, data_size)
+                for component, ratio in SSTABLE_COMPONENTS:
+                    component_size = max(int(sstable_size * ratio), MIN_COMPONENT_SIZE)
+                    _write_component(os.path.join(table_path, 'mc-{generation}-big-{component}'.format(
+                        generation=generation, component=component)), component_size)
+                    files_count += 1
+                    total_size += component_size
+    return files_count, total_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('data_dir')
+    parser.add_argument('--keyspaces', type=int, default=2)
+    parser.add_argument('--tables', type=int, default=4)
+    parser.add_argument('--sstables', type=int, default=4)
+    parser.add_argument('--data-size', type=int, default=1024, help='mean Data.db size (KB)')
+    parser.add_argument('--distribution', choices=SIZE_DISTRIBUTIONS, default='exponential')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    files_count, total_size = generate_data_directory(args.data_dir, args.keyspaces, args.tables, args.sstables,
+                                                      args.data_size * 1024, args.distribution, args.seed)
+    sys.stdout.write("{files} files, {size} bytes\n".format(files=files_count, size=total_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,8 +17,14 @@ setup(
     install_requires=[
         'Click>=7.0',
         'boto3>=1.9.0',
-        'slackclient>=1.3.0'
+        'slackclient>=1.3.0',
+        'futures>=3.0.0;python_version<"3.2"',
+        'scandir>=1.5;python_version<"3.5"'
     ],
+    extras_require={
+        'zstd': ['zstandard>=0.9.0'],
+        'lz4': ['lz4>=2.0.0'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: System Administrators',